@@ -1,6 +1,4 @@
-
-
 from .client    import *
+from .pool      import *
 
-__all__ = (client.__all__)
-
+__all__ = (client.__all__ + pool.__all__)
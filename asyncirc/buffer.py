@@ -2,13 +2,23 @@
 
 __all__ = ['LineBuffer']
 
-import re
 
 class LineBuffer:
-    _line_sep = re.compile('\r?\n')
+    """Incremental byte buffer which frames CRLF (or bare LF) terminated lines.
 
-    def __init__(self):
-        self._buffer = ''
+    Only the bytes pushed since the last call to lines() are scanned for a
+    line separator, and consumed lines are released from the front of the
+    buffer in one go, so a burst of data costs time linear in its size.
+
+    Lines longer than max_line_length are truncated, and the remainder up to
+    the next line separator is discarded.
+    """
+
+    def __init__(self, max_line_length=None):
+        self._buffer = bytearray()
+        self._scan = 0
+        self._discard = False
+        self.max_line_length = max_line_length
 
     def __iter__(self):
         return self.lines()
@@ -17,10 +27,44 @@ class LineBuffer:
         return len(self._buffer)
 
     def push(self, data):
+        # throw away the tail end of an overlong line
+        if self._discard:
+            pos = data.find(b'\n')
+            if pos < 0:
+                return
+            data = memoryview(data)[pos:]
+            self._discard = False
+
         self._buffer += data
 
     def lines(self):
-        lines = self._line_sep.split(self._buffer)
-        self._buffer = lines.pop()
-        return iter(lines)
+        buf = self._buffer
+        maxlen = self.max_line_length
+        lines = []
+        start = 0
+
+        pos = buf.find(b'\n', self._scan)
+        with memoryview(buf) as view:
+            while pos >= 0:
+                end = pos
+                if end > start and buf[end - 1] == 0x0d:
+                    end -= 1
+                if maxlen and end - start > maxlen:
+                    end = start + maxlen
+                lines.append(bytes(view[start:end]))
 
+                start = pos + 1
+                pos = buf.find(b'\n', start)
+
+        # drop everything we've consumed
+        if start:
+            del buf[:start]
+
+        # a partial line that's already too long gets cut short here,
+        # so the buffer can't grow without bounds
+        if maxlen and len(buf) > maxlen:
+            del buf[maxlen:]
+            self._discard = True
+
+        self._scan = len(buf)
+        return iter(lines)
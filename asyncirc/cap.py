@@ -0,0 +1,112 @@
+"""IRCv3 client capability negotiation"""
+
+__all__ = ['CapNegotiator']
+
+import logging
+
+from . import protocol
+
+log = logging.getLogger(__name__)
+
+
+class CapNegotiator:
+    """Negotiates IRCv3 capabilities while registering.
+
+    On connecting we list the server's capabilities with CAP LS, request
+    the ones we want that it has, and end negotiation once it's answered.
+    Servers which don't know CAP ignore it and carry on registering.
+    Capabilities added or removed later (cap-notify) are followed too.
+    """
+
+    def __init__(self, client, wanted):
+        self.client = client
+        self.wanted = frozenset(wanted)
+        self.clear()
+
+    def __contains__(self, name):
+        return name in self.enabled
+
+    def clear(self):
+        """Forget everything, e.g. when disconnected"""
+        # name -> value (or '') of what the server has, and what we got
+        self.available = {}
+        self.enabled = set()
+
+        self.negotiating = False
+        self._requests = 0
+
+    def start(self):
+        """Begin negotiating, this must be sent before NICK and USER"""
+        self.clear()
+        self.negotiating = True
+        self.client._send('CAP LS 302')
+
+    def update(self, args):
+        """Handle a CAP reply"""
+        # nick|* LS [*] :caps
+        if len(args) < 3:
+            return
+
+        subcommand = args[1].upper()
+        caps = self._parse(args[-1])
+
+        if subcommand == 'LS':
+            self.available.update(caps)
+            # more to come
+            if len(args) > 3 and args[2] == '*':
+                return
+            if self.negotiating:
+                self._request(self.available)
+
+        elif subcommand == 'ACK':
+            for name in caps:
+                if name.startswith('-'):
+                    self.enabled.discard(name[1:])
+                else:
+                    self.enabled.add(name.lstrip('~='))
+            log.debug('*** capabilities: {0}'.format(' '.join(sorted(self.enabled))))
+            self._answered()
+
+        elif subcommand == 'NAK':
+            log.info('*** capabilities refused: {0}'.format(args[-1]))
+            self._answered()
+
+        elif subcommand == 'NEW':
+            self.available.update(caps)
+            self._request(caps)
+
+        elif subcommand == 'DEL':
+            for name in caps:
+                self.available.pop(name, None)
+                self.enabled.discard(name)
+
+    def _parse(self, caps):
+        """Split 'sasl=PLAIN,EXTERNAL multi-prefix' into a dict"""
+        parsed = {}
+        for cap in caps.split():
+            name, _, value = cap.partition('=')
+            parsed[name] = value
+        return parsed
+
+    def _request(self, caps):
+        """Ask for the capabilities we want from caps"""
+        names = sorted(name for name in self.wanted.intersection(caps)
+                       if name not in self.enabled)
+
+        room = protocol.MAX_LINE_LENGTH - 2 - len('CAP REQ :')
+        for group in protocol.pack(names, None, room):
+            self._requests += 1
+            self.client._send('CAP REQ :' + ' '.join(group))
+
+        if not self._requests:
+            self._end()
+
+    def _answered(self):
+        self._requests = max(0, self._requests - 1)
+        if not self._requests:
+            self._end()
+
+    def _end(self):
+        if self.negotiating:
+            self.negotiating = False
+            self.client._send('CAP END')
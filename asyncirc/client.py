@@ -1,17 +1,25 @@
-"""IRC Client library using Asynchronous I/O via the py3k 'tulip' library"""
+"""IRC Client library using Asynchronous I/O via the py3k 'asyncio' library"""
 
 __author__    = 'Michael Stella <asyncirc@thismetalsky.org>'
-__version__   = 'tulip-0.1'
+__version__   = 'asyncio-0.2'
 __copyright__ = 'Copyright 2013 Michael Stella'
 
-__all__ = ['IRCClient', 'IRCError', 'NotConnected']
+__all__ = ['IRCClient', 'IRCError', 'NotConnected', 'use_uvloop']
 
-import datetime, logging, sys, time
-import tulip
+import asyncio, functools, inspect, logging, random, sys, time
 
 from . import buffer
+from . import cap
 from . import events
+from . import flood
+from . import isupport
+from . import metrics
 from . import protocol
+from . import queries
+from . import routes
+from . import schedule
+from . import state
+from . import tasks
 
 class IRCError(Exception): pass
 class InvalidCharacters(ValueError): pass
@@ -20,11 +28,109 @@ class NotConnected(IRCError): pass
 log = logging.getLogger(__name__)
 #log.setLevel(logging.DEBUG)
 
+
+def use_uvloop():
+    """Switch to uvloop's faster event loop, if it's installed.  This has
+    to be done before any loops are created.  Returns True if it was."""
+    try:
+        import uvloop
+    except ImportError:
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
 class IRCClient:
     """IRC Client object"""
 
+    # on_* methods which are client hooks, not IRC command handlers
+    _hooks = ('on_connect', 'on_disconnect', 'on_reconnecting')
+
+    # commands the client handles itself, whether or not there's a handler
+    _internal = frozenset(['001', '005', '376', '422', 'NICK', 'JOIN', '396', 'PING',
+                           'PRIVMSG', 'NOTICE', 'CAP', 'BATCH', 'PART', 'KICK'])
+
+    # replies to a JOIN which failed, and those which mean it never will
+    _join_errors = frozenset(['403', '405', '471', '473', '474', '475', '476', '477'])
+    _join_fatal  = frozenset(['403', '476'])
+
+    # incoming text is decoded with the first of these that works, and
+    # keep_raw gives events the undecoded line as event.raw, and leaves
+    # lines only handlers want undecoded until the handler needs them
+    encodings = ('UTF-8', 'cp1252')
+    keep_raw  = False
+
+    # reconnect backoff, in seconds: the delay doubles with each attempt
+    # up to the maximum, and a random jitter of up to half is taken off
+    reconnect_delay     = 5
+    reconnect_max_delay = 300
+
+    # outbound flood control: up to flood_burst messages at once, then
+    # flood_rate messages per second.  Set flood_rate to None to disable.
+    flood_burst = 5
+    flood_rate  = 1.0
+
+    # keep track of channel members in self.state
+    track_state = True
+
+    # join the channels we were on again after reconnecting
+    rejoin = True
+
+    # file to keep scheduled messages in, so they survive restarts
+    schedule_file = None
+
+    # async def handlers run as tasks, at most handler_concurrency at once
+    # in total (tasks.GLOBAL) or for each channel (tasks.PER_CHANNEL).  With
+    # handler_ordered, each source's events are handled one at a time.
+    handler_concurrency = 10
+    handler_scope       = tasks.GLOBAL
+    handler_ordered     = False
+
+    # collect metrics in self.metrics, and pass them to its sinks every
+    # metrics_interval seconds, see metrics.py.  Off, this costs nothing.
+    collect_metrics  = False
+    metrics_interval = 10
+
+    # in channels, bot commands start with one of these, or with our
+    # nick if command_address is set, see routes.py
+    command_prefixes = ('!',)
+    command_address  = True
+
+    # IRCv3 capabilities to ask for, if the server has them
+    capabilities = ('message-tags', 'server-time', 'batch', 'multi-prefix',
+                    'away-notify', 'extended-join')
+
+    # types of BATCH whose messages are collected into one event for
+    # on_batch, rather than handled one by one
+    aggregate_batches = ('netsplit', 'netjoin')
+
+    # transport write buffer limits in bytes, writing is paused above the
+    # high water mark until the buffer drains below the low one.  None
+    # leaves the transport's defaults.
+    write_buffer_high = None
+    write_buffer_low  = None
+
+    # most bytes of normal and low priority messages to hold in the send
+    # queue, and what to do when it's full, see flood.SendQueue
+    send_queue_max_bytes = 256 * 1024
+    send_queue_overflow  = flood.DROP_OLDEST
+
+    # everything sent in one loop iteration goes out in a single write,
+    # or sooner once this many bytes are waiting (without flood control)
+    send_flush_bytes = 64 * 1024
+
+    # seconds to wait for the replies to whois_async() and friends
+    query_timeout = 30
+
+    # how many WHOIS and USERHOST results to cache, and for how many
+    # seconds, 0 turns the cache off
+    query_cache_size = 1000
+    query_cache_ttl  = 300
+
     def __init__(self, host, port=6667, ssl=False,
-                 nickname='monkey', username=None, ircname=None):
+                 nickname='monkey', username=None, ircname=None,
+                 network=None, loop=None):
         if not isinstance(port, int):
             raise ValueError("port must be an integer")
 
@@ -33,41 +139,195 @@ class IRCClient:
         self.port = port
         self.ssl = ssl
 
+        # what makes the connection, loop.create_connection unless set,
+        # e.g. to server.FakeServer.create_connection
+        self.connector = None
+
+        # the network name events get tagged with, and the IRCPool
+        # managing this client if there is one
+        self.network = network or host
+        self.pool = None
+
         # names
         self.nickname = nickname
         self.username = username or nickname
         self.ircname  = ircname or nickname
         self.real_server_name = None
 
-        # the incoming data buffer
-        self.buffer = buffer.LineBuffer()
+        # our user@host as other clients see it, once we know
+        self._own_userhost = None
 
-        # our event loop
-        self.loop = tulip.get_event_loop()
+        # what the server supports, and its limits
+        self.isupport = isupport.ISupport()
+        self.casefold = protocol.CaseFolder(self.isupport.casemapping)
+        self.cap = cap.CapNegotiator(self, self.capabilities)
+
+        # batch reference -> BatchEvent being collected
+        self._batches = {}
+
+        # casefolded channel -> (name, key) of the channels we're on, or
+        # trying to be, and those we've sent a JOIN for since connecting
+        self.joined = {}
+        self._join_sent = set()
+        self._rejoin_due = False
+
+        # the incoming data buffer
+        self.buffer = buffer.LineBuffer(
+                max_line_length=protocol.MAX_LINE_LENGTH + protocol.MAX_TAGS_LENGTH)
+
+        # handler dispatch tables, built once per class
+        if '_handlers' not in type(self).__dict__:
+            type(self)._build_handlers()
+
+        # the outgoing message queue
+        self.transport = None
+        self.send_queue = flood.SendQueue(None, self._write,
+                                          self.flood_rate, self.flood_burst,
+                                          self.send_queue_max_bytes,
+                                          self.send_queue_overflow,
+                                          self.send_flush_bytes)
+        self._drain_waiters = []
+
+        self.metrics = metrics.Metrics(self, self.metrics_interval) \
+                if self.collect_metrics else None
+
+        # async handlers in progress
+        self.handlers = tasks.HandlerRunner(self, self.handler_concurrency,
+                                            self.handler_scope, self.handler_ordered)
+
+        # delayed messages, held until we're registered, so those which
+        # come due while we're away are sent once we're back
+        self.scheduler = schedule.Scheduler(resolve=functools.partial(getattr, self),
+                                            path=self.schedule_file)
+        self.scheduler.pause()
+
+        # our event loop, if not given it's the one we connect from
+        self.loop = None
+        self._done = None
+        if loop:
+            self._bind(loop)
+
+        # bot commands and triggers
+        self.router = routes.Router(self, self._routes, self.command_prefixes,
+                                    self.command_address) if self._routes else None
+
+        # channel and user state
+        self.state = state.StateTracker(self) if self.track_state else None
+
+        # queries waiting for replies
+        self.queries = queries.QueryManager(self, self.query_timeout,
+                                            self.query_cache_size, self.query_cache_ttl)
+
+        # the commands the client itself needs to see
+        needed = self._internal.union(self.queries.commands, self._join_errors)
+        if self.queries.cache is not None:
+            needed |= self.queries.stale
+        if self.state:
+            needed |= self.state.commands
+        if 'BATCH' in self._handlers:
+            # the messages that make up netsplits and netjoins
+            needed |= {'QUIT', 'JOIN'}
+
+        # lines with any other command are dropped before decoding
+        self._wanted = needed.union(self._handlers)
+
+        # with keep_raw, lines which only go to a handler are decoded
+        # when the handler first looks past event.raw
+        self._lazy = frozenset(self._handlers).difference(needed) if self.keep_raw \
+                else frozenset()
+
+        self._apply_isupport()
 
         # status info
         self.connected = False
         self.reconnect = True
         self.reconnect_count = 1
+        self._reconnect_handle = None
+        self._connect_task = None
+
+
+    def _bind(self, loop):
+        """Use an event loop"""
+        self.loop = loop
+        self.send_queue.loop = loop
+        self.scheduler.start(loop)
+        if self.metrics is not None:
+            self.metrics.start()
+
 
+    async def connect(self):
+        """Connect to the server, returns once the connection is made"""
+        self._bind(asyncio.get_running_loop())
+        self._reconnect_handle = None
+
+        connector = self.connector or self.loop.create_connection
+        connect = connector(lambda: self, self.host, self.port, ssl=self.ssl)
+        if self.pool:
+            connect = self.pool._limit_connect(connect)
+
+        await connect
 
     def _connect(self):
-        """Create a connection"""
-        tulip.Task(self.loop.create_connection(lambda: self, self.host, self.port, ssl=self.ssl))
+        """Start connecting in the background, retrying on failure"""
+        task = self._connect_task = self.loop.create_task(self.connect())
+        task.add_done_callback(self._connect_done)
+        return task
+
+    def _connect_done(self, task):
+        """Retry if the connection attempt failed"""
+        if task is self._connect_task:
+            self._connect_task = None
+        if task.cancelled():
+            return
+
+        exc = task.exception()
+        if exc:
+            self.connection_refused(exc)
+            if self.reconnect:
+                self._reconnect()
+            else:
+                self._finished()
 
     def _reconnect(self):
-        """Reconnect to the server, with an increasing delay time"""
-        rctime = 5 * self.reconnect_count
-        log.info('*** reconnecting in {0} seconds'.format(rctime))
-        time.sleep(rctime)
+        """Schedule a reconnect to the server, with an increasing delay time"""
+        if self._reconnect_handle:
+            return
+
+        delay = min(self.reconnect_max_delay,
+                    self.reconnect_delay * 2 ** (self.reconnect_count - 1))
+        delay -= random.uniform(0, delay / 2)
+
+        log.info('*** reconnecting in {0:.1f} seconds'.format(delay))
+        self.on_reconnecting(self.reconnect_count, delay)
+        if self.metrics is not None:
+            self.metrics.reconnects += 1
+
+        self._reconnect_handle = self.loop.call_later(delay, self._connect)
         self.reconnect_count += 1
-        self._connect()
 
+    def cancel_reconnect(self):
+        """Cancel a scheduled reconnect, or a connection attempt still in
+        progress, returns True if there was one"""
+        if self._connect_task:
+            self._connect_task.cancel()
+            self._connect_task = None
+            return True
+
+        if not self._reconnect_handle:
+            return False
+
+        self._reconnect_handle.cancel()
+        self._reconnect_handle = None
+        return True
 
-    def run(self):
-        """Start the loop"""
+
+    async def run(self):
+        """Connect, and keep the connection going (reconnecting as needed)
+        until we quit"""
+        self._bind(asyncio.get_running_loop())
+        self._done = self.loop.create_future()
         self._connect()
-        self.loop.run_forever()
+        await self._done
 
 
 #    def disconnect(self, message=''):
@@ -78,14 +338,18 @@ class IRCClient:
 #        self.loop.stop()
 
 
-    ### Tulip responses ###
+    ### asyncio responses ###
 
     def connection_made(self, transport):
         self.transport = transport
         self.connected = True
+        if self.write_buffer_high is not None:
+            transport.set_write_buffer_limits(self.write_buffer_high, self.write_buffer_low)
         self.on_connect()
 
         # logon to IRC
+        if self.capabilities:
+            self.cap.start()
         self.nick(self.nickname)
         self.user(self.username, self.ircname)
 
@@ -96,84 +360,371 @@ class IRCClient:
 
     def connection_lost(self, exc):
         log.error('*** connection lost: {0}'.format(exc))
-        self.connected = False
-        self.on_disconnect()
-        if self.reconnect:
-            self._reconnect()
-        else:
-            self.loop.stop()
+        self._disconnected()
 
 
     def eof_received(self):
         log.info('*** connection closed')
+        self._disconnected()
+
+
+    def _disconnected(self):
+        """Clean up after the connection goes away, this is called for
+        both EOF and a lost connection, but only acts once."""
+        if not self.connected:
+            return
+
         self.connected = False
+        self.send_queue.clear()
+        self._wake_drain_waiters()
+        if self.state:
+            self.state.clear()
+        self.queries.cancel_all(NotConnected())
+        if self.queries.cache is not None:
+            self.queries.cache.clear()
+        self._own_userhost = None
+        self.isupport.clear()
+        self._apply_isupport()
+        self.cap.clear()
+        self._batches.clear()
+        self._join_sent.clear()
+        self._rejoin_due = False
+        self.scheduler.pause()
         self.on_disconnect()
         if self.reconnect:
             self._reconnect()
         else:
-            self.loop.stop()
+            self._finished()
+
+
+    def _finished(self):
+        """We're done for good, let run() or the pool know"""
+        self.scheduler.save()
+        self.handlers.cancel_all()
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.pool:
+            self.pool._client_finished(self)
+        elif self._done and not self._done.done():
+            self._done.set_result(None)
+
+
+    def pause_writing(self):
+        """The transport's buffer is over the high water mark, hold
+        everything in the send queue for now"""
+        self.send_queue.pause()
+
+
+    def resume_writing(self):
+        """The transport's buffer is below the low water mark again"""
+        self.send_queue.resume()
+        self._wake_drain_waiters()
+
+
+    @property
+    def bytes_buffered(self):
+        """Outgoing bytes not yet sent, in the send queue and the
+        transport's buffer"""
+        buffered = self.send_queue.bytes_queued
+        if self.connected:
+            buffered += self.transport.get_write_buffer_size()
+        return buffered
 
 
     ### Process IRC messages ###
 
     def data_received(self, data):
         """Process messages from the server"""
-        self.buffer.push(data.decode())
+        # lines are decoded one at a time, so multi-byte characters
+        # split across reads survive
+        self.buffer.push(data)
         for line in self.buffer:
             if line:
                 self._handle_line(line)
 
 
     def _handle_line(self, line):
-        """Handle an incoming IRC message"""
+        """Handle an incoming IRC message, as raw bytes"""
 
-        (tags, prefix, command, args) = protocol.parse(line)
+        command = protocol.verb_bytes(line).decode('ascii', 'replace').upper()
 
-        # translate numerics
-        command = events.numeric.get(command, command).lower()
-        if not command:
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.received(command, len(line))
+
+        # nothing to do with this one, so don't bother decoding it
+        if command not in self._wanted:
+            return
+
+        # no one but its handler needs this one, which can decode it
+        if command in self._lazy and not self._batches:
+            log.debug('<- %r', line)
+            name, handler = self._handlers[command]
+            self._dispatch(handler, events.RawEvent(line, name, self.network,
+                                                    self.casefold, self.encodings))
             return
 
-        log.debug('<- p: {0} c: {1} a: {2}'.format(prefix, command, args))
+        if metrics is not None:
+            start = time.perf_counter()
+
+        # mostly the whole line decodes fine, if not the parts are decoded
+        # one by one, using the fallback encodings
+        try:
+            (tags, prefix, _, args) = protocol.parse(line.decode(self.encodings[0]))
+        except UnicodeDecodeError:
+            (tags, prefix, _, args) = protocol.parse_bytes(line, self.encodings)
+
+        if metrics is not None:
+            metrics.parse_time.observe(time.perf_counter() - start)
+
+        raw = line if self.keep_raw else None
+
+        # not formatted unless it's logged
+        log.debug('<- p: %s c: %s a: %s', prefix, command, args)
 
-        if command == 'welcome':
+        if command == '001':
             # record the nickname in case the server changed it
             self.nickname = args[0]
 
             # reset the reconnect count
             self.reconnect_count = 1
 
+            # back to where we were once the MOTD's done, by when
+            # ISUPPORT has said how many channels fit in a JOIN
+            self._rejoin_due = self.rejoin
+
+        elif command in ('376', '422'):
+            # end of the MOTD, or there isn't one
+            if self._rejoin_due:
+                self._rejoin_due = False
+                if self.joined:
+                    self.join(*zip(*self.joined.values()))
+            self.scheduler.resume()
+
+        elif command == 'NICK' and args and \
+                self.is_me(prefix.split('!', 1)[0]):
+            # our own nick changed
+            self.nickname = args[0]
+
+        elif command == 'JOIN' and not self._own_userhost:
+            # our own joins tell us how others see us
+            nick, user, host = protocol.parse_prefix(prefix)
+            if nick and self.is_me(nick):
+                self._own_userhost = '{0}@{1}'.format(user, host)
+
+        elif command in ('PART', 'KICK') and args:
+            # we're off a channel, and needn't go back
+            nick = args[1] if command == 'KICK' and len(args) > 1 else \
+                    protocol.parse_prefix(prefix)[0]
+            if nick and self.is_me(nick):
+                for channel in args[0].split(','):
+                    self._forget_channel(channel)
+
+        elif command in self._join_errors and len(args) > 1:
+            # let join() try again later, or not at all
+            self._join_sent.discard(self.casefold(args[1]))
+            if command in self._join_fatal:
+                self._forget_channel(args[1])
+
+        elif command == '005' and len(args) > 2:
+            self.isupport.update(args[1:-1])
+            self._apply_isupport()
+
+        elif command == '396' and len(args) > 1:
+            # our displayed host changed, sometimes given as user@host
+            if '@' in args[1]:
+                self._own_userhost = args[1]
+            elif self._own_userhost:
+                self._own_userhost = self._own_userhost.split('@')[0] + '@' + args[1]
+
+        # keep the channel state up to date
+        if self.state and command in self.state.commands:
+            self.state.update(command, prefix, args)
+
+        # collect replies to queries
+        if command in self.queries.commands and len(self.queries):
+            self.queries.update(command, args)
+        elif command in self.queries.stale:
+            self.queries.forget(command, prefix, args)
+
+        # messages in a batch we're collecting are handled all at once
+        if self._batches and 'batch' in tags:
+            batch = self._batches.get(tags['batch'])
+            if batch is not None:
+                name = self._handlers.get(command, (command.lower(),))[0]
+                batch.events.append(events.Event(prefix, name, args, tags,
+                                                 self.network, raw, self.casefold))
+                return
 
         # handle privmsg/notice special to split out the CTCP stuff
-        if command in ('privmsg', 'notice'):
-            self._on_message(prefix, command, args, tags)
+        if command in ('PRIVMSG', 'NOTICE'):
+            self._on_message(prefix, command, args, tags, raw)
 
         # handle server pings internally
-        elif command == 'ping':
+        elif command == 'PING':
             self.pong(args[0])
 
+        elif command == 'CAP':
+            self.cap.update(args)
+
+        elif command == 'BATCH':
+            self._on_batch(prefix, args, tags, raw)
+
         # otherwise, find a handler, and call it
         else:
+            entry = self._handlers.get(command)
+            if entry:
+                name, handler = entry
+                event = events.Event(prefix, name, args, tags,
+                                     self.network, raw, self.casefold)
+                self._dispatch(handler, event)
+
+
+    def _on_batch(self, prefix, args, tags, raw=None):
+        """Start or finish collecting a batch, if it's a type on_batch
+        wants to see in one go"""
+        if not args or 'BATCH' not in self._handlers:
+            return
+
+        ref = args[0]
+        if ref.startswith('+'):
+            if len(args) > 1 and args[1] in self.aggregate_batches:
+                self._batches[ref[1:]] = events.BatchEvent(
+                        prefix, 'batch', args, tags, self.network, raw, self.casefold)
+
+        elif ref.startswith('-'):
+            event = self._batches.pop(ref[1:], None)
+            if event is not None:
+                self._dispatch(self._handlers['BATCH'][1], event)
+
+
+    def _apply_isupport(self):
+        """Make use of what the server told us it supports"""
+        isupport = self.isupport
+
+        # nick and channel names are compared casefolded with this, see
+        # protocol.CaseFolder
+        if self.casefold.mapping != isupport.casemapping:
+            self.casefold = protocol.CaseFolder(isupport.casemapping)
+
+            # and whatever was folded the old way needs folding again
+            keys = {old: self.casefold(name) for old, (name, _) in self.joined.items()}
+            self.joined = {keys[old]: joined for old, joined in self.joined.items()}
+            self._join_sent = {keys.get(old, self.casefold(old)) for old in self._join_sent}
+            self.queries.refold()
+            if self.state:
+                self.state.refold()
+
+        # command -> how many targets it can be sent to at once
+        self.targmax = isupport.targmax
+
+        for kind in ('WHOIS', 'WHO', 'NAMES', 'LIST'):
+            self.queries.max_targets[kind] = isupport.targmax.get(kind, 1)
+
+        if self.state:
+            a, b, c, d = isupport.chanmodes
+            self.state.set_prefixes(isupport.prefix)
+            self.state.param_modes   = a + b + c
+            self.state.unparam_modes = a + b
+
+
+    def is_me(self, nick):
+        """Is this nick ours?"""
+        return self.casefold(nick) == self.casefold(self.nickname)
+
+
+    def _dispatch(self, handler, event, respond=True):
+        """Have a handler called with an event, soon.  Coroutine handlers
+        are run as tasks, see tasks.HandlerRunner."""
+        if handler in self._async_handlers:
+            self.handlers.submit(handler, event, respond)
+        elif self.metrics is not None:
+            self.loop.call_soon(self._timed_handler, handler, event, respond,
+                                time.perf_counter())
+        elif respond:
+            self.loop.call_soon(self._call_handler, handler, event)
+        else:
+            self.loop.call_soon(handler, self, event)
 
-            response = None
-            handler = getattr(self, 'on_%s' % command, None)
-            if handler:
-                event = events.Event(prefix, command, args, tags)
 
-                def delegate(event):
-                    response = handler(event)
-                    if response:
-                        self._send(response)
+    def _timed_handler(self, handler, event, respond, queued):
+        """Run a handler, recording how long it took since it was queued"""
+        try:
+            if respond:
+                self._call_handler(handler, event)
+            else:
+                handler(self, event)
+        finally:
+            self.metrics.handler_latency.observe(time.perf_counter() - queued)
 
-                self.loop.call_soon(delegate, event)
 
-#            else:
-#                log.debug('<- p: {0} c:{1} a: {2}'.format(prefix, command, args))
+    def _call_handler(self, handler, event):
+        """Run a handler, and send its response if it has one"""
+        response = handler(self, event)
+        if response:
+            self._send(response)
 
 
-    def _send(self, msg):
+    @classmethod
+    def _build_handlers(cls):
+        """Build the command -> handler dispatch tables for this class.
+
+        Handlers are looked up once per class, so they must be defined
+        on the class rather than assigned to an instance.
+        """
+        handlers = {}
+        ctcp_handlers = {}
+        async_handlers = set()
+        routed = []
+
+        for attr in dir(cls):
+            handler = getattr(cls, attr, None)
+
+            # bot commands and triggers, see routes.py
+            if callable(handler) and '_routes' in getattr(handler, '__dict__', ()):
+                routed.extend(handler._routes)
+                if inspect.iscoroutinefunction(handler):
+                    async_handlers.add(handler)
+                continue
+
+            if not attr.startswith('on_') or attr in cls._hooks:
+                continue
+
+            if not callable(handler):
+                continue
+
+            if inspect.iscoroutinefunction(handler):
+                async_handlers.add(handler)
+
+            name = attr[3:]
+            if name.startswith('ctcp_'):
+                ctcp_handlers[name[5:].upper()] = handler
+            else:
+                handlers[name.upper()] = (name, handler)
+
+        # numerics are delivered under their names
+        for code, name in events.numeric.items():
+            entry = handlers.get(name.upper())
+            if entry:
+                handlers[code] = entry
+
+        cls._handlers = handlers
+        cls._ctcp_handlers = ctcp_handlers
+        cls._async_handlers = frozenset(async_handlers)
+        cls._routes = routes.RouteTable(routed) if routed else None
+
+
+    def _send(self, msg, priority=flood.PRIORITY_NORMAL):
         """Raw message send"""
 
+        # Add message to the send queue, it'll be written out as soon
+        # as flood control allows.
+        self.send_queue.push(self._encode(msg), priority)
+
+
+    def _encode(self, msg):
+        """Check and encode an outgoing message"""
+
         if '\n' in msg:
             raise InvalidCharacters()
 
@@ -181,24 +732,76 @@ class IRCClient:
         if not self.connected or not self.transport:
             raise NotConnected()
 
-        log.debug("-> {0}".format(msg))
+        log.debug('-> %s', msg)
 
         # encode into bytes
         msg = msg.encode() + b'\r\n'
 
-        # truncate if too long, but make sure we keep
-        # the CRLF at the end
-        if len(msg) > 512:
+        # truncate if too long, but make sure we keep the CRLF at the
+        # end, and don't leave half a character
+        if len(msg) > protocol.MAX_LINE_LENGTH:
             log.debug("Message too long, truncating")
-            msg = msg[0:510] + b'\r\n'
+            msg = msg[0:510].decode('UTF-8', 'ignore').encode() + b'\r\n'
 
-        # Add message to the write queue.  This won't necessarily write
-        # right away, so it won't throw an exception
-        self.transport.write(msg)
+        return msg
+
+
+    def _write(self, data):
+        """Write queued messages to the transport"""
+        if self.connected:
+            self.transport.write(data)
+            if self.metrics is not None:
+                self.metrics.written(data)
+            if not len(self.send_queue):
+                self._wake_drain_waiters()
+
+
+    def flush(self):
+        """Write out what's been sent so far now, rather than at the end
+        of this loop iteration, for replies which shouldn't wait"""
+        if self.connected:
+            self.send_queue.flush()
+
+
+    async def send(self, msg, priority=flood.PRIORITY_NORMAL):
+        """Send a raw message, waiting for room in the send queue first,
+        and then until it's been written"""
+        msg = self._encode(msg)
+        await self.send_queue.wait_for_space(len(msg))
+        if not self.connected:
+            raise NotConnected()
+
+        self.send_queue.push(msg, priority)
+        await self.drain()
+
+
+    async def drain(self):
+        """Wait until the send queue is empty and the transport isn't
+        paused, i.e. its buffer is below the low water mark"""
+        while len(self.send_queue) or self.send_queue.paused:
+            if not self.connected:
+                raise NotConnected()
+
+            waiter = self.loop.create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+
+        if not self.connected:
+            raise NotConnected()
+
+
+    def _wake_drain_waiters(self):
+        if self.send_queue.paused and self.connected:
+            return
+
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
 
 
     ### Special IRC Handlers ###
-    def _on_message(self, prefix, command, args, tags):
+    def _on_message(self, prefix, command, args, tags, raw=None):
         """Handle messages by stripping out the CTCP stuff first
             msg: ['#test', 'yo']
             action: ['#test', '\x01ACTION yawns\x01']
@@ -206,21 +809,23 @@ class IRCClient:
 
         # ahh, CTCP here, we'll strip it
         if '\x01' in args[1]:
-            self._on_ctcp(prefix, command, args, tags)
+            self._on_ctcp(prefix, command, args, tags, raw)
 
         # normal messages
         else:
-            handler = getattr(self, 'on_%s' % command.lower(), None)
-            if handler:
-                event = events.MessageEvent(prefix, command, args, tags)
-
-                def delegate(event):
-                    handler(event)
-
-                self.loop.call_soon(delegate, event)
-
-
-    def _on_ctcp(self, prefix, command, args, tags):
+            entry = self._handlers.get(command)
+            routed = self.router is not None and command == 'PRIVMSG'
+            if entry or routed:
+                name = entry[0] if entry else command.lower()
+                event = events.MessageEvent(prefix, name, args, tags,
+                                            self.network, raw, self.casefold)
+                if entry:
+                    self._dispatch(entry[1], event, respond=False)
+                if routed:
+                    self.router.route(event)
+
+
+    def _on_ctcp(self, prefix, command, args, tags, raw=None):
         """Handle common CTCP messages"""
 
         # strip out the CTCP stuff
@@ -232,14 +837,11 @@ class IRCClient:
             command = line
             args[1] = ''
 
-        handler = getattr(self, 'on_ctcp_%s' % command.lower(), None)
+        handler = self._ctcp_handlers.get(command.upper())
         if handler:
-            event = events.CTCPEvent(prefix, command, args, tags)
-
-            def delegate(event):
-                handler(event)
-
-            self.loop.call_soon(delegate, event)
+            event = events.CTCPEvent(prefix, command, args, tags,
+                                     self.network, raw, self.casefold)
+            self._dispatch(handler, event, respond=False)
 
 
 
@@ -252,9 +854,10 @@ class IRCClient:
 
 
     # you probably will overload these
-    def on_ctcp_action(self, prefix, args):     pass
+    def on_ctcp_action(self, event):            pass
     def on_connect(self, *args):                pass
     def on_disconnect(self):                    pass
+    def on_reconnecting(self, attempt, delay):  pass
     def on_error(self, event):                  pass
     def on_notice(self, event):                 pass
     def on_privmsg(self, event):                pass
@@ -263,18 +866,21 @@ class IRCClient:
 
     ### IRC Actions ###
     def action(self, target, action):
-        self.ctcp('ACTION', target, action)
+        self.ctcp(target, 'ACTION', action)
 
     def admin(self, server=''):
         self._send(' '.join(['ADMIN', server]).strip())
 
+    # CTCP messages can't be split up, so they skip privmsg() and notice()
     def ctcp(self, target, ctcptype, param=''):
         ctcptype = ctcptype.upper()
-        self.privmsg(target, '\001{0}{1}\001'.format(ctcptype, param and (' ' + param) or ''))
+        self._send('PRIVMSG {0} :\001{1}{2}\001'.format(
+                target, ctcptype, param and (' ' + param) or ''), flood.PRIORITY_LOW)
 
     def ctcp_reply(self, target, ctcptype, param=''):
         ctcptype = ctcptype.upper()
-        self.notice(target, '\001{0}{1}\001'.format(ctcptype, param and (' ' + param) or ''))
+        self._send('NOTICE {0} :\001{1}{2}\001'.format(
+                target, ctcptype, param and (' ' + param) or ''), flood.PRIORITY_LOW)
 
     def info(self, server=''):
         self._send(' '.join(['INFO', server]).strip())
@@ -282,35 +888,100 @@ class IRCClient:
     def invite(self, nick, channel):
         self._send(' '.join(['INVITE', nick, channel]).strip())
 
-    def join(self, channel, key=''):
-        self._send('JOIN {0}{1}'.format(channel, (key and (' ' + key))))
+    def join(self, channels, keys=''):
+        """Join a channel, or a list of them, with keys if needed.
+
+        For a list of channels, keys is a list or a comma-separated
+        string, in the same order.
+
+        Channels are remembered, with their keys, to rejoin them after
+        reconnecting.  Channels a JOIN's already been sent for since
+        connecting are skipped.
+        """
+        if isinstance(channels, str):
+            channels, keys = [channels], [keys]
+        else:
+            channels = list(channels)
+            if isinstance(keys, str):
+                keys = keys.split(',') if keys else []
+        keys = list(keys or []) + [''] * len(channels)
+
+        pairs = []
+        for channel, key in zip(channels, keys):
+            folded = self.casefold(channel)
+            key = key or self.joined.get(folded, ('', ''))[1]
+            self.joined[folded] = (channel, key)
+            if folded not in self._join_sent:
+                self._join_sent.add(folded)
+                pairs.append((channel, key))
+
+        # channels with keys have to come first
+        pairs.sort(key=lambda pair: not pair[1])
+
+        size = lambda pair: len(pair[0].encode()) + (len(pair[1].encode()) + 1 if pair[1] else 0)
+        for group in self._pack('JOIN', pairs, size=size):
+            channels, keys = zip(*group)
+            keys = ','.join(key for key in keys if key)
+            self._send('JOIN {0}{1}'.format(','.join(channels), keys and (' ' + keys)))
 
     def kick(self, channel, nick, comment=''):
         self._send('KICK {0} {1}{2}'.format(channel, nick, (comment and (' :'+comment))))
 
     def mode(self, target, cmd):
-        self._send('MODE {0} {1}'.format(target, cmd))
+        """Set modes.  cmd is a mode string, sent as it is, or a list of
+        (mode, param) pairs such as ('+o', 'nick'), which are sent with as
+        many to a line as the server allows."""
+        if isinstance(cmd, str):
+            self._send('MODE {0} {1}'.format(target, cmd))
+            return
+
+        limit = self.isupport.modes
+        room = protocol.MAX_LINE_LENGTH - 2 - len('MODE {0} '.format(target).encode())
+        modes, params, size, sign = '', [], 0, None
+        for change, param in cmd:
+            cost = len(change) + (len(param.encode()) + 1 if param else 0)
+            if modes and ((param and len(params) == limit) or size + cost > room):
+                self._send(' '.join(['MODE', target, modes] + params))
+                modes, params, size, sign = '', [], 0, None
+
+            if change[0] != sign:
+                sign = change[0]
+                modes += sign
+            modes += change[1:]
+            if param:
+                params.append(param)
+            size += cost
+
+        if modes:
+            self._send(' '.join(['MODE', target, modes] + params))
 
     def names(self, channels=None):
-        self._send('NAMES' + (channels and (' ' + ','.join(channels))))
+        if not channels:
+            self._send('NAMES')
+            return
+        self._send_list('NAMES', channels)
 
     def nick(self, newnick):
         """Set nickname"""
         self._send('NICK ' + newnick)
 
     def notice(self, target, text):
-        # TODO: limit text length
-        self._send('NOTICE {0} :{1}'.format(target, text))
+        self._message('NOTICE', target, text)
 
     def oper(self, nick, password):
         self._send('OPER {0} {1}'.format(nick, password))
 
     def part(self, channels, message=''):
-        cmd = ['PART', ','.join(channels)]
-        if message:
-            cmd.append(message)
+        if isinstance(channels, str):
+            channels = [channels]
+        for channel in channels:
+            self._forget_channel(channel)
+        self._send_list('PART', channels, message and (' :' + message))
 
-        self._send(' '.join(cmd))
+    def _forget_channel(self, channel):
+        folded = self.casefold(channel)
+        self.joined.pop(folded, None)
+        self._join_sent.discard(folded)
 
     def passwd(self, password):
         self._send('PASS ' + password)
@@ -319,14 +990,16 @@ class IRCClient:
         self._send('PING {0}{1}'.format(target, target2 and (' ' + target2)))
 
     def pong(self, target, target2=''):
-        self._send('PONG {0}{1}'.format(target, target2 and (' ' + target2)))
+        self._send('PONG {0}{1}'.format(target, target2 and (' ' + target2)), flood.PRIORITY_HIGH)
+        self.flush()
 
     def privmsg(self, target, text):
-        self._send('PRIVMSG {0} :{1}'.format(target, text))
+        self._message('PRIVMSG', target, text)
 
     def quit(self, message=''):
         self.reconnect = False
-        self._send('QUIT' + (message and (' :' + message)))
+        self.cancel_reconnect()
+        self._send('QUIT' + (message and (' :' + message)), flood.PRIORITY_HIGH)
 
     def time(self, server=''):
         self._send('TIME' + (server and (' ' + server)))
@@ -350,30 +1023,121 @@ class IRCClient:
         self._send('WHO{0}{1}'.format(target and (' ' + target), op and (' o')))
 
     def whois(self, targets):
-        self._send('WHOIS ' + ','.join(targets))
+        self._send_list('WHOIS', targets)
+
+
+    def _send_list(self, command, targets, suffix=''):
+        """Send a command to a list of targets, with as many to a line as
+        the server allows"""
+        if isinstance(targets, str):
+            targets = [targets]
+
+        for group in self._pack(command, targets, len(suffix.encode())):
+            self._send('{0} {1}{2}'.format(command, ','.join(group), suffix))
+
+    def _pack(self, command, items, reserved=0, size=None):
+        """Group items so each group fits in one command, see TARGMAX"""
+        room = protocol.MAX_LINE_LENGTH - 3 - len(command) - reserved
+        return protocol.pack(items, self.targmax.get(command, 1), room, size)
+
+
+    def _message(self, command, targets, text):
+        """Send a PRIVMSG or NOTICE, split over as many lines as it takes.
+
+        Lines are split at spaces where possible, so that they fit once
+        the server has added our prefix.  targets can be a list, which is
+        sent to as many at once as TARGMAX allows.
+        """
+        if isinstance(targets, str):
+            targets = [targets]
+        else:
+            targets = list(targets)
+
+        prefix = self._prefix_length()
+        # only CR and LF end lines, splitlines() would also split on
+        # formatting codes like \x1d, and blank lines can't be sent
+        lines = [line for line in text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+                 if line] or ['']
+
+        # leave room for at least a few words
+        for group in self._pack(command, targets, 100):
+            target = ','.join(group)
+
+            # what we send has all the targets, what the server relays
+            # has one each, and our prefix
+            longest = max(len(t.encode()) for t in group)
+            overhead = max(len(command) + len(target.encode()) + 3,
+                           prefix + len(command) + longest + 5)
+            limit = protocol.MAX_LINE_LENGTH - 2 - overhead
+
+            for line in lines:
+                for chunk in protocol.split_message(line, limit):
+                    self._send('{0} {1} :{2}'.format(command, target, chunk),
+                               flood.PRIORITY_LOW)
+
+    def _prefix_length(self):
+        """Length of our nick!user@host as the server relays it, or the
+        longest it could be until we know"""
+        if self._own_userhost:
+            return len(self.nickname.encode()) + 1 + len(self._own_userhost.encode())
+
+        # the username might get a ~, and the host is unknown
+        return (len(self.nickname.encode()) + len(self.username.encode())
+                + 3 + protocol.MAX_HOST_LENGTH)
+
+
+    ### Queries ###
+    # these wait for the replies, and return them, see queries.py
+    async def whois_async(self, nick):
+        """WHOIS a nick, returns a WhoisReply, or None if there's no such nick"""
+        return await self._query('WHOIS', nick)
+
+    async def who_async(self, target):
+        """WHO a channel or mask, returns a list of WhoReply"""
+        return await self._query('WHO', target)
+
+    async def names_async(self, channel):
+        """NAMES a channel, returns a dict of nick -> prefixes"""
+        return await self._query('NAMES', channel)
+
+    async def list_async(self, channels=None):
+        """LIST some (or all) channels, returns a list of ListEntry"""
+        if isinstance(channels, str):
+            channels = [channels]
+        return await self._query('LIST', ','.join(channels or []))
+
+    async def userhost_async(self, nick):
+        """USERHOST a nick, returns a UserhostReply, or None if there's
+        no such nick"""
+        return await self._query('USERHOST', nick)
+
+    def _query(self, kind, target):
+        if not self.connected:
+            raise NotConnected()
+        return self.queries.query(kind, target)
 
 
     ### Delayed IRC actions ###
-    # NOTE: these do NOT handle timezones, this is all in localtime!
+    # these return a schedule.Job, which can be cancelled.  Times are UTC
+    # timestamps or datetimes, naive datetimes are taken to be in UTC.
+    # Those which come due while we're not connected are sent once we are.
     def privmsg_delayed(self, delay, target, text):
         """Send a PRIVMSG after a delay (in seconds)"""
-        self.loop.call_later(delay, self.privmsg, target, text)
+        return self.scheduler.call_later(delay, 'privmsg', target, text)
 
     def action_delayed(self, delay, target, action):
         """Send a CTCP ACTION after a delay (in seconds)"""
-        self.loop.call_later(delay, self.action, target, action)
+        return self.scheduler.call_later(delay, 'action', target, action)
 
     def privmsg_at(self, at, target, text):
-        """Send a PRIVMSG at a time (int seconds or datetime.datetime)"""
-        if isinstance(at, int):
-            at = datetime.datetime.fromtimestamp(at)
-        delay = at - datetime.datetime.now()
-        self.loop.call_later(delay.total_seconds(), self.privmsg, target, text)
+        """Send a PRIVMSG at a time, e.g. in two minutes:
+
+            now = datetime.datetime.now(datetime.timezone.utc)
+            client.privmsg_at(now + datetime.timedelta(minutes=2), '#chan', 'hi')
+        """
+        return self.scheduler.call_at(at, 'privmsg', target, text)
 
     def action_at(self, at, target, text):
-        """Send a CTCP ACTION at a time (int seconds or datetime.datetime)"""
-        if isinstance(at, int):
-            at = datetime.datetime.fromtimestamp(at)
-        delay = at - datetime.datetime.now()
-        self.loop.call_later(delay.total_seconds(), self.action, target, text)
+        """Send a CTCP ACTION at a time"""
+        return self.scheduler.call_at(at, 'action', target, text)
 
@@ -1,9 +1,11 @@
 """IRC Events and numeric->name conversions"""
 
 __author__    = 'Michael Stella <asyncirc@thismetalsky.org>'
-__version__   = 'tulip-0.1'
+__version__   = 'asyncio-0.2'
 __copyright__ = 'Copyright 2013 Michael Stella'
 
+import datetime
+
 from . import protocol
 
 numeric = {
@@ -171,46 +173,185 @@ numeric = {
 }
 
 
+# for events made without a client's
+_casefold = protocol.CaseFolder()
+
+
 class Event:
-    """Standard IRC Event"""
+    """Standard IRC Event
+
+    The source, user and host are only split out of the prefix when
+    they're first used, and the args are a tuple.  raw is the undecoded
+    line, if the client was asked to keep it.
+    """
+
+    __slots__ = ('prefix', 'command', 'args', 'tags', 'network', 'target',
+                 'raw', 'casefold', '_prefix_parts', '_source_key', '_target_key')
+
+    # only MessageEvents have one
+    message = ''
 
-    def __init__(self, prefix, command, args=[], tags={}):
+    def __init__(self, prefix, command, args=(), tags=None, network=None, raw=None,
+                 casefold=None):
         self.prefix     = prefix
         self.command    = command
-        self.args       = args
-        self.tags       = tags
-        self.message    = ''
+        self.tags       = {} if tags is None else tags
+        self.network    = network
         self.target     = ''
+        self.raw        = raw
+        self.casefold   = casefold or _casefold
 
-        # split up prefix
-        self.source, self.user, self.host = protocol.parse_prefix(prefix)
-        if not self.source:
-            self.source = prefix
-
-        if len(args) > 0:
-            if command not in protocol.commands_without_target:
-                self.target = args.pop(0)
-            else:
-                self.target = ''
+        self._prefix_parts = None
+        self._source_key   = None
+        self._target_key   = None
 
+        if args and command not in protocol.commands_without_target:
+            self.target = args[0]
+            self.args   = tuple(args[1:])
         else:
-            self.target = ''
+            self.args   = tuple(args)
+
+    def _split_prefix(self):
+        """Split up the prefix, once"""
+        parts = self._prefix_parts
+        if parts is None:
+            source, user, host = protocol.parse_prefix(self.prefix)
+            parts = self._prefix_parts = (source or self.prefix, user, host)
+        return parts
+
+    @property
+    def source(self):
+        return self._split_prefix()[0]
+
+    @property
+    def user(self):
+        return self._split_prefix()[1]
+
+    @property
+    def host(self):
+        return self._split_prefix()[2]
 
     @property
     def hostmask(self):
-        return '@'.join((self.user, self.host))
+        return '@'.join(self._split_prefix()[1:])
+
+    # the source and target casefolded with the network's case mapping,
+    # for comparing, e.g. event.target_key == client.casefold('#chan')
+    @property
+    def source_key(self):
+        key = self._source_key
+        if key is None:
+            key = self._source_key = self.casefold(self.source or '')
+        return key
+
+    @property
+    def target_key(self):
+        key = self._target_key
+        if key is None:
+            key = self._target_key = self.casefold(self.target)
+        return key
+
+    @property
+    def time(self):
+        """When the server says this happened (IRCv3 server-time), as a UTC
+        datetime, or None if it didn't say"""
+        value = self.tags.get('time') if 'time' in self.tags else None
+        if not value:
+            return None
+        try:
+            time = datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ')
+        except ValueError:
+            return None
+        return time.replace(tzinfo=datetime.timezone.utc)
 
 
 class MessageEvent(Event):
-    """Message Event is a standard event with a message"""
+    """Message Event is a standard event with a message.  For messages
+    routed to a bot command or trigger, match is what matched, see
+    routes.py."""
 
-    def __init__(self, prefix, command, args=[], tags={}):
-        super().__init__(prefix, command, args, tags)
+    __slots__ = ('message', 'match')
+
+    def __init__(self, prefix, command, args=(), tags=None, network=None, raw=None,
+                 casefold=None):
+        super().__init__(prefix, command, args, tags, network, raw, casefold)
 
         self.message = args[-1].strip()
+        self.match   = None
+
+
+class RawEvent(Event):
+    """An event for a client keeping raw lines, whose line is only
+    decoded and parsed when something other than raw is first used.
+    Handlers which only look at event.raw never pay for decoding."""
+
+    __slots__ = ('_encodings', '_parsed')
+
+    def __init__(self, raw, command, network=None, casefold=None, encodings=('UTF-8',)):
+        self.command    = command
+        self.network    = network
+        self.raw        = raw
+        self.casefold   = casefold or _casefold
+
+        self._encodings = encodings
+        self._parsed    = None
+
+        self._prefix_parts = None
+        self._source_key   = None
+        self._target_key   = None
+
+    def _parse(self):
+        """Decode and split up the line, once, as (tags, prefix, target, args)"""
+        parsed = self._parsed
+        if parsed is None:
+            try:
+                tags, prefix, _, args = protocol.parse(self.raw.decode(self._encodings[0]))
+            except UnicodeDecodeError:
+                tags, prefix, _, args = protocol.parse_bytes(self.raw, self._encodings)
+
+            if args and self.command not in protocol.commands_without_target:
+                parsed = (tags, prefix, args[0], tuple(args[1:]))
+            else:
+                parsed = (tags, prefix, '', tuple(args))
+            self._parsed = parsed
+        return parsed
+
+    @property
+    def tags(self):
+        return self._parse()[0]
+
+    @property
+    def prefix(self):
+        return self._parse()[1]
+
+    @property
+    def target(self):
+        return self._parse()[2]
+
+    @property
+    def args(self):
+        return self._parse()[3]
 
 
 class CTCPEvent(Event):
     """CTCP-specific event"""
-    pass
 
+    __slots__ = ()
+
+
+class BatchEvent(Event):
+    """An IRCv3 BATCH, delivered once it's complete.  type is the batch
+    type, e.g. 'netsplit', params are its parameters, and events the
+    messages in it."""
+
+    __slots__ = ('ref', 'type', 'params', 'events')
+
+    def __init__(self, prefix, command, args=(), tags=None, network=None, raw=None,
+                 casefold=None):
+        super().__init__(prefix, command, args, tags, network, raw, casefold)
+
+        # +ref type params...
+        self.ref    = args[0][1:]
+        self.type   = args[1] if len(args) > 1 else ''
+        self.params = tuple(args[2:])
+        self.events = []
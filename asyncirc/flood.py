@@ -0,0 +1,237 @@
+"""Outbound flood control: a token bucket, and a prioritized send queue"""
+
+__all__ = ['TokenBucket', 'SendQueue', 'QueueFull',
+           'PRIORITY_HIGH', 'PRIORITY_NORMAL', 'PRIORITY_LOW',
+           'DROP_OLDEST', 'DROP_NEWEST', 'BLOCK']
+
+import collections, itertools, time
+
+class QueueFull(Exception): pass
+
+# send queue lanes, highest priority first
+PRIORITY_HIGH   = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW    = 2
+
+# what to do when the send queue is full
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+BLOCK       = 'block'
+
+
+class TokenBucket:
+    """Token bucket rate limiter.
+
+    Holds up to `burst` tokens, which are refilled at `rate` tokens per
+    second.
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate  = rate
+        self.burst = burst
+        self.clock = clock
+
+        self._tokens = burst
+        self._stamp  = clock()
+
+    @property
+    def tokens(self):
+        self._refill()
+        return self._tokens
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def consume(self, count=1):
+        """Take tokens from the bucket, returns False if there aren't enough"""
+        self._refill()
+        if self._tokens < count:
+            return False
+
+        self._tokens -= count
+        return True
+
+    def delay(self, count=1):
+        """Seconds until `count` tokens will be available"""
+        self._refill()
+        return max(0.0, (count - self._tokens) / self.rate)
+
+    def reset(self):
+        """Fill the bucket back up"""
+        self._tokens = self.burst
+        self._stamp  = self.clock()
+
+
+class SendQueue:
+    """Outbound message queue with priority lanes.
+
+    Messages go out in the order they were sent, as fast as the token
+    bucket allows.  Priority only matters once the bucket is holding
+    messages back: the tokens there are go to the higher lanes first, so
+    e.g. a PONG can jump a backlog of PRIVMSGs.  Everything drained in
+    one go is handed to `write` as a single chunk of bytes.  With no rate, the queue only coalesces the
+    messages sent during one loop iteration, or until `flush_bytes` are
+    waiting, and flush() writes them out straight away.  Nothing is
+    written while the queue is paused.
+
+    If max_bytes is set, the normal and low priority lanes together hold
+    at most that much, and the overflow policy decides what happens to
+    more: DROP_OLDEST throws away the oldest, lowest priority messages to
+    make room, DROP_NEWEST throws away the new one, and BLOCK raises
+    QueueFull, so producers should wait_for_space() first.  The high
+    priority lane is never limited.
+    """
+
+    def __init__(self, loop, write, rate=None, burst=1,
+                 max_bytes=None, overflow=DROP_OLDEST, flush_bytes=None):
+        if overflow not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError("unknown overflow policy {0}".format(overflow))
+
+        self.loop  = loop
+        self.write = write
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.max_bytes = max_bytes
+        self.overflow  = overflow
+        self.flush_bytes = flush_bytes
+        self.paused = False
+
+        # stats
+        self.bytes_queued  = 0
+        self.bytes_written = 0
+        self.dropped       = 0
+
+        # (sequence number, message) per lane, the numbers keep the
+        # order messages were sent in across lanes
+        self._lanes  = (collections.deque(), collections.deque(), collections.deque())
+        self._seq    = itertools.count()
+        self._limited = 0
+        self._handle = None
+        self._space_waiters = []
+
+    def __len__(self):
+        return sum(len(lane) for lane in self._lanes)
+
+    def has_space(self, size):
+        """Would a message of this size fit without overflowing?"""
+        return not self.max_bytes or self._limited + size <= self.max_bytes
+
+    async def wait_for_space(self, size):
+        """Wait until a message of this size fits in the queue"""
+        while not self.has_space(size) and self._limited:
+            waiter = self.loop.create_future()
+            self._space_waiters.append(waiter)
+            await waiter
+
+    def push(self, msg, priority=PRIORITY_NORMAL):
+        """Queue up an encoded message, returns False if it was dropped"""
+        size = len(msg)
+        if priority != PRIORITY_HIGH:
+            if not self.has_space(size):
+                if self.overflow == BLOCK:
+                    raise QueueFull()
+                if self.overflow == DROP_NEWEST or not self._make_space(size):
+                    self.dropped += 1
+                    return False
+            self._limited += size
+
+        self._lanes[priority].append((next(self._seq), msg))
+        self.bytes_queued += size
+
+        # without flood control, don't let a big burst pile up
+        if self.flush_bytes and self.bytes_queued >= self.flush_bytes and not self.bucket:
+            self.flush()
+        else:
+            self._schedule()
+        return True
+
+    def flush(self):
+        """Write out what's queued now, as far as the rate allows,
+        rather than at the end of this loop iteration"""
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+        self._drain()
+
+    def _make_space(self, size):
+        """Drop the oldest, least important messages until size fits"""
+        for lane in reversed(self._lanes[1:]):
+            while lane and not self.has_space(size):
+                old = len(lane.popleft()[1])
+                self._limited -= old
+                self.bytes_queued -= old
+                self.dropped += 1
+        return self.has_space(size)
+
+    def drain_time(self):
+        """Seconds until everything currently queued will have been sent"""
+        if not self.bucket:
+            return 0.0
+        return self.bucket.delay(len(self))
+
+    def pause(self):
+        """Stop writing, messages are held in the queue"""
+        self.paused = True
+
+    def resume(self):
+        """Start writing again"""
+        self.paused = False
+        self._schedule()
+
+    def clear(self):
+        """Throw away anything queued, and refill the bucket"""
+        for lane in self._lanes:
+            lane.clear()
+        self.bytes_queued = self._limited = 0
+        self.paused = False
+
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+
+        if self.bucket:
+            self.bucket.reset()
+
+        self._wake_space_waiters()
+
+    def _schedule(self):
+        if not self._handle and not self.paused and len(self):
+            self._handle = self.loop.call_soon(self._drain)
+
+    def _wake_space_waiters(self):
+        waiters, self._space_waiters = self._space_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _drain(self):
+        self._handle = None
+        if self.paused:
+            return
+
+        bucket = self.bucket
+        out = []
+        for priority, lane in enumerate(self._lanes):
+            while lane and (not bucket or bucket.consume()):
+                seq, msg = lane.popleft()
+                if priority != PRIORITY_HIGH:
+                    self._limited -= len(msg)
+                out.append((seq, msg))
+
+            # out of tokens
+            if lane:
+                break
+
+        if out:
+            # the lanes decided what goes now, not the order it goes in
+            out.sort(key=lambda item: item[0])
+            data = b''.join(msg for _, msg in out)
+            self.bytes_queued  -= len(data)
+            self.bytes_written += len(data)
+            self._wake_space_waiters()
+            self.write(data)
+
+        # come back when the next message can go out
+        if bucket and len(self) and not self.paused:
+            self._handle = self.loop.call_later(bucket.delay(), self._drain)
@@ -0,0 +1,118 @@
+"""What the server supports, and its limits, from RPL_ISUPPORT (005)"""
+
+__all__ = ['ISupport']
+
+import re
+
+_escape = re.compile(r'\\x([0-9A-Fa-f]{2})')
+
+
+def _unescape(value):
+    """Values can have \\xHH escapes, e.g. for spaces"""
+    if '\\' not in value:
+        return value
+    return _escape.sub(lambda m: chr(int(m.group(1), 16)), value)
+
+
+def _int(value, default=None):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class ISupport:
+    """The parameters a server advertised in its 005 replies.
+
+    params holds all of them, as strings, or True for those without a
+    value.  The ones the client makes use of are parsed into attributes,
+    which have RFC1459 defaults until the server says otherwise:
+
+      casemapping   'rfc1459', 'ascii' or 'strict-rfc1459'
+      chantypes     characters channel names can start with
+      prefix        dict of member mode letter -> nick prefix, highest first
+      chanmodes     the A, B, C and D channel mode letters
+      modes         most modes with parameters in one MODE, None if unlimited
+      targmax       command -> most targets in one command, None if unlimited
+      nicklen, channellen, topiclen   maximum lengths, None if unknown
+
+    >>> isupport = ISupport()
+    >>> isupport.update(['PREFIX=(qov)~@+', 'TARGMAX=NAMES:1,JOIN:,PRIVMSG:4',
+    ...                  'MODES=4', 'NETWORK=Example\\\\x20Net', 'EXCEPTS'])
+    >>> isupport.prefix
+    {'q': '~', 'o': '@', 'v': '+'}
+    >>> isupport.targmax['JOIN'], isupport.targmax['PRIVMSG'], isupport.modes
+    (None, 4, 4)
+    >>> isupport['NETWORK'], isupport['EXCEPTS']
+    ('Example Net', True)
+    """
+
+    # commands which take any number of targets unless TARGMAX says otherwise
+    list_commands = ('JOIN', 'PART')
+
+    def __init__(self):
+        self.clear()
+
+    def __contains__(self, key):
+        return key in self.params
+
+    def __getitem__(self, key):
+        return self.params[key]
+
+    def get(self, key, default=None):
+        return self.params.get(key, default)
+
+    def clear(self):
+        """Forget everything, e.g. when disconnected"""
+        self.params = {}
+        self._parse()
+
+    def update(self, tokens):
+        """Add the parameters from one 005 line, given without our nick
+        and the trailing text"""
+        for token in tokens:
+            if token.startswith('-'):
+                self.params.pop(token[1:].upper(), None)
+                continue
+
+            key, eq, value = token.partition('=')
+            self.params[key.upper()] = _unescape(value) if eq else True
+
+        self._parse()
+
+    def _value(self, key, default):
+        value = self.params.get(key)
+        return value if isinstance(value, str) and value else default
+
+    def _parse(self):
+        self.casemapping = self._value('CASEMAPPING', 'rfc1459').lower()
+        self.chantypes   = self._value('CHANTYPES', '#&')
+
+        # (ov)@+
+        self.prefix = {'o': '@', 'v': '+'}
+        modes, _, prefixes = self._value('PREFIX', '').lstrip('(').partition(')')
+        if modes and len(modes) == len(prefixes):
+            self.prefix = dict(zip(modes, prefixes))
+
+        # A,B,C,D: list modes, modes with a parameter both ways, modes
+        # with a parameter only when set, and modes without one
+        chanmodes = self._value('CHANMODES', 'beI,k,l,imnpst').split(',')
+        self.chanmodes = tuple((chanmodes + ['', '', '', ''])[:4])
+
+        # MODES without a value means no limit
+        modes = self.params.get('MODES', '3')
+        self.modes = None if modes is True else _int(modes, 3)
+
+        self.targmax = {command: None for command in self.list_commands}
+        maxtargets = _int(self._value('MAXTARGETS', None))
+        if maxtargets:
+            self.targmax['PRIVMSG'] = self.targmax['NOTICE'] = maxtargets
+
+        for item in self._value('TARGMAX', '').split(','):
+            command, _, count = item.partition(':')
+            if command:
+                self.targmax[command.upper()] = _int(count)
+
+        self.nicklen    = _int(self._value('NICKLEN', None))
+        self.channellen = _int(self._value('CHANNELLEN', None))
+        self.topiclen   = _int(self._value('TOPICLEN', None))
@@ -0,0 +1,214 @@
+"""Client metrics: counters and histograms, and sinks to send them to"""
+
+__all__ = ['Metrics', 'Histogram', 'StatsdSink']
+
+import bisect, collections, logging, socket
+
+log = logging.getLogger(__name__)
+
+# histogram bucket upper bounds, in seconds
+TIME_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+def _escape(value):
+    """Escape a Prometheus label value"""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """Counts of observations falling into fixed buckets"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts  = [0] * (len(self.buckets) + 1)
+        self.sum     = 0.0
+        self.count   = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum   += value
+        self.count += 1
+
+    def snapshot(self):
+        """Cumulative (upper bound, count) pairs, and the sum and count"""
+        cumulative, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            cumulative.append((bound, total))
+        return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+
+class Metrics:
+    """What a client's been doing: lines and bytes in and out by command,
+    how long parsing and handlers take, the send queue, and reconnects.
+
+    Every `interval` seconds a snapshot() is passed to each of the sinks,
+    which are callables, e.g. a StatsdSink.  prometheus() renders the
+    current values in the Prometheus text format, for serving up however
+    suits.
+    """
+
+    def __init__(self, client, interval=10):
+        self.client   = client
+        self.interval = interval
+        self.sinks    = []
+
+        self.lines_in  = collections.Counter()
+        self.bytes_in  = collections.Counter()
+        self.lines_out = collections.Counter()
+        self.bytes_out = collections.Counter()
+
+        self.parse_time      = Histogram()
+        self.handler_latency = Histogram()
+
+        self.reconnects = 0
+
+        self._handle = None
+
+    def received(self, command, size):
+        self.lines_in[command] += 1
+        self.bytes_in[command] += size
+
+    def sent(self, command, size):
+        self.lines_out[command] += 1
+        self.bytes_out[command] += size
+
+    def written(self, data):
+        """Count the lines in a chunk written to the transport"""
+        for line in data.split(b'\r\n')[:-1]:
+            self.sent(line.split(b' ', 1)[0].decode('ascii', 'replace').upper(), len(line) + 2)
+
+    def snapshot(self):
+        """The current values, as a dict"""
+        queue = self.client.send_queue
+        return {
+            'network':         self.client.network,
+            'lines_in':        dict(self.lines_in),
+            'bytes_in':        dict(self.bytes_in),
+            'lines_out':       dict(self.lines_out),
+            'bytes_out':       dict(self.bytes_out),
+            'parse_time':      self.parse_time.snapshot(),
+            'handler_latency': self.handler_latency.snapshot(),
+            'queue_messages':  len(queue),
+            'queue_bytes':     queue.bytes_queued,
+            'queue_dropped':   queue.dropped,
+            'reconnects':      self.reconnects,
+        }
+
+
+    ### Sinks ###
+
+    def add_sink(self, sink):
+        """Send snapshots to sink(snapshot) every interval seconds"""
+        self.sinks.append(sink)
+        self.start()
+
+    def start(self):
+        if self.sinks and not self._handle and self.client.loop:
+            self._handle = self.client.loop.call_later(self.interval, self._flush)
+
+    def stop(self):
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+
+    def _flush(self):
+        self._handle = None
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            try:
+                sink(snapshot)
+            except Exception:
+                log.exception('*** metrics sink {0} failed'.format(sink))
+        self.start()
+
+    def prometheus(self, prefix='asyncirc'):
+        """The current values in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        network = snapshot['network']
+        out = []
+
+        def labels(**extra):
+            extra['network'] = network
+            return ','.join('{0}="{1}"'.format(k, _escape(str(v)))
+                            for k, v in sorted(extra.items()))
+
+        for name in ('lines_in', 'bytes_in', 'lines_out', 'bytes_out'):
+            out.append('# TYPE {0}_{1}_total counter'.format(prefix, name))
+            for command, value in sorted(snapshot[name].items()):
+                out.append('{0}_{1}_total{{{2}}} {3}'.format(
+                        prefix, name, labels(command=command), value))
+
+        for name in ('parse_time', 'handler_latency'):
+            hist = snapshot[name]
+            out.append('# TYPE {0}_{1}_seconds histogram'.format(prefix, name))
+            for bound, count in hist['buckets']:
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                out.append('{0}_{1}_seconds_bucket{{{2}}} {3}'.format(
+                        prefix, name, labels(le=le), count))
+            out.append('{0}_{1}_seconds_sum{{{2}}} {3}'.format(prefix, name, labels(), hist['sum']))
+            out.append('{0}_{1}_seconds_count{{{2}}} {3}'.format(prefix, name, labels(), hist['count']))
+
+        for name, kind in (('queue_messages', 'gauge'), ('queue_bytes', 'gauge'),
+                           ('queue_dropped', 'counter'), ('reconnects', 'counter')):
+            metric = name + ('_total' if kind == 'counter' else '')
+            out.append('# TYPE {0}_{1} {2}'.format(prefix, metric, kind))
+            out.append('{0}_{1}{{{2}}} {3}'.format(prefix, metric, labels(), snapshot[name]))
+
+        return '\n'.join(out) + '\n'
+
+
+class StatsdSink:
+    """Sends snapshots to a statsd daemon over UDP: counters as the change
+    since the last snapshot, histograms as their count and total time (in
+    ms), and the send queue as gauges."""
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='asyncirc'):
+        self.address = (host, port)
+        self.prefix  = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+        self._last = {}
+
+    def __call__(self, snapshot):
+        prefix = '{0}.{1}'.format(self.prefix, snapshot['network'].replace('.', '_'))
+        lines = []
+
+        def counter(name, value):
+            delta = value - self._last.get(name, 0)
+            self._last[name] = value
+            if delta:
+                lines.append('{0}.{1}:{2}|c'.format(prefix, name, delta))
+
+        for name in ('lines_in', 'bytes_in', 'lines_out', 'bytes_out'):
+            for command, value in snapshot[name].items():
+                counter('{0}.{1}'.format(name, command), value)
+
+        for name in ('parse_time', 'handler_latency'):
+            hist = snapshot[name]
+            counter(name + '.count', hist['count'])
+            counter(name + '.total_ms', int(hist['sum'] * 1000))
+
+        counter('queue_dropped', snapshot['queue_dropped'])
+        counter('reconnects', snapshot['reconnects'])
+        for name in ('queue_messages', 'queue_bytes'):
+            lines.append('{0}.{1}:{2}|g'.format(prefix, name, snapshot[name]))
+
+        # keep the packets under a typical MTU
+        packet = []
+        for line in lines:
+            if packet and sum(len(l) + 1 for l in packet) + len(line) > 1400:
+                self._send(packet)
+                packet = []
+            packet.append(line)
+        if packet:
+            self._send(packet)
+
+    def _send(self, lines):
+        try:
+            self.sock.sendto('\n'.join(lines).encode(), self.address)
+        except OSError as e:
+            log.debug('*** statsd send failed: {0}'.format(e))
@@ -0,0 +1,160 @@
+"""Run many IRC connections on one event loop"""
+
+__all__ = ['IRCPool', 'run_sharded']
+
+import asyncio, logging, multiprocessing
+
+from .client import use_uvloop
+
+log = logging.getLogger(__name__)
+
+
+class IRCPool:
+    """A set of IRCClient connections sharing an event loop.
+
+    Clients are keyed by network name, and the events they dispatch are
+    tagged with it.  At most `max_connecting` connection attempts are in
+    flight at once, including reconnects, so a few hundred clients don't
+    all hit the network at the same moment.
+    """
+
+    def __init__(self, loop=None, max_connecting=10):
+        self.loop = loop
+        self.clients = {}
+
+        self._connecting = asyncio.Semaphore(max_connecting)
+        self._running = set()
+        self._close_handle = None
+        self._done = None
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __iter__(self):
+        return iter(self.clients.values())
+
+    def __getitem__(self, network):
+        return self.clients[network]
+
+    def add(self, client, network=None):
+        """Add a client to the pool, it must not be bound to some other
+        event loop.  Returns the client."""
+        if client.loop and self.loop and client.loop is not self.loop:
+            raise ValueError("client must use the pool's event loop")
+
+        network = network or client.network
+        if network in self.clients:
+            raise ValueError("network {0} already in the pool".format(network))
+
+        client.network = network
+        client.pool = self
+        self.clients[network] = client
+        return client
+
+    def remove(self, network):
+        """Remove a client from the pool, disconnecting it first"""
+        client = self.clients[network]
+        if client.connected:
+            client.quit()
+        client.cancel_reconnect()
+
+        self._running.discard(network)
+        del self.clients[network]
+        client.pool = None
+        return client
+
+    def start(self):
+        """Start connecting all clients that aren't running yet, this must
+        be called from the event loop"""
+        self.loop = asyncio.get_running_loop()
+        for network, client in self.clients.items():
+            if network not in self._running:
+                self._running.add(network)
+                client._bind(self.loop)
+                client._connect()
+
+    async def run(self):
+        """Start all the clients, and wait until they're done"""
+        self.start()
+        self._done = self.loop.create_future()
+        await self._done
+
+    def shutdown(self, message='', timeout=10):
+        """Quit all clients, and stop those still connecting.  run()
+        returns once they've all gone, or after timeout seconds, when the
+        remaining connections are closed."""
+        for client in list(self.clients.values()):
+            client.reconnect = False
+            if client.connected:
+                client.quit(message)
+            elif client.cancel_reconnect():
+                self._client_finished(client)
+
+        if self._running and not self._close_handle:
+            self._close_handle = self.loop.call_later(timeout, self._close_all)
+
+    def _close_all(self):
+        """Forcibly close whatever is still connected"""
+        self._close_handle = None
+        for client in self.clients.values():
+            if client.connected:
+                client.transport.close()
+
+    async def _limit_connect(self, connect):
+        """Wrap a connection attempt so it waits its turn"""
+        async with self._connecting:
+            return await connect
+
+    def _client_finished(self, client):
+        """Called by a client which has disconnected for good"""
+        self._running.discard(client.network)
+        if not self._running:
+            log.info('*** all connections closed')
+            if self._close_handle:
+                self._close_handle.cancel()
+                self._close_handle = None
+            if self._done and not self._done.done():
+                self._done.set_result(None)
+
+
+### Multiple processes ###
+
+def _run_shard(factory, shard, max_connecting, uvloop):
+    """Worker process: run one shard of the networks in its own loop"""
+    if uvloop:
+        use_uvloop()
+
+    pool = IRCPool(max_connecting=max_connecting)
+    for network, spec in shard:
+        pool.add(factory(network, spec), network)
+
+    try:
+        asyncio.run(pool.run())
+    except KeyboardInterrupt:
+        pass
+
+
+def run_sharded(factory, networks, workers=None, max_connecting=10, uvloop=False):
+    """Spread connections over several worker processes, each running its
+    own IRCPool, and wait for them all to finish.
+
+    `networks` maps network names to a spec, and `factory(network, spec)`
+    must return an IRCClient for it.  The factory and specs are sent to
+    the workers, so they must be picklable.  With uvloop set, workers use
+    uvloop if it's installed.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    items = sorted(networks.items())
+    shards = [items[i::workers] for i in range(workers)]
+
+    procs = []
+    for shard in shards:
+        if not shard:
+            continue
+        proc = multiprocessing.Process(target=_run_shard,
+                                       args=(factory, shard, max_connecting, uvloop))
+        proc.start()
+        procs.append(proc)
+
+    for proc in procs:
+        proc.join()
@@ -4,59 +4,318 @@ parse_prefix() added by me.
 
 """
 __author__    = ['Kiyoshi Aman', 'Michael Stella']
-__version__   = 'tulip-0.1'
+__version__   = 'asyncio-0.2'
 __copyright__ = 'Copyright 2013 Michael Stella, Kiyoshi Aman'
 
+from collections.abc import Mapping
+
 commands_without_target = ['quit','ping','squit','error']
 
+# RFC1459 line length, including the CRLF, plus room for IRCv3 message tags
+MAX_LINE_LENGTH = 512
+MAX_TAGS_LENGTH = 8191
+
+# longest hostname a server will show in a prefix
+MAX_HOST_LENGTH = 63
+
+def _split(line, space, colon, at):
+    """Find the tag, prefix, verb and trailing boundaries of a line in a
+    single pass.  Works on both str and bytes, given matching separators.
+
+    Returns (tags, prefix, verb, params, trailing), with trailing set to
+    None if the message has no trailing parameter.
+    """
+    pos = 0
+
+    # handle tags
+    tags = None
+    if line.startswith(at):
+        pos = line.find(space)
+        if pos < 0:
+            return (line[1:], None, line[:0], [], None)
+        tags = line[1:pos]
+        pos = _skip(line, pos + 1, space)
+
+    # handle prefix
+    prefix = None
+    if line.startswith(colon, pos):
+        end = line.find(space, pos)
+        if end < 0:
+            return (tags, line[pos + 1:], line[:0], [], None)
+        prefix = line[pos + 1:end]
+        pos = _skip(line, end + 1, space)
+
+    # handle verb
+    end = line.find(space, pos)
+    if end < 0:
+        return (tags, prefix, line[pos:], [], None)
+    verb = line[pos:end]
+
+    # handle arguments, everything after the first ' :' is the trailing one
+    trailing = line.find(space + colon, end)
+    if trailing < 0:
+        params = line[end + 1:]
+        trailing = None
+    else:
+        params = line[end + 1:trailing]
+        trailing = line[trailing + 2:]
+
+    if not params:
+        return (tags, prefix, verb, [], trailing)
+
+    params = params.split(space)
+    if not all(params):
+        params = [p for p in params if p]
+    return (tags, prefix, verb, params, trailing)
+
+
+def _skip(line, pos, space):
+    """Skip over repeated separators"""
+    while line.startswith(space, pos):
+        pos += 1
+    return pos
+
+
+# IRCv3 tag value escapes
+_tag_escapes = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+def _unescape_tag(value):
+    if '\\' not in value:
+        return value
+
+    out = []
+    chars = iter(value)
+    for char in chars:
+        if char == '\\':
+            # a lone backslash at the end is dropped
+            char = next(chars, '')
+            char = _tag_escapes.get(char, char)
+        out.append(char)
+    return ''.join(out)
+
+
+def parse_tags(tag_str):
+    """Split up an IRCv3 tag string into a dict, unescaping the values
+
+    >>> parse_tags('time=2026-10-18T05:28:00.000Z;+draft/reply=abc;flag')
+    {'time': '2026-10-18T05:28:00.000Z', '+draft/reply': 'abc', 'flag': ''}
+    >>> parse_tags('msg=semi\\\\:colon\\\\sand\\\\\\\\slash;x=end\\\\')
+    {'msg': 'semi;colon and\\\\slash', 'x': 'end'}
+    """
+    tags = {}
+    for tag in tag_str.split(';'):
+        k, _, v = tag.partition('=')
+        if k:
+            tags[k] = _unescape_tag(v)
+    return tags
+
+
+class Tags(Mapping):
+    """Message tags, only parsed when they're first looked at"""
+
+    __slots__ = ('_raw', '_tags')
+
+    def __init__(self, raw):
+        self._raw  = raw
+        self._tags = None
+
+    def _parsed(self):
+        tags = self._tags
+        if tags is None:
+            tags = self._tags = parse_tags(self._raw)
+        return tags
+
+    def __getitem__(self, key):
+        return self._parsed()[key]
+
+    def __iter__(self):
+        return iter(self._parsed())
+
+    def __len__(self):
+        return len(self._parsed())
+
+    def __contains__(self, key):
+        # cheap check before parsing, most lines don't have most tags
+        if key not in self._raw:
+            return False
+        return key in self._parsed()
+
+    def __repr__(self):
+        return repr(self._parsed())
+
+
 def parse(input):
-    """Parse an IRC message.
+    """Parse an IRC message.  The tags are only parsed when they're used,
+    see Tags.
 
     >>> parse('@foo=bar :lol!lol@example.com PRIVMSG #lol :lol')
-    ({'@foo': 'bar'}, ':lol!lol@example.com', 'PRIVMSG', ['#lol', ':lol'])
+    ({'foo': 'bar'}, 'lol!lol@example.com', 'PRIVMSG', ['#lol', 'lol'])
+    >>> parse(':irc.example.com 353 lol = #lol :@lol +foo bar')
+    ({}, 'irc.example.com', '353', ['lol', '=', '#lol', '@lol +foo bar'])
+    >>> parse(':lol!lol@example.com PRIVMSG #lol :spaced  out :text')
+    ({}, 'lol!lol@example.com', 'PRIVMSG', ['#lol', 'spaced  out :text'])
+    >>> parse(':lol!lol@example.com MODE #lol +ov lol foo')
+    ({}, 'lol!lol@example.com', 'MODE', ['#lol', '+ov', 'lol', 'foo'])
+    >>> parse('PING :irc.example.com')
+    ({}, '', 'PING', ['irc.example.com'])
+    >>> parse(':lol!lol@example.com QUIT :')
+    ({}, 'lol!lol@example.com', 'QUIT', [''])
+    >>> parse('AWAY')
+    ({}, '', 'AWAY', [])
     """
     if isinstance(input, bytes):
         input = input.decode('UTF-8', 'replace')
 
-    string = input.split(' ')
+    tags, prefix, verb, args, trailing = _split(input, ' ', ':', '@')
+    if trailing is not None:
+        args.append(trailing)
 
-    # handle tags
-    if string[0].startswith('@'):
-        tag_str = string[0][1:]
-        string = string[1:]
+    return (Tags(tags) if tags else {}, prefix or '', verb, args)
 
-        tag_str = tag_str.split(',')
-        tags = {}
 
-        for tag in tag_str:
-            k, v = tag.split('=', 1)
-            tags[k] = v
-    else:
-        tags = {}
+def split_bytes(input):
+    """Split up a raw IRC message without decoding any of it.
 
-    # handle prefix
-    if string[0].startswith(':'):
-        prefix = string[0][1:]
-        string = string[1:]
-    else:
-        prefix = ''
+    Returns (tags, prefix, verb, args) as bytes, with the tag string left
+    unparsed, and b'' for missing tags or prefix.
 
-    # handle verb and arguments
-    verb = string[0]
-    args = string[1:]
+    >>> split_bytes(b'@a=b :lol!lol@example.com PRIVMSG #lol :caf\\xe9')
+    (b'a=b', b'lol!lol@example.com', b'PRIVMSG', [b'#lol', b'caf\\xe9'])
+    """
+    tags, prefix, verb, args, trailing = _split(input, b' ', b':', b'@')
+    if trailing is not None:
+        args.append(trailing)
 
-    for arg in args:
-        if arg.startswith(':'):
-            idx  = args.index(arg)
-            arg  = ' '.join(args[idx:])
-            arg  = arg[1:]
-            args = args[:idx]
+    return (tags or b'', prefix or b'', verb, args)
 
-            args.append(arg)
 
-            break
+def verb_bytes(input):
+    """Find the command of a raw IRC message, without parsing the rest.
 
-    return (tags, prefix, verb, args)
+    >>> verb_bytes(b'@a=b :lol!lol@example.com PRIVMSG #lol :lol')
+    b'PRIVMSG'
+    """
+    pos = 0
+    if input.startswith(b'@'):
+        pos = _skip(input, input.find(b' ') + 1, b' ')
+        if pos == 0:
+            return b''
+
+    if input.startswith(b':', pos):
+        end = input.find(b' ', pos)
+        if end < 0:
+            return b''
+        pos = _skip(input, end + 1, b' ')
+
+    end = input.find(b' ', pos)
+    return input[pos:end] if end >= 0 else input[pos:]
+
+
+def parse_bytes(input, encodings=('UTF-8',)):
+    """Parse a raw IRC message, as read from the socket.
+
+    The line is split up before anything is decoded, so a bad byte in a
+    message can't shift the boundaries between its parts, and each part
+    is decoded on its own, see decode().  The results are the same as for
+    parse().
+
+    >>> corpus = [
+    ...     '@foo=bar;baz :lol!lol@example.com PRIVMSG #lol :lol',
+    ...     ':lol!lol@example.com PRIVMSG #lol :\x01ACTION yawns\x01',
+    ...     ':irc.example.com 005 lol CHANTYPES=# PREFIX=(ov)@+ :are supported',
+    ...     ':irc.example.com 366 lol #lol :End of /NAMES list.',
+    ...     ':lol!lol@example.com JOIN #lol',
+    ...     ':lol!lol@example.com PRIVMSG #lol :caf\xe9 \u2603',
+    ...     'ERROR :Closing Link: lol (Excess Flood)',
+    ... ]
+    >>> all(parse_bytes(line.encode()) == parse(line) for line in corpus)
+    True
+    >>> parse_bytes(b':lol!lol@example.com PRIVMSG #lol :caf\\xe9', ('UTF-8', 'cp1252'))
+    ({}, 'lol!lol@example.com', 'PRIVMSG', ['#lol', 'caf\xe9'])
+    """
+    tags, prefix, verb, args = split_bytes(input)
+
+    return (Tags(decode(tags, encodings)) if tags else {},
+            decode(prefix, encodings),
+            decode(verb, encodings),
+            [decode(a, encodings) for a in args])
+
+
+def decode(data, encodings=('UTF-8',)):
+    """Decode bytes using the first of the encodings that works, and if
+    none do, the first one with replacement characters
+
+    >>> decode(b'caf\\xc3\\xa9', ('UTF-8', 'cp1252')), decode(b'caf\\xe9', ('UTF-8', 'cp1252'))
+    ('caf\xe9', 'caf\xe9')
+    >>> decode(b'caf\\xe9')
+    'caf\ufffd'
+    """
+    for encoding in encodings:
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+
+    return data.decode(encodings[0], 'replace')
+
+
+# RFC1459 says []\~ are the uppercase versions of {}|^, strict-rfc1459
+# leaves out ~ and ^, see ISUPPORT CASEMAPPING
+_ascii_lower   = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+                               'abcdefghijklmnopqrstuvwxyz')
+_rfc1459_lower = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~',
+                               'abcdefghijklmnopqrstuvwxyz{}|^')
+_strict_lower  = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\',
+                               'abcdefghijklmnopqrstuvwxyz{}|')
+
+casemappings = {
+    'ascii':          _ascii_lower,
+    'rfc1459':        _rfc1459_lower,
+    'strict-rfc1459': _strict_lower,
+}
+
+def casefold(name, mapping='rfc1459'):
+    """Lowercase a nick or channel name, using a server's case mapping,
+    unknown ones are taken to be RFC1459
+
+    >>> casefold('Nick[away]') == casefold('nick{AWAY}')
+    True
+    >>> casefold('Nick[away]~', 'ascii'), casefold('Nick[away]~', 'strict-rfc1459')
+    ('nick[away]~', 'nick{away}~')
+    """
+    return name.translate(casemappings.get(mapping, _rfc1459_lower))
+
+
+class CaseFolder:
+    """Casefolds names with one case mapping, remembering the results, so
+    a name's folded again without any work, and all the spellings of a
+    name share one key string.  Once max_size names are remembered, it
+    starts again.
+
+    >>> fold = CaseFolder('rfc1459')
+    >>> fold('Nick[away]') is fold('nick{AWAY}')
+    True
+    """
+
+    __slots__ = ('mapping', 'max_size', '_table', '_keys')
+
+    def __init__(self, mapping='rfc1459', max_size=100000):
+        self.mapping  = mapping
+        self.max_size = max_size
+
+        self._table = casemappings.get(mapping, _rfc1459_lower)
+        self._keys  = {}
+
+    def __call__(self, name):
+        keys = self._keys
+        key = keys.get(name)
+        if key is None:
+            if len(keys) >= self.max_size:
+                keys.clear()
+            key = name.translate(self._table)
+            # folded names fold to themselves, so they share the dict
+            key = keys[name] = keys.setdefault(key, key)
+        return key
 
 
 def parse_prefix(prefix):
@@ -76,3 +335,64 @@ def create_prefix(nick, user, host):
     """Create a prefix from nick, user, host"""
     return '{0}!{1}@{2}'.format(nick, user, host)
 
+
+def split_message(text, limit):
+    """Split text into chunks of at most limit bytes of UTF-8, breaking
+    at spaces where possible, and never inside a character.
+
+    >>> split_message('the quick brown fox', 10)
+    ['the quick', 'brown fox']
+    >>> split_message('abcdefghij', 4)
+    ['abcd', 'efgh', 'ij']
+    >>> split_message('caf\xe9 na\xefve', 4)
+    ['caf', '\xe9', 'na\xef', 've']
+    """
+    data = text.encode()
+    if len(data) <= limit:
+        return [text]
+
+    chunks = []
+    pos = 0
+    while len(data) - pos > limit:
+        end = pos + limit
+        space = data.rfind(b' ', pos, end + 1)
+        if space > pos:
+            chunks.append(data[pos:space])
+            pos = space + 1
+            continue
+
+        # no space to break at, back up to the start of a character
+        while end > pos and (data[end] & 0xC0) == 0x80:
+            end -= 1
+        if end == pos:
+            end = pos + limit
+        chunks.append(data[pos:end])
+        pos = end
+
+    if pos < len(data):
+        chunks.append(data[pos:])
+    return [chunk.decode('UTF-8', 'replace') for chunk in chunks]
+
+
+def pack(items, count, room, size=None):
+    """Group items for commands which take a comma separated list, with
+    at most count (None for any number) in a group, and each group's
+    items taking at most room bytes with their separators.
+
+    >>> list(pack(['#a', '#b', '#c'], 2, 100))
+    [['#a', '#b'], ['#c']]
+    >>> list(pack(['#aaa', '#bbb', '#ccc'], None, 10))
+    [['#aaa', '#bbb'], ['#ccc']]
+    """
+    group, used = [], 0
+    for item in items:
+        cost = (size(item) if size else len(item.encode())) + 1
+        if group and (len(group) == count or used + cost > room):
+            yield group
+            group, used = [], 0
+
+        group.append(item)
+        used += cost
+
+    if group:
+        yield group
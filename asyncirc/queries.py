@@ -0,0 +1,509 @@
+"""Awaitable WHOIS, WHO, NAMES, LIST and USERHOST queries.
+
+A query sends its command, collects the numeric replies up to the END
+numeric, and resolves with a structured result.  Identical queries in
+flight share one command and result, and queries made in the same loop
+iteration are packed into as few commands as the server allows.
+
+WHOIS and USERHOST results can be cached for a while, so repeated checks
+on the same nick don't go to the server every time.
+"""
+
+__all__ = ['QueryManager', 'ReplyCache',
+           'WhoisReply', 'WhoReply', 'ListEntry', 'UserhostReply']
+
+import asyncio, collections, time
+
+from . import protocol
+
+
+class WhoisReply:
+    """Everything WHOIS told us about a nick"""
+
+    __slots__ = ('nick', 'user', 'host', 'realname', 'server', 'server_info',
+                 'operator', 'idle', 'signon', 'channels', 'away', 'account')
+
+    def __init__(self, nick):
+        self.nick        = nick
+        self.user        = None
+        self.host        = None
+        self.realname    = None
+        self.server      = None
+        self.server_info = None
+        self.operator    = False
+        self.idle        = None
+        self.signon      = None
+        self.channels    = []
+        self.away        = None
+        self.account     = None
+
+
+WhoReply      = collections.namedtuple('WhoReply',
+                        'channel user host server nick flags hops realname')
+ListEntry     = collections.namedtuple('ListEntry', 'channel users topic')
+UserhostReply = collections.namedtuple('UserhostReply', 'nick user host operator away')
+
+# nick prefixes in NAMES replies, these can't start a nick
+_name_prefixes = '~&@%+!'
+
+
+class _Pending:
+    """A query in flight"""
+
+    __slots__ = ('target', 'future', 'result', 'timer')
+
+    def __init__(self, target, future, result):
+        self.target = target
+        self.future = future
+        self.result = result
+        self.timer  = None
+
+
+class ReplyCache:
+    """A bounded cache of query results, keyed by kind and casefolded
+    nick.  Entries expire `ttl` seconds after they're stored, and once
+    there are `size` of them the least recently used are thrown out.
+    """
+
+    def __init__(self, size=1000, ttl=300, clock=time.monotonic):
+        self.size  = size
+        self.ttl   = ttl
+        self.clock = clock
+
+        # stats
+        self.hits   = 0
+        self.misses = 0
+
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, kind, key):
+        """Get a cached result, or None"""
+        entry = self._entries.get((kind, key))
+        if entry is not None:
+            expires, result = entry
+            if expires > self.clock():
+                self._entries.move_to_end((kind, key))
+                self.hits += 1
+                return result
+            del self._entries[(kind, key)]
+
+        self.misses += 1
+        return None
+
+    def put(self, kind, key, result):
+        self._entries[(kind, key)] = (self.clock() + self.ttl, result)
+        self._entries.move_to_end((kind, key))
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """Forget everything about a casefolded nick"""
+        for kind in QueryManager.cached:
+            self._entries.pop((kind, key), None)
+
+    def refold(self, casefold):
+        """Re-key the entries with a new casefold function"""
+        entries = collections.OrderedDict()
+        for (kind, _), (expires, result) in self._entries.items():
+            entries[(kind, casefold(result.nick))] = (expires, result)
+        self._entries = entries
+
+    def clear(self):
+        self._entries.clear()
+
+
+class QueryManager:
+    """Keeps track of the queries a client has in flight.
+
+    Replies to WHOIS and NAMES name their target, so they're matched up
+    by it.  WHO, LIST and USERHOST replies are matched up in the order
+    the commands were sent, which is the order servers answer them in,
+    and WHO and LIST replies then by the channel or nick they name.
+
+    With a cache_size, WHOIS and USERHOST results are cached for
+    cache_ttl seconds, or until we see the nick change, quit or get
+    killed.  Nicks that don't exist aren't cached.
+    """
+
+    # command, how targets are joined, and how many fit in one command
+    kinds = {
+        'WHOIS':    (',', 1),
+        'WHO':      (',', 1),
+        'NAMES':    (',', 1),
+        'LIST':     (',', 1),
+        'USERHOST': (' ', 5),
+    }
+
+    # kinds whose replies don't say which query they're for
+    ordered = ('WHO', 'LIST', 'USERHOST')
+
+    # kinds whose results can be cached, and the messages that make them stale
+    cached = ('WHOIS', 'USERHOST')
+    stale  = frozenset(['NICK', 'QUIT', 'KILL'])
+
+    def __init__(self, client, timeout=30, cache_size=0, cache_ttl=300):
+        self.client  = client
+        self.timeout = timeout
+        self.cache   = ReplyCache(cache_size, cache_ttl) if cache_size else None
+
+        # how many targets each kind of query can pack into one command
+        self.max_targets = {kind: count for kind, (sep, count) in self.kinds.items()}
+
+        self._pending  = {kind: collections.OrderedDict() for kind in self.kinds}
+        self._batch    = {kind: [] for kind in self.kinds}
+        self._sent     = {kind: collections.deque() for kind in self.kinds}
+        self._flush_handle = None
+
+        self._handlers = {
+            '301': self._on_whois_away,
+            '311': self._on_whoisuser,
+            '312': self._on_whoisserver,
+            '313': self._on_whoisoperator,
+            '317': self._on_whoisidle,
+            '318': self._on_endofwhois,
+            '319': self._on_whoischannels,
+            '330': self._on_whoisaccount,
+            '401': self._on_nosuchnick,
+            '352': self._on_whoreply,
+            '315': self._on_endofwho,
+            '353': self._on_namreply,
+            '366': self._on_endofnames,
+            '322': self._on_list,
+            '323': self._on_listend,
+            '302': self._on_userhost,
+        }
+        self.commands = frozenset(self._handlers)
+
+    def __len__(self):
+        return sum(len(pending) for pending in self._pending.values())
+
+
+    ### Queries ###
+
+    def query(self, kind, target=''):
+        """Start a query, or join an identical one in flight.  Returns an
+        awaitable for the result."""
+        key = self.client.casefold(target)
+        if self.cache is not None and kind in self.cached:
+            result = self.cache.get(kind, key)
+            if result is not None:
+                future = self.client.loop.create_future()
+                future.set_result(result)
+                return future
+
+        pending = self._pending[kind]
+        entry = pending.get(key)
+        if entry is None:
+            loop = self.client.loop
+            entry = pending[key] = _Pending(target, loop.create_future(),
+                                            self._new_result(kind, target))
+            entry.timer = loop.call_later(self.timeout, self._expire, kind, key)
+
+            self._batch[kind].append(target)
+            if not self._flush_handle:
+                self._flush_handle = loop.call_soon(self._flush)
+
+        # one waiter giving up shouldn't cancel it for the others
+        return asyncio.shield(entry.future)
+
+    def cancel_all(self, exc):
+        """Fail everything in flight, e.g. when disconnected"""
+        for pending in self._pending.values():
+            for entry in pending.values():
+                entry.timer.cancel()
+                if not entry.future.done():
+                    entry.future.set_exception(exc)
+                    # don't complain if nobody was waiting any more
+                    entry.future.exception()
+            pending.clear()
+
+        for kind in self.kinds:
+            self._batch[kind].clear()
+            self._sent[kind].clear()
+
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    def refold(self):
+        """Re-key the queries in flight and the cache with the client's
+        casefold, when the server's case mapping changed"""
+        casefold = self.client.casefold
+        loop = self.client.loop
+
+        for kind, pending in self._pending.items():
+            keys = {}
+            for old, entry in list(pending.items()):
+                keys[old] = key = casefold(entry.target)
+                # the timer expires the query by key
+                entry.timer.cancel()
+                entry.timer = loop.call_at(entry.timer.when(), self._expire, kind, key)
+            self._pending[kind] = collections.OrderedDict(
+                    (keys[old], entry) for old, entry in pending.items())
+            self._sent[kind] = collections.deque(
+                    [keys.get(key, casefold(key)) for key in chunk]
+                    for chunk in self._sent[kind])
+
+        if self.cache is not None:
+            self.cache.refold(casefold)
+
+    def _new_result(self, kind, target):
+        if kind == 'WHOIS':
+            return WhoisReply(target)
+        if kind == 'NAMES':
+            return {}
+        return []
+
+    def _flush(self):
+        """Send the queries made since the last flush"""
+        self._flush_handle = None
+
+        for kind, (sep, _) in self.kinds.items():
+            targets = self._batch[kind]
+            if not targets:
+                continue
+            self._batch[kind] = []
+
+            room = protocol.MAX_LINE_LENGTH - 3 - len(kind)
+            for chunk in protocol.pack(targets, self.max_targets.get(kind, 1), room):
+                if kind in self.ordered:
+                    self._sent[kind].append([self.client.casefold(t) for t in chunk])
+                self.client._send(' '.join(filter(None, [kind, sep.join(chunk)])))
+
+    def _resolve(self, kind, key, result=None, exc=None):
+        entry = self._pending[kind].pop(key, None)
+        if entry is None:
+            return
+
+        entry.timer.cancel()
+        if not entry.future.done():
+            if exc:
+                entry.future.set_exception(exc)
+                entry.future.exception()
+            else:
+                entry.future.set_result(result)
+
+        if self.cache is not None and result is not None and kind in self.cached:
+            self.cache.put(kind, key, result)
+
+    def _expire(self, kind, key):
+        self._resolve(kind, key, exc=asyncio.TimeoutError())
+
+    def _first(self, kind, key=None):
+        """The query the server's answering with a reply of this kind, or
+        None if the reply should be thrown away.
+
+        Commands stay in line until their end reply comes, even once
+        their queries have expired, so late replies aren't taken for the
+        next query's.  key is the casefolded channel a reply names, if
+        it names one: a reply for a later command means those before it
+        are finished, and one for a channel we didn't ask about, when
+        we asked about channels, is for a command sent some other way.
+        """
+        sent = self._sent[kind]
+        if key is not None:
+            for i, chunk in enumerate(sent):
+                if key in chunk:
+                    for _ in range(i):
+                        self._finish_first(kind)
+                    return self._pending[kind].get(key)
+
+        if not sent:
+            return None
+        if key is not None and key[:1] in self.client.isupport.chantypes and \
+                all(target[:1] in self.client.isupport.chantypes for target in sent[0]):
+            return None
+
+        for target in sent[0]:
+            entry = self._pending[kind].get(target)
+            if entry:
+                return entry
+        return None
+
+    def _finish_first(self, kind, key=None):
+        """The server's done with the oldest command of this kind, or if
+        the end reply names its target, with the command for key and
+        any before it.  An end naming none of them is for a command
+        sent some other way."""
+        sent = self._sent[kind]
+        count = 1 if sent else 0
+        if key is not None:
+            count = 0
+            for i, chunk in enumerate(sent):
+                if key in chunk:
+                    count = i + 1
+                    break
+
+        for _ in range(count):
+            for target in sent.popleft():
+                entry = self._pending[kind].get(target)
+                if entry:
+                    self._resolve(kind, target, entry.result)
+
+
+    ### Replies ###
+
+    def forget(self, command, prefix, args):
+        """Drop cached results a NICK, QUIT or KILL made stale"""
+        if self.cache is None:
+            return
+
+        if command == 'KILL':
+            if args:
+                self.cache.invalidate(self.client.casefold(args[0]))
+            return
+
+        nick = protocol.parse_prefix(prefix)[0]
+        if nick:
+            self.cache.invalidate(self.client.casefold(nick))
+        # someone else may have had the new nick before
+        if command == 'NICK' and args:
+            self.cache.invalidate(self.client.casefold(args[0]))
+
+    def update(self, command, args):
+        """Collect a reply"""
+        handler = self._handlers.get(command)
+        if handler and len(args) > 1:
+            handler(args)
+
+    def _whois(self, nick):
+        entry = self._pending['WHOIS'].get(self.client.casefold(nick))
+        return entry and entry.result
+
+    def _on_whoisuser(self, args):
+        # me nick user host * :realname
+        whois = self._whois(args[1])
+        if whois and len(args) > 5:
+            whois.nick, whois.user, whois.host, whois.realname = \
+                    args[1], args[2], args[3], args[5]
+
+    def _on_whoisserver(self, args):
+        # me nick server :info
+        whois = self._whois(args[1])
+        if whois and len(args) > 3:
+            whois.server, whois.server_info = args[2], args[3]
+
+    def _on_whoisoperator(self, args):
+        whois = self._whois(args[1])
+        if whois:
+            whois.operator = True
+
+    def _on_whoisidle(self, args):
+        # me nick idle signon :seconds idle, signon time
+        whois = self._whois(args[1])
+        if whois and len(args) > 2:
+            whois.idle = int(args[2])
+            if len(args) > 4:
+                whois.signon = int(args[3])
+
+    def _on_whoischannels(self, args):
+        # me nick :@#chan +#chan2
+        whois = self._whois(args[1])
+        if whois and len(args) > 2:
+            whois.channels.extend(args[2].split())
+
+    def _on_whois_away(self, args):
+        # me nick :away message
+        whois = self._whois(args[1])
+        if whois and len(args) > 2:
+            whois.away = args[2]
+
+    def _on_whoisaccount(self, args):
+        # me nick account :is logged in as
+        whois = self._whois(args[1])
+        if whois and len(args) > 2:
+            whois.account = args[2]
+
+    def _on_nosuchnick(self, args):
+        entry = self._pending['WHOIS'].get(self.client.casefold(args[1]))
+        if entry:
+            entry.result = None
+
+    def _on_endofwhois(self, args):
+        # me nick[,nick] :End of /WHOIS list.
+        for nick in args[1].split(','):
+            key = self.client.casefold(nick)
+            entry = self._pending['WHOIS'].get(key)
+            if entry:
+                self._resolve('WHOIS', key, entry.result)
+
+    def _on_whoreply(self, args):
+        # me #chan user host server nick flags :hops realname
+        if len(args) < 8:
+            return
+        # a reply to a WHO for a nick may name any channel, or '*'
+        casefold = self.client.casefold
+        key = casefold(args[1])
+        nick = casefold(args[5])
+        if not any(key in chunk for chunk in self._sent['WHO']) and \
+                any(nick in chunk for chunk in self._sent['WHO']):
+            key = nick
+
+        entry = self._first('WHO', key)
+        if entry:
+            hops, _, realname = args[7].partition(' ')
+            entry.result.append(WhoReply(args[1], args[2], args[3], args[4],
+                                         args[5], args[6], hops, realname))
+
+    def _on_endofwho(self, args):
+        # me mask :End of WHO list.
+        self._finish_first('WHO', self.client.casefold(args[1].split(',')[0]))
+
+    def _on_namreply(self, args):
+        # me = #chan :@nick +nick nick
+        if len(args) < 4:
+            return
+
+        entry = self._pending['NAMES'].get(self.client.casefold(args[2]))
+        if entry:
+            for name in args[3].split():
+                nick = name.lstrip(_name_prefixes)
+                entry.result[nick] = name[:len(name) - len(nick)]
+
+    def _on_endofnames(self, args):
+        # me #chan :End of /NAMES list.
+        for channel in args[1].split(','):
+            key = self.client.casefold(channel)
+            entry = self._pending['NAMES'].get(key)
+            if entry:
+                self._resolve('NAMES', key, entry.result)
+
+    def _on_list(self, args):
+        # me #chan users :topic
+        if len(args) < 4:
+            return
+
+        # a LIST of everything gets every channel, otherwise each reply
+        # goes to the query for the channel it names
+        sent = self._sent['LIST']
+        if sent and sent[0] == ['']:
+            entry = self._pending['LIST'].get('')
+        else:
+            entry = self._first('LIST', self.client.casefold(args[1]))
+        if entry:
+            entry.result.append(ListEntry(args[1], int(args[2]), args[3]))
+
+    def _on_listend(self, args):
+        self._finish_first('LIST')
+
+    def _on_userhost(self, args):
+        # me :nick*=+user@host nick=-user@host
+        sent = self._sent['USERHOST']
+        if not sent:
+            return
+
+        replies = {}
+        for reply in args[1].split():
+            nick, _, userhost = reply.partition('=')
+            operator = nick.endswith('*')
+            nick = nick.rstrip('*')
+            user, _, host = userhost[1:].partition('@')
+            replies[self.client.casefold(nick)] = UserhostReply(
+                    nick, user, host, operator, userhost[:1] == '-')
+
+        # nicks which don't exist just aren't in the reply
+        for key in sent.popleft():
+            self._resolve('USERHOST', key, replies.get(key))
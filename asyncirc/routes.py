@@ -0,0 +1,292 @@
+"""Routing bot commands and triggers in PRIVMSGs to handlers"""
+
+__all__ = ['command', 'trigger', 'Command', 'Route', 'RouteTable', 'Router']
+
+import collections, itertools, logging, re, time
+
+from . import flood
+
+log = logging.getLogger(__name__)
+
+# what a command handler gets as event.match: the command's name, and
+# the rest of the message
+Command = collections.namedtuple('Command', ('name', 'args'))
+
+# routes are tried in the order they're defined
+_order = itertools.count()
+
+# flags which can be scoped to one alternative of the combined regex
+_inline_flags = ((re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'),
+                 (re.VERBOSE, 'x'), (re.ASCII, 'a'))
+
+
+class Route:
+    """A handler, and the command names or regex that lead to it.
+
+    With a cooldown, the route is used at most once every `cooldown`
+    seconds.  A rate of (count, seconds) lets each user use it `count`
+    times in any `seconds`, on top of that.
+    """
+
+    __slots__ = ('handler', 'names', 'regex', 'cooldown', 'rate', 'order')
+
+    def __init__(self, handler, names=(), regex=None, cooldown=0, rate=None):
+        self.handler  = handler
+        self.names    = tuple(names)
+        self.regex    = regex
+        self.cooldown = cooldown
+        self.rate     = rate
+        self.order    = next(_order)
+
+    def __repr__(self):
+        return '<Route {0} -> {1}>'.format(
+                '|'.join(self.names) if self.regex is None else self.regex.pattern,
+                self.handler.__name__)
+
+
+def _add_route(func, route):
+    routes = func.__dict__.setdefault('_routes', [])
+    routes.append(route)
+    return func
+
+
+def command(*names, cooldown=0, rate=None):
+    """Decorate a handler for bot commands, e.g.
+
+        @command('join', 'j')
+        def cmd_join(self, event):
+            self.join(event.match.args)
+
+    Names may be several words, e.g. 'set topic', and are matched
+    case-insensitively.  The aliases share a cooldown and rate limit.
+    event.match is a Command of the first name and the rest of the
+    message.
+    """
+    if not names:
+        raise ValueError("a command needs a name")
+
+    names = [' '.join(name.lower().split()) for name in names]
+    def decorate(func):
+        return _add_route(func, Route(func, names, cooldown=cooldown, rate=rate))
+    return decorate
+
+
+def trigger(pattern, flags=0, cooldown=0, rate=None):
+    """Decorate a handler for messages which match a regex anywhere, e.g.
+
+        @trigger(r'\\bhttps?://\\S+')
+        def on_url(self, event):
+            self.fetch_title(event.target, event.match.group(0))
+
+    event.match is the regex's match object.  A message matching several
+    triggers goes to the one defined first, wherever in the message the
+    others match.
+    """
+    def decorate(func):
+        return _add_route(func, Route(func, regex=re.compile(pattern, flags),
+                                      cooldown=cooldown, rate=rate))
+    return decorate
+
+
+class RouteTable:
+    """The routes of a client class, compiled for lookups.
+
+    Commands go in a trie of words, so finding the longest command a
+    message starts with takes one dict lookup per word, however many
+    commands there are.  The triggers are joined into one regex, with a
+    lookahead for each in the order they're defined, so a message is
+    tried against all of them in one call, and the named group that
+    matched says which it was.  Regexes with groups of their own, whose
+    numbers would shift, are searched one by one instead.
+    """
+
+    def __init__(self, routes):
+        routes = sorted(routes, key=lambda route: route.order)
+
+        # word -> node, a node is a dict with its route under None
+        self.commands = {}
+        self.depth = 0
+        for route in routes:
+            for name in route.names:
+                words = name.split()
+                node = self.commands
+                for word in words:
+                    node = node.setdefault(word, {})
+                if None in node:
+                    log.warning('*** command {0!r} defined twice'.format(name))
+                node[None] = route
+                self.depth = max(self.depth, len(words))
+
+        self.routes   = routes
+        self.triggers = [route for route in routes if route.regex is not None]
+        self.regex = self._combine(self.triggers)
+
+    def __len__(self):
+        return len(self.routes)
+
+    @staticmethod
+    def _combine(triggers):
+        """One regex matching the first of the triggers that's found
+        anywhere, or None"""
+        if not triggers:
+            return None
+
+        # backreferences would point at other triggers' groups
+        if any(route.regex.groups for route in triggers):
+            return None
+
+        parts = []
+        for i, route in enumerate(triggers):
+            flags = ''.join(letter for flag, letter in _inline_flags
+                            if route.regex.flags & flag)
+            pattern = '(?{0}:{1})'.format(flags, route.regex.pattern) if flags \
+                    else route.regex.pattern
+            parts.append(r'(?=[\s\S]*?(?P<_{0}>{1}))'.format(i, pattern))
+
+        try:
+            return re.compile('|'.join(parts))
+        except re.error as e:
+            # e.g. a verbose pattern ending in a comment
+            log.warning('*** triggers can\'t be combined, trying each: {0}'.format(e))
+            return None
+
+    def find_command(self, text):
+        """The longest command text starts with, as (route, args), or None"""
+        words = text.split(None, self.depth)
+        node, found = self.commands, None
+        for i, word in enumerate(words[:self.depth]):
+            node = node.get(word.lower())
+            if node is None:
+                break
+            if None in node:
+                found = (node[None], i + 1)
+
+        if found is None:
+            return None
+
+        route, length = found
+        rest = text.split(None, length)
+        return route, rest[length] if len(rest) > length else ''
+
+    def find_trigger(self, text):
+        """The first trigger, in the order they're defined, matching text,
+        as (route, match), or None"""
+        if self.regex is not None:
+            m = self.regex.match(text)
+            if m is None:
+                return None
+            route = self.triggers[int(m.lastgroup[1:])]
+            # match the trigger's own regex there, for a match object of
+            # its own
+            return route, route.regex.match(text, m.start(m.lastgroup))
+
+        for route in self.triggers:
+            m = route.regex.search(text)
+            if m:
+                return route, m
+        return None
+
+
+class Router:
+    """Sends a client's PRIVMSGs to the routes they match.
+
+    In channels a command has to start with one of the prefixes, e.g.
+    '!help', or, with `address`, be addressed to us, 'nick: help'.  In
+    private neither is needed.  A message goes to the first route it
+    matches: commands are tried before triggers.
+
+    Cooldowns and rate limits are kept here, per client, and a message
+    which matches a route that's cooling down or over its limit is
+    dropped.
+    """
+
+    # how many users' rate limits to keep before dropping idle ones
+    max_users = 10000
+
+    def __init__(self, client, table, prefixes=('!',), address=True, clock=time.monotonic):
+        self.client   = client
+        self.table    = table
+        self.prefixes = tuple(prefixes)
+        self.address  = address
+        self.clock    = clock
+
+        # route -> when it was last used, (route, user) -> TokenBucket
+        self._used  = {}
+        self._users = {}
+
+    def route(self, event):
+        """Dispatch a message event to its route, returns the route or None"""
+        found = self.match(event)
+        if found is None:
+            return None
+
+        route, match = found
+        if not self._allow(route, event):
+            return None
+
+        event.match = match
+        self.client._dispatch(route.handler, event, respond=False)
+        return route
+
+    def match(self, event):
+        """Find the route a message event goes to, as (route, match)"""
+        text = event.message
+        table = self.table
+
+        if table.commands:
+            command = self._command_text(event, text)
+            if command is not None:
+                found = table.find_command(command)
+                if found is not None:
+                    return found[0], Command(found[0].names[0], found[1])
+
+        if table.triggers:
+            return table.find_trigger(text)
+        return None
+
+    def _command_text(self, event, text):
+        """What's left of the message once its command prefix is taken
+        off, or None if it isn't a command"""
+        for prefix in self.prefixes:
+            if text.startswith(prefix):
+                return text[len(prefix):]
+
+        if self.address:
+            nick = self.client.nickname
+            if len(text) > len(nick) and text[len(nick)] in ':,' and \
+                    self.client.is_me(text[:len(nick)]):
+                return text[len(nick) + 1:].lstrip()
+
+        if event.target and event.target[0] not in self.client.isupport.chantypes:
+            return text
+        return None
+
+    def _allow(self, route, event):
+        """Check and update the route's cooldown and the user's rate limit"""
+        if route.cooldown:
+            now = self.clock()
+            if now - self._used.get(route, -route.cooldown) < route.cooldown:
+                log.debug('*** {0} is cooling down'.format(route))
+                return False
+
+        if route.rate:
+            key = (route, event.source_key)
+            bucket = self._users.get(key)
+            if bucket is None:
+                if len(self._users) >= self.max_users:
+                    self._prune()
+                count, seconds = route.rate
+                bucket = self._users[key] = flood.TokenBucket(count / seconds, count, self.clock)
+            if not bucket.consume():
+                log.debug('*** {0} is over its limit for {1}'.format(route, event.source))
+                return False
+
+        if route.cooldown:
+            self._used[route] = now
+        return True
+
+    def _prune(self):
+        """Forget users whose buckets have filled back up"""
+        for key, bucket in list(self._users.items()):
+            if bucket.tokens >= bucket.burst:
+                del self._users[key]
@@ -0,0 +1,323 @@
+"""Scheduled jobs, kept on a hierarchical timer wheel"""
+
+__all__ = ['Scheduler', 'Job']
+
+import datetime, json, logging, math, os, time
+
+log = logging.getLogger(__name__)
+
+# slots per wheel, as bits
+_BITS  = 8
+_SLOTS = 1 << _BITS
+_MASK  = _SLOTS - 1
+
+
+def timestamp(when):
+    """A UTC timestamp from a number or a datetime, naive datetimes are
+    taken to be in UTC"""
+    if isinstance(when, datetime.datetime):
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=datetime.timezone.utc)
+        return when.timestamp()
+    return float(when)
+
+
+class Job:
+    """A scheduled call, which can be cancelled until it's run"""
+
+    __slots__ = ('scheduler', 'when', 'tick', 'action', 'args', 'slot', 'cancelled')
+
+    def __init__(self, scheduler, when, tick, action, args):
+        self.scheduler = scheduler
+        self.when      = when
+        self.tick      = tick
+        self.action    = action
+        self.args      = args
+        self.slot      = None
+        self.cancelled = False
+
+    def __repr__(self):
+        return '<Job {0} {1}{2}>'.format(self.time.isoformat(), self.action, self.args)
+
+    @property
+    def time(self):
+        """When the job's due, as a UTC datetime"""
+        return datetime.datetime.fromtimestamp(self.when, datetime.timezone.utc)
+
+    def cancel(self):
+        """Don't run the job, returns False if it's already run or been
+        cancelled"""
+        if self.slot is None or self.cancelled:
+            return False
+        self.slot.discard(self)
+        self.cancelled = True
+        self.scheduler._changed()
+        return True
+
+
+class Scheduler:
+    """Runs jobs at given (UTC) times on an event loop.
+
+    Jobs go on a hierarchical timer wheel: `levels` wheels of 256 slots,
+    the first with a slot per `resolution` seconds, each of the others
+    with a slot per turn of the one below.  Adding and cancelling a job
+    is O(1), and as a wheel's slot comes round its jobs drop down to the
+    wheel below, until they're due.  The loop is only woken when a slot
+    with jobs in it comes round, and everything due by then is run in
+    one go.
+
+    A job's action is either a callable, or the name of one for `resolve`
+    to look up when it's run.  Jobs with named actions and JSON-friendly
+    arguments can be saved with snapshot() and loaded again with restore().
+    Given a path, they're loaded from it to start with, and saved to it
+    every save_interval seconds when anything's changed.
+
+    While paused, jobs which come due are held, and run once it resumes.
+    """
+
+    def __init__(self, loop=None, resolve=None, resolution=0.1, levels=4,
+                 path=None, save_interval=60, clock=time.time):
+        self.loop       = loop
+        self.resolve    = resolve
+        self.resolution = resolution
+        self.clock      = clock
+        self.path       = path
+        self.save_interval = save_interval
+
+        # slot number -> set of jobs, slots are only made when used, so
+        # an idle scheduler is cheap
+        self._wheels   = [{} for _ in range(levels)]
+        self._overflow = set()
+        self._due      = set()
+        self._tick     = self._now_tick()
+        self._handle   = None
+        self._wake     = None
+        self.paused    = False
+
+        self._dirty       = False
+        self._save_handle = None
+
+        if path:
+            self.restore(path)
+            self._dirty = False
+
+    def __len__(self):
+        count = len(self._due) + len(self._overflow)
+        for wheel in self._wheels:
+            count += sum(len(slot) for slot in wheel.values())
+        return count
+
+    def _now_tick(self):
+        return math.floor(self.clock() / self.resolution)
+
+
+    ### Jobs ###
+
+    def call_at(self, when, action, *args):
+        """Run action(*args) at a time, given as a UTC timestamp or a
+        datetime.  Returns the Job."""
+        when = timestamp(when)
+        job = Job(self, when, math.ceil(when / self.resolution), action, args)
+        self._insert(job)
+        self._schedule()
+        self._changed()
+        return job
+
+    def call_later(self, delay, action, *args):
+        """Run action(*args) after delay seconds.  Returns the Job."""
+        return self.call_at(self.clock() + delay, action, *args)
+
+    def jobs(self):
+        """All the jobs waiting to run, soonest first"""
+        jobs = list(self._due) + list(self._overflow)
+        for wheel in self._wheels:
+            for slot in wheel.values():
+                jobs.extend(slot)
+        return sorted(jobs, key=lambda job: job.when)
+
+    def cancel_all(self):
+        """Cancel every job"""
+        for job in self.jobs():
+            job.cancel()
+        if self._handle:
+            self._handle.cancel()
+            self._handle = self._wake = None
+
+    def start(self, loop):
+        """Start running jobs on an event loop"""
+        self.loop = loop
+        self._schedule()
+        if self._dirty:
+            self._changed()
+
+
+    def pause(self):
+        """Hold jobs which come due until resume(), e.g. while there's
+        no connection to run them on"""
+        self.paused = True
+        if self._handle:
+            self._handle.cancel()
+            self._handle = self._wake = None
+
+    def resume(self):
+        """Run the jobs held while paused, and carry on as usual"""
+        self.paused = False
+        self._schedule()
+
+
+    ### Persistence ###
+
+    def snapshot(self, path):
+        """Save the jobs with named actions to a file, returns how many"""
+        saved = [{'when': job.when, 'action': job.action, 'args': list(job.args)}
+                 for job in self.jobs() if isinstance(job.action, str)]
+
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmp, path)
+        return len(saved)
+
+    def save(self):
+        """Save the jobs to our path now, if anything's changed"""
+        if self._save_handle:
+            self._save_handle.cancel()
+            self._save_handle = None
+
+        if self.path and self._dirty:
+            self._dirty = False
+            self.snapshot(self.path)
+
+    def _changed(self):
+        self._dirty = True
+        if self.path and self.loop and not self._save_handle:
+            self._save_handle = self.loop.call_later(self.save_interval, self.save)
+
+    def restore(self, path):
+        """Load jobs saved by snapshot(), those which came due while they
+        were saved run straight away.  Returns how many were loaded."""
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return 0
+
+        for job in saved:
+            self.call_at(job['when'], job['action'], *job['args'])
+        return len(saved)
+
+
+    ### The wheels ###
+
+    def _insert(self, job):
+        """Put a job in the slot for its tick: on the lowest wheel where
+        the higher digits of its tick match the current one"""
+        diff = job.tick ^ self._tick
+        if job.tick <= self._tick:
+            slot = self._due
+        else:
+            level = (diff.bit_length() - 1) // _BITS
+            if level < len(self._wheels):
+                wheel = self._wheels[level]
+                index = (job.tick >> (level * _BITS)) & _MASK
+                slot = wheel.get(index)
+                if slot is None:
+                    slot = wheel[index] = set()
+            else:
+                slot = self._overflow
+
+        slot.add(job)
+        job.slot = slot
+
+    def _next_tick(self):
+        """The next tick that has any work to do, or None"""
+        if self._due:
+            return self._tick
+        return self._next_slot()
+
+    def _next_slot(self):
+        """The next tick after this one with a slot to empty, or None"""
+        for level, wheel in enumerate(self._wheels):
+            shift = level * _BITS
+            digit = (self._tick >> shift) & _MASK
+            later = [i for i, slot in wheel.items() if i > digit and slot]
+            if later:
+                base = (self._tick >> (shift + _BITS)) << (shift + _BITS)
+                return base | (min(later) << shift)
+
+        if self._overflow:
+            shift = len(self._wheels) * _BITS
+            return ((self._tick >> shift) + 1) << shift
+        return None
+
+    def _advance(self, target):
+        """Move the wheels on to a tick, returning the jobs now due"""
+        while True:
+            tick = self._next_slot()
+            if tick is None or tick > target:
+                self._tick = max(self._tick, target)
+                break
+
+            self._tick = tick
+            # jobs coming round on higher wheels drop down a level
+            for level in range(len(self._wheels), 0, -1):
+                shift = level * _BITS
+                if tick & ((1 << shift) - 1):
+                    continue
+                if level == len(self._wheels):
+                    jobs = list(self._overflow)
+                    self._overflow.clear()
+                else:
+                    jobs = self._wheels[level].pop((tick >> shift) & _MASK, ())
+                for job in jobs:
+                    self._insert(job)
+
+            slot = self._wheels[0].pop(tick & _MASK, ())
+            for job in slot:
+                job.slot = self._due
+            self._due.update(slot)
+
+            if tick == target:
+                break
+
+        # cancelling a due job takes it out of the set that's returned
+        due, self._due = self._due, set()
+        return sorted(due, key=lambda job: job.when)
+
+    def _schedule(self):
+        """Make sure the loop wakes us for the next tick with work"""
+        if not self.loop or self.paused:
+            return
+
+        tick = self._next_tick()
+        if tick is None or (self._wake is not None and self._wake <= tick):
+            return
+
+        if self._handle:
+            self._handle.cancel()
+
+        delay = max(0.0, tick * self.resolution - self.clock())
+        self._wake = tick
+        self._handle = self.loop.call_later(delay, self._run)
+
+    def _run(self):
+        """Run everything that's due"""
+        self._handle = self._wake = None
+
+        due = self._advance(self._now_tick())
+        for job in due:
+            if job.cancelled:
+                continue
+            job.slot = None
+
+            action = job.action
+            if isinstance(action, str):
+                action = self.resolve(action)
+            try:
+                action(*job.args)
+            except Exception:
+                log.exception('*** scheduled {0} failed'.format(job))
+
+        if due:
+            self._changed()
+        self._schedule()
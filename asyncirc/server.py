@@ -0,0 +1,689 @@
+"""A small in-process IRC server, for testing and load testing clients.
+
+FakeServer speaks just enough IRC for a client to register, join
+channels and talk: CAP, NICK, USER, PING, JOIN, PART, PRIVMSG, NOTICE,
+NAMES and QUIT.  It can throttle and kill flooding clients like a real
+server does, and disconnect clients on cue, to exercise reconnects.
+
+Clients connect to it over TCP once it's listening, or in memory, which
+needs no sockets at all:
+
+    server = FakeServer()
+    client.connector = server.create_connection
+    await client.connect()
+
+load_test() runs thousands of simulated clients against it, and reports
+how fast their messages got through.  Run this module to try it:
+
+    python -m asyncirc.server [clients] [channels] [messages] [interval]
+"""
+
+__all__ = ['FakeServer', 'MemoryTransport', 'LoadClient', 'load_test']
+
+import asyncio, collections, logging, sys, time
+
+from . import buffer, flood, protocol
+from .client import IRCClient
+
+log = logging.getLogger(__name__)
+
+
+class MemoryTransport(asyncio.Transport):
+    """One end of an in-memory connection.  What's written is handed to
+    the other end's protocol on the next loop iteration, in order, all
+    of one iteration's writes at once.  Closing either end closes both."""
+
+    def __init__(self, loop, protocol, name='memory'):
+        super().__init__({'peername': (name, 0), 'sockname': (name, 0)})
+        self.loop     = loop
+        self.protocol = protocol
+        self.peer     = None
+
+        self._pending = bytearray()
+        self._closing = False
+        self._lost    = False
+
+    @classmethod
+    def pair(cls, loop, protocol, peer_protocol):
+        """Connect two protocols, returns their transports"""
+        a, b = cls(loop, protocol), cls(loop, peer_protocol)
+        a.peer, b.peer = b, a
+        loop.call_soon(protocol.connection_made, a)
+        loop.call_soon(peer_protocol.connection_made, b)
+        return a, b
+
+    def write(self, data):
+        if self._closing or not data:
+            return
+        if not self._pending:
+            self.loop.call_soon(self._deliver)
+        self._pending += data
+
+    def writelines(self, lines):
+        self.write(b''.join(lines))
+
+    def _deliver(self):
+        data = bytes(self._pending)
+        self._pending.clear()
+        if not self.peer._lost:
+            self.peer.protocol.data_received(data)
+
+    def close(self):
+        for end in (self, self.peer):
+            if not end._closing:
+                end._closing = True
+                self.loop.call_soon(end._connection_lost)
+
+    abort = close
+
+    def _connection_lost(self):
+        if not self._lost:
+            self._lost = True
+            self.protocol.connection_lost(None)
+
+    def is_closing(self):
+        return self._closing
+
+    def can_write_eof(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+
+class Channel:
+    """A channel on the fake server"""
+
+    __slots__ = ('name', 'members')
+
+    def __init__(self, name):
+        self.name = name
+        # connection -> its prefix, '@' or ''
+        self.members = {}
+
+
+class Connection(asyncio.Protocol):
+    """The server's side of one client connection"""
+
+    def __init__(self, server):
+        self.server    = server
+        self.transport = None
+
+        self.nick       = None
+        self.user       = None
+        self.host       = 'sim'
+        self.registered = False
+        self.negotiating = False
+        self.channels   = set()
+        self.lines      = 0
+
+        self.buffer = buffer.LineBuffer(
+                max_line_length=protocol.MAX_LINE_LENGTH + protocol.MAX_TAGS_LENGTH)
+
+        # lines held back while the client's flooding
+        self.bucket  = flood.TokenBucket(server.flood_rate, server.flood_burst) \
+                if server.flood_rate else None
+        self.backlog = collections.deque()
+        self._handle = None
+
+    @property
+    def prefix(self):
+        return '{0}!{1}@{2}'.format(self.nick, self.user, self.host)
+
+    @property
+    def name(self):
+        """What numerics are addressed to"""
+        return self.nick or '*'
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server._connected(self)
+
+    def connection_lost(self, exc):
+        if self._handle:
+            self._handle.cancel()
+        self.server._disconnected(self, 'Connection closed')
+
+    def data_received(self, data):
+        if self.transport.is_closing():
+            return
+        self.buffer.push(data)
+        for line in self.buffer:
+            if not line:
+                continue
+            if self.backlog or (self.bucket and not self.bucket.consume()):
+                self._hold(line)
+            else:
+                self._handle_line(line)
+            if self.transport.is_closing():
+                break
+
+    def _hold(self, line):
+        """Queue a line until the flood limit allows it, or kill the
+        client if too much has piled up"""
+        self.backlog.append(line)
+        if len(self.backlog) > self.server.flood_max_lines:
+            self.server.stats['floods'] += 1
+            self.server.kill(self, 'Excess Flood')
+        elif not self._handle:
+            self._handle = self.server.loop.call_later(self.bucket.delay(), self._drain)
+
+    def _drain(self):
+        self._handle = None
+        while self.backlog and self.bucket.consume():
+            self._handle_line(self.backlog.popleft())
+            if self.transport.is_closing():
+                return
+        if self.backlog:
+            self._handle = self.server.loop.call_later(self.bucket.delay(), self._drain)
+
+    def _handle_line(self, line):
+        server = self.server
+        server.stats['lines_in'] += 1
+        self.lines += 1
+
+        tags, prefix, command, args = protocol.parse_bytes(line)
+        command = command.upper()
+        server.received[command] += 1
+
+        handler = server._commands.get(command)
+        if handler is None:
+            if self.registered:
+                server.numeric(self, '421', command, 'Unknown command')
+        elif not self.registered and command not in server._unregistered:
+            server.numeric(self, '451', 'You have not registered')
+        else:
+            handler(server, self, args)
+
+        if server.kill_after and self.lines >= server.kill_after and \
+                not self.transport.is_closing():
+            server.kill(self, 'Scripted disconnect')
+
+    def send(self, line):
+        """Send a line, as a str or bytes without the CRLF"""
+        if isinstance(line, str):
+            line = line.encode()
+        self.write(line + b'\r\n')
+
+    def write(self, data):
+        if self.transport and not self.transport.is_closing():
+            stats = self.server.stats
+            stats['lines_out'] += data.count(b'\n')
+            stats['bytes_out'] += len(data)
+            self.transport.write(data)
+
+
+class FakeServer:
+    """An IRC server stand-in, running on the current event loop.
+
+    Flood limits work like ircd's: each client may send `flood_burst`
+    lines at once, then `flood_rate` a second.  Lines over that are held
+    back, and a client with more than `flood_max_lines` held back is
+    killed for Excess Flood.  With no flood_rate, anything goes.
+
+    For scripted disconnects, kill() and kill_later() drop clients, and
+    with `kill_after` set every client is dropped once it's sent that
+    many lines.
+
+    stats counts connections, lines and bytes, and received counts the
+    commands clients sent.
+    """
+
+    # advertised in the 005 reply
+    isupport = ('CASEMAPPING=rfc1459', 'CHANTYPES=#&', 'PREFIX=(ov)@+',
+                'CHANMODES=beI,k,l,imnst', 'MODES=4', 'NICKLEN=30', 'CHANNELLEN=50',
+                'TARGMAX=JOIN:,PART:,PRIVMSG:4,NOTICE:4,NAMES:1')
+
+    # commands which can be sent before registering
+    _unregistered = frozenset(['CAP', 'NICK', 'USER', 'PING', 'PONG', 'QUIT'])
+
+    def __init__(self, name='irc.fake', network='FakeNet', capabilities=(),
+                 flood_rate=None, flood_burst=10, flood_max_lines=100, kill_after=None):
+        self.name         = name
+        self.network      = network
+        self.capabilities = frozenset(capabilities)
+
+        self.flood_rate      = flood_rate
+        self.flood_burst     = flood_burst
+        self.flood_max_lines = flood_max_lines
+        self.kill_after      = kill_after
+
+        self.casefold = protocol.CaseFolder('rfc1459')
+        self.loop = None
+
+        self.connections = set()
+        # casefolded nick -> Connection, casefolded name -> Channel
+        self.nicks    = {}
+        self.channels = {}
+
+        self.stats    = collections.Counter()
+        self.received = collections.Counter()
+
+        self._server = None
+
+    def __len__(self):
+        return len(self.connections)
+
+
+    ### Listening ###
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Listen for TCP connections, returns the port"""
+        self.loop = asyncio.get_running_loop()
+        self._server = await self.loop.create_server(lambda: Connection(self), host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def create_connection(self, protocol_factory, host=None, port=None, **kwargs):
+        """Connect a client in memory, like loop.create_connection()"""
+        self.loop = asyncio.get_running_loop()
+        client = protocol_factory()
+        transport, _ = MemoryTransport.pair(self.loop, client, Connection(self))
+        # connection_made has to have happened by the time we return
+        await asyncio.sleep(0)
+        return transport, client
+
+    async def close(self):
+        """Disconnect everyone, and stop listening"""
+        for conn in list(self.connections):
+            self.kill(conn, 'Server shutting down')
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        # let the connections see they're closed
+        await asyncio.sleep(0)
+
+
+    ### Scripted disconnects ###
+
+    def kill(self, who=None, reason='Killed'):
+        """Disconnect a client, by nick or Connection, or everyone"""
+        if who is None:
+            for conn in list(self.connections):
+                self.kill(conn, reason)
+            return
+
+        conn = who if isinstance(who, Connection) else self.nicks.get(self.casefold(who))
+        if conn is None or conn.transport.is_closing():
+            return
+
+        self.stats['kills'] += 1
+        conn.send('ERROR :Closing Link: {0} ({1})'.format(conn.host, reason))
+        self._disconnected(conn, reason)
+        conn.transport.close()
+
+    def kill_later(self, delay, who=None, reason='Killed'):
+        """kill() after delay seconds"""
+        return self.loop.call_later(delay, self.kill, who, reason)
+
+
+    ### Bookkeeping ###
+
+    def _connected(self, conn):
+        self.loop = self.loop or asyncio.get_running_loop()
+        self.connections.add(conn)
+        self.stats['connections'] += 1
+
+    def _disconnected(self, conn, reason):
+        """Forget a client, telling everyone who shared a channel"""
+        if conn not in self.connections:
+            return
+        self.connections.discard(conn)
+
+        if conn.registered:
+            line = ':{0} QUIT :{1}\r\n'.format(conn.prefix, reason).encode()
+            peers = set()
+            for key in conn.channels:
+                channel = self.channels[key]
+                del channel.members[conn]
+                peers.update(channel.members)
+                if not channel.members:
+                    del self.channels[key]
+            for peer in peers:
+                peer.write(line)
+
+        if conn.nick and self.nicks.get(self.casefold(conn.nick)) is conn:
+            del self.nicks[self.casefold(conn.nick)]
+        conn.channels.clear()
+
+    def numeric(self, conn, code, *args):
+        """Send a numeric reply, the last argument is the trailing one"""
+        params = ' '.join(args[:-1])
+        conn.send(':{0} {1} {2} {3}{4}:{5}'.format(
+                self.name, code, conn.name, params, params and ' ', args[-1]))
+
+    def _register(self, conn):
+        if conn.registered or conn.negotiating or not (conn.nick and conn.user):
+            return
+
+        conn.registered = True
+        self.numeric(conn, '001', 'Welcome to the {0} IRC Network {1}'.format(
+                self.network, conn.prefix))
+        self.numeric(conn, '002', 'Your host is {0}, running asyncirc.server'.format(self.name))
+        self.numeric(conn, '004', self.name, 'asyncirc', 'iow', 'beIklimnostv',
+                     'The server is here')
+        tokens = list(self.isupport) + ['NETWORK=' + self.network]
+        for group in protocol.pack(tokens, 12, 400):
+            self.numeric(conn, '005', *group, 'are supported by this server')
+        self.numeric(conn, '422', 'MOTD File is missing')
+
+    def _names(self, conn, channel):
+        names = [prefix + member.nick for member, prefix in channel.members.items()]
+        room = protocol.MAX_LINE_LENGTH - 2 - len(
+                ':{0} 353 {1} = {2} :'.format(self.name, conn.nick, channel.name))
+        for group in protocol.pack(names, None, room):
+            self.numeric(conn, '353', '=', channel.name, ' '.join(group))
+        self.numeric(conn, '366', channel.name, 'End of /NAMES list.')
+
+
+    ### Commands ###
+
+    def _cap(self, conn, args):
+        if not args:
+            return self.numeric(conn, '461', 'CAP', 'Not enough parameters')
+
+        subcommand = args[0].upper()
+        if subcommand == 'LS':
+            conn.negotiating = not conn.registered
+            conn.send(':{0} CAP {1} LS :{2}'.format(
+                    self.name, conn.name, ' '.join(sorted(self.capabilities))))
+        elif subcommand == 'REQ' and len(args) > 1:
+            wanted = args[1].split()
+            reply = 'ACK' if self.capabilities.issuperset(
+                    name.lstrip('-') for name in wanted) else 'NAK'
+            conn.send(':{0} CAP {1} {2} :{3}'.format(self.name, conn.name, reply, args[1]))
+        elif subcommand == 'END':
+            conn.negotiating = False
+            self._register(conn)
+
+    def _nick(self, conn, args):
+        if not args or not args[0]:
+            return self.numeric(conn, '431', 'No nickname given')
+
+        nick = args[0]
+        if nick[0] in '#&:0123456789-' or len(nick) > 30 or \
+                any(c in nick for c in ' ,*?!@.'):
+            return self.numeric(conn, '432', nick, 'Erroneous Nickname')
+
+        key = self.casefold(nick)
+        other = self.nicks.get(key)
+        if other is not None and other is not conn:
+            return self.numeric(conn, '433', nick, 'Nickname is already in use')
+
+        if conn.nick:
+            del self.nicks[self.casefold(conn.nick)]
+        self.nicks[key] = conn
+
+        if conn.registered:
+            line = ':{0} NICK :{1}\r\n'.format(conn.prefix, nick).encode()
+            peers = {conn}
+            for channel in conn.channels:
+                peers.update(self.channels[channel].members)
+            for peer in peers:
+                peer.write(line)
+
+        conn.nick = nick
+        self._register(conn)
+
+    def _user(self, conn, args):
+        if conn.registered:
+            return self.numeric(conn, '462', 'You may not reregister')
+        if len(args) < 4:
+            return self.numeric(conn, '461', 'USER', 'Not enough parameters')
+
+        conn.user = args[0][:10]
+        self._register(conn)
+
+    def _ping(self, conn, args):
+        conn.send(':{0} PONG {0} :{1}'.format(self.name, args[0] if args else ''))
+
+    def _pong(self, conn, args):
+        pass
+
+    def _join(self, conn, args):
+        if not args:
+            return self.numeric(conn, '461', 'JOIN', 'Not enough parameters')
+
+        if args[0] == '0':
+            for key in list(conn.channels):
+                self._part_channel(conn, self.channels[key], 'Left all channels')
+            return
+
+        for name in args[0].split(','):
+            if not name or name[0] not in '#&' or len(name) > 50:
+                self.numeric(conn, '403', name, 'No such channel')
+                continue
+
+            key = self.casefold(name)
+            if key in conn.channels:
+                continue
+
+            channel = self.channels.get(key)
+            if channel is None:
+                channel = self.channels[key] = Channel(name)
+            channel.members[conn] = '' if channel.members else '@'
+            conn.channels.add(key)
+
+            line = ':{0} JOIN {1}\r\n'.format(conn.prefix, channel.name).encode()
+            for member in channel.members:
+                member.write(line)
+            self._names(conn, channel)
+
+    def _part(self, conn, args):
+        if not args:
+            return self.numeric(conn, '461', 'PART', 'Not enough parameters')
+
+        for name in args[0].split(','):
+            key = self.casefold(name)
+            if key not in conn.channels:
+                self.numeric(conn, '442', name, "You're not on that channel")
+            else:
+                self._part_channel(conn, self.channels[key], args[1] if len(args) > 1 else '')
+
+    def _part_channel(self, conn, channel, message):
+        line = ':{0} PART {1}{2}\r\n'.format(
+                conn.prefix, channel.name, message and (' :' + message)).encode()
+        for member in channel.members:
+            member.write(line)
+
+        del channel.members[conn]
+        key = self.casefold(channel.name)
+        conn.channels.discard(key)
+        if not channel.members:
+            del self.channels[key]
+
+    def _privmsg(self, conn, args, command='PRIVMSG'):
+        if not args:
+            return self.numeric(conn, '411', 'No recipient given ({0})'.format(command))
+        if len(args) < 2 or not args[1]:
+            return self.numeric(conn, '412', 'No text to send')
+
+        for target in args[0].split(',')[:4]:
+            key = self.casefold(target)
+            # the line's only encoded once, however many get it
+            line = ':{0} {1} {2} :{3}\r\n'.format(conn.prefix, command, target, args[1]).encode()
+
+            if target[:1] in '#&':
+                channel = self.channels.get(key)
+                if channel is None:
+                    self.numeric(conn, '401', target, 'No such nick/channel')
+                elif conn not in channel.members:
+                    self.numeric(conn, '404', target, 'Cannot send to channel')
+                else:
+                    self.stats['messages'] += 1
+                    for member in channel.members:
+                        if member is not conn:
+                            member.write(line)
+            else:
+                other = self.nicks.get(key)
+                if other is None or not other.registered:
+                    self.numeric(conn, '401', target, 'No such nick/channel')
+                else:
+                    self.stats['messages'] += 1
+                    other.write(line)
+
+    def _notice(self, conn, args):
+        self._privmsg(conn, args, 'NOTICE')
+
+    def _names_command(self, conn, args):
+        for name in args[0].split(',') if args else ():
+            channel = self.channels.get(self.casefold(name))
+            if channel is None:
+                self.numeric(conn, '366', name, 'End of /NAMES list.')
+            else:
+                self._names(conn, channel)
+
+    def _quit(self, conn, args):
+        reason = 'Quit: ' + args[0] if args and args[0] else 'Client Quit'
+        conn.send('ERROR :Closing Link: {0} ({1})'.format(conn.host, reason))
+        self._disconnected(conn, reason)
+        conn.transport.close()
+
+    _commands = {
+        'CAP':     _cap,
+        'NICK':    _nick,
+        'USER':    _user,
+        'PING':    _ping,
+        'PONG':    _pong,
+        'JOIN':    _join,
+        'PART':    _part,
+        'PRIVMSG': _privmsg,
+        'NOTICE':  _notice,
+        'NAMES':   _names_command,
+        'QUIT':    _quit,
+    }
+
+
+### Load testing ###
+
+class LoadClient(IRCClient):
+    """A simulated client: it joins its channel once registered, and
+    notes how long each message it's sent took to arrive"""
+
+    flood_rate   = None
+    capabilities = ()
+    rejoin       = False
+    track_state  = False
+    query_cache_size = 0
+
+    def __init__(self, *args, channel='#load', results=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.channel = channel
+        self.results = results
+
+    def on_welcome(self, event):
+        self.join(self.channel)
+
+    def on_join(self, event):
+        if self.is_me(event.source):
+            self.results.joined(self)
+
+    def on_privmsg(self, event):
+        sent = float(event.message.split(' ', 1)[0])
+        self.results.delivered(time.perf_counter() - sent)
+
+
+class _Results:
+    """What the load test's clients have seen"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.latencies = []
+        self.expected_joins = self.expected_messages = 0
+        self._joins = 0
+        self._waiter = None
+
+    def joined(self, client):
+        self._joins += 1
+        self._check()
+
+    def delivered(self, latency):
+        self.latencies.append(latency)
+        self._check()
+
+    def _check(self):
+        if self._waiter and not self._waiter.done() and \
+                self._joins >= self.expected_joins and \
+                len(self.latencies) >= self.expected_messages:
+            self._waiter.set_result(None)
+
+    async def wait(self, timeout):
+        self._waiter = self.loop.create_future()
+        self._check()
+        await asyncio.wait_for(self._waiter, timeout)
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0.0
+
+
+async def load_test(clients=1000, channels=10, messages=10, interval=0.0,
+                    server=None, client_class=LoadClient, timeout=60):
+    """Connect `clients` simulated clients in memory, spread over
+    `channels` channels, then have each send `messages` messages to its
+    channel, a round of one each every `interval` seconds.  Returns a
+    dict of how long connecting took, how many messages were delivered,
+    how fast, and the delivery latency."""
+    server = server or FakeServer()
+    results = _Results(asyncio.get_running_loop())
+
+    start = time.perf_counter()
+    sims = [client_class('fake', nickname='sim{0}'.format(i), network='sim{0}'.format(i),
+                         channel='#load{0}'.format(i % channels), results=results)
+            for i in range(clients)]
+    results.expected_joins = len(sims)
+    for sim in sims:
+        sim.connector = server.create_connection
+        await sim.connect()
+    await results.wait(timeout)
+    connected = time.perf_counter() - start
+
+    # each message reaches everyone else in the channel
+    sizes = collections.Counter(sim.channel for sim in sims)
+    results.expected_messages = sum(messages * (sizes[sim.channel] - 1) for sim in sims)
+
+    start = time.perf_counter()
+    for n in range(messages):
+        if n:
+            await asyncio.sleep(interval)
+        for sim in sims:
+            sim.privmsg(sim.channel, '{0:.9f} load test message {1}'.format(
+                    time.perf_counter(), n))
+    await results.wait(timeout)
+    elapsed = time.perf_counter() - start
+
+    for sim in sims:
+        sim.quit()
+    await asyncio.sleep(0)
+    await server.close()
+
+    latencies = results.latencies
+    return {
+        'clients':     clients,
+        'connect_time': connected,
+        'sent':        clients * messages,
+        'delivered':   len(latencies),
+        'elapsed':     elapsed,
+        'rate':        len(latencies) / elapsed if elapsed else 0.0,
+        'latency_p50': _percentile(latencies, 50),
+        'latency_p99': _percentile(latencies, 99),
+        'latency_max': max(latencies, default=0.0),
+    }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    args = [int(arg) for arg in sys.argv[1:4]] + [float(arg) for arg in sys.argv[4:5]]
+    result = asyncio.run(load_test(*args))
+    for name, value in result.items():
+        print('{0:14s} {1}'.format(name, value))
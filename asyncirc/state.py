@@ -0,0 +1,377 @@
+"""Channel and user state tracking"""
+
+__all__ = ['StateTracker', 'Channel', 'User']
+
+import sys
+
+from . import protocol
+
+
+class Channel:
+    """A channel we're on.  members maps casefolded nicks to the member's
+    channel modes, as a string of mode letters."""
+
+    __slots__ = ('name', 'key', 'members', '_casefold')
+
+    def __init__(self, name, casefold=protocol.casefold):
+        self.name    = name
+        self.key     = sys.intern(casefold(name))
+        self.members = {}
+
+        self._casefold = casefold
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, nick):
+        return self._casefold(nick) in self.members
+
+
+class User:
+    """A user sharing at least one channel with us.  channels is the set
+    of casefolded names of those channels."""
+
+    __slots__ = ('nick', 'user', 'host', 'channels')
+
+    def __init__(self, nick, user=None, host=None):
+        self.nick     = nick
+        self.user     = user
+        self.host     = host
+        self.channels = set()
+
+
+class StateTracker:
+    """Keeps track of the channels we're on, who's in them, and with
+    which modes, from the messages the client receives.
+
+    Channels and users are indexed by casefolded name both ways, so
+    membership lookups don't need to scan anything.  Member modes are
+    stored as shared strings of mode letters, mostly the empty one.
+    """
+
+    # messages the tracker wants to see
+    commands = frozenset(['JOIN', 'PART', 'KICK', 'QUIT', 'NICK', 'MODE',
+                          '352', '353', '366'])
+
+    def __init__(self, client):
+        self.client   = client
+        self.channels = {}
+        self.users    = {}
+
+        # mode letter -> nick prefix, see ISUPPORT PREFIX
+        self.set_prefixes({'o': '@', 'v': '+'})
+
+        # channel modes which take a parameter when set, and when unset
+        # (besides the prefix modes), see ISUPPORT CHANMODES
+        self.param_modes   = 'beIkl'
+        self.unparam_modes = 'beIk'
+
+        # NAMES replies collected until the end of the list
+        self._names = {}
+
+        self._modes = {'': ''}
+        self._handlers = {
+            'JOIN': self._on_join,
+            'PART': self._on_part,
+            'KICK': self._on_kick,
+            'QUIT': self._on_quit,
+            'NICK': self._on_nick,
+            'MODE': self._on_mode,
+            '352':  self._on_whoreply,
+            '353':  self._on_namreply,
+            '366':  self._on_endofnames,
+        }
+
+
+    ### Queries ###
+
+    def channel(self, name):
+        """Get a Channel, or None if we're not on it"""
+        return self.channels.get(self.client.casefold(name))
+
+    def user(self, nick):
+        """Get a User, or None if we don't share a channel with them"""
+        return self.users.get(self.client.casefold(nick))
+
+    def is_on(self, nick, channel):
+        """Is nick on channel?"""
+        chan = self.channels.get(self.client.casefold(channel))
+        return chan is not None and self.client.casefold(nick) in chan.members
+
+    def members(self, channel):
+        """List the nicks on a channel"""
+        chan = self.channels.get(self.client.casefold(channel))
+        if chan is None:
+            return []
+        users = self.users
+        return [users[key].nick for key in chan.members]
+
+    def modes(self, channel, nick):
+        """Get the channel modes nick has on channel, or None if they're
+        not on it"""
+        chan = self.channels.get(self.client.casefold(channel))
+        if chan is None:
+            return None
+        return chan.members.get(self.client.casefold(nick))
+
+    def common_channels(self, nick):
+        """List the names of the channels nick shares with us"""
+        user = self.users.get(self.client.casefold(nick))
+        if user is None:
+            return []
+        channels = self.channels
+        return [channels[key].name for key in user.channels]
+
+    def clear(self):
+        """Forget everything, e.g. when disconnected"""
+        self.channels.clear()
+        self.users.clear()
+        self._names.clear()
+
+    def refold(self):
+        """Re-key everything with the client's casefold, when the server
+        told us it compares names with a different case mapping"""
+        casefold = self.client.casefold
+
+        users = {}
+        nicks = {}
+        for old, user in self.users.items():
+            nicks[old] = key = sys.intern(casefold(user.nick))
+            users[key] = user
+
+        channels = {}
+        names = {}
+        for old, chan in self.channels.items():
+            chan.key = names[old] = sys.intern(casefold(chan.name))
+            chan._casefold = casefold
+            chan.members = {nicks.get(nick, nick): modes for nick, modes in chan.members.items()}
+            channels[chan.key] = chan
+
+        for user in users.values():
+            user.channels = {names.get(key, key) for key in user.channels}
+
+        self.users    = users
+        self.channels = channels
+        self._names   = {names.get(key, casefold(key)): nicks for key, nicks in self._names.items()}
+
+
+    ### Updates ###
+
+    def set_prefixes(self, prefixes):
+        """Set the member mode letter -> nick prefix mapping, highest
+        ranked first"""
+        self.prefixes = dict(prefixes)
+        self._prefix_modes = {p: m for m, p in self.prefixes.items()}
+
+    def update(self, command, prefix, args):
+        """Update the state from an incoming message"""
+        handler = self._handlers.get(command)
+        if handler:
+            handler(prefix, args)
+
+    def _is_me(self, key):
+        return key == self.client.casefold(self.client.nickname)
+
+    def _intern_modes(self, modes):
+        """Share mode strings between members, there aren't many distinct ones"""
+        return self._modes.setdefault(modes, modes)
+
+    def _add_member(self, chan, nick, user=None, host=None, modes=''):
+        # the same key is used in lots of channels, keep a single copy
+        key = sys.intern(self.client.casefold(nick))
+        u = self.users.get(key)
+        if u is None:
+            u = self.users[key] = User(nick, user, host)
+        elif user:
+            u.user, u.host = user, host
+
+        u.channels.add(chan.key)
+        if key not in chan.members or modes:
+            chan.members[key] = self._intern_modes(modes)
+        return key
+
+    def _remove_member(self, chankey, key):
+        chan = self.channels.get(chankey)
+        if chan is not None:
+            chan.members.pop(key, None)
+
+        u = self.users.get(key)
+        if u is not None:
+            u.channels.discard(chankey)
+            if not u.channels:
+                del self.users[key]
+
+    def _drop_channel(self, chankey):
+        chan = self.channels.pop(chankey, None)
+        if chan is None:
+            return
+
+        for key in chan.members:
+            u = self.users.get(key)
+            if u is not None:
+                u.channels.discard(chankey)
+                if not u.channels:
+                    del self.users[key]
+
+    def _split_prefixes(self, nick):
+        """Split '@+nick' into ('nick', 'ov')"""
+        letters = self._prefix_modes
+        modes = ''
+        while nick and nick[0] in letters:
+            modes += letters[nick[0]]
+            nick = nick[1:]
+        return nick, modes
+
+    def _on_join(self, prefix, args):
+        nick, user, host = protocol.parse_prefix(prefix)
+        if not nick or not args:
+            return
+
+        chankey = self.client.casefold(args[0])
+        chan = self.channels.get(chankey)
+        if chan is None:
+            if not self._is_me(self.client.casefold(nick)):
+                return
+            chan = Channel(args[0], self.client.casefold)
+            self.channels[chan.key] = chan
+
+        self._add_member(chan, nick, user, host)
+
+    def _on_part(self, prefix, args):
+        nick = protocol.parse_prefix(prefix)[0]
+        if not nick or not args:
+            return
+
+        key = self.client.casefold(nick)
+        for channel in args[0].split(','):
+            chankey = self.client.casefold(channel)
+            if self._is_me(key):
+                self._drop_channel(chankey)
+            else:
+                self._remove_member(chankey, key)
+
+    def _on_kick(self, prefix, args):
+        if len(args) < 2:
+            return
+
+        chankey = self.client.casefold(args[0])
+        key = self.client.casefold(args[1])
+        if self._is_me(key):
+            self._drop_channel(chankey)
+        else:
+            self._remove_member(chankey, key)
+
+    def _on_quit(self, prefix, args):
+        nick = protocol.parse_prefix(prefix)[0]
+        if not nick:
+            return
+
+        key = self.client.casefold(nick)
+        u = self.users.pop(key, None)
+        if u is None:
+            return
+
+        for chankey in u.channels:
+            chan = self.channels.get(chankey)
+            if chan is not None:
+                chan.members.pop(key, None)
+
+    def _on_nick(self, prefix, args):
+        nick = protocol.parse_prefix(prefix)[0]
+        if not nick or not args:
+            return
+
+        key = self.client.casefold(nick)
+        u = self.users.pop(key, None)
+        if u is None:
+            return
+
+        newkey = sys.intern(self.client.casefold(args[0]))
+        u.nick = args[0]
+        self.users[newkey] = u
+
+        for chankey in u.channels:
+            members = self.channels[chankey].members
+            members[newkey] = members.pop(key, '')
+
+    def _on_mode(self, prefix, args):
+        if len(args) < 2:
+            return
+
+        chan = self.channels.get(self.client.casefold(args[0]))
+        if chan is None:
+            return
+
+        prefixes = self.prefixes
+        params = iter(args[2:])
+        adding = True
+        for mode in args[1]:
+            if mode in '+-':
+                adding = (mode == '+')
+
+            elif mode in prefixes:
+                nick = next(params, None)
+                key = nick and self.client.casefold(nick)
+                if key not in chan.members:
+                    continue
+
+                modes = chan.members[key].replace(mode, '')
+                if adding:
+                    # keep the letters in rank order
+                    modes = ''.join(m for m in prefixes if m in modes or m == mode)
+                chan.members[key] = self._intern_modes(modes)
+
+            elif mode in (self.param_modes if adding else self.unparam_modes):
+                next(params, None)
+
+    def _on_whoreply(self, prefix, args):
+        # me #chan user host server nick flags :hops realname
+        if len(args) < 7:
+            return
+
+        channel, user, host, nick, flags = args[1], args[2], args[3], args[5], args[6]
+        u = self.users.get(self.client.casefold(nick))
+        if u is not None:
+            u.user, u.host = user, host
+
+        chan = self.channels.get(self.client.casefold(channel))
+        if chan is not None:
+            # flags are H/G, maybe *, then the member prefixes
+            modes = self._split_prefixes(flags.lstrip('HG*'))[1]
+            self._add_member(chan, nick, user, host, modes)
+
+    def _on_namreply(self, prefix, args):
+        # me = #chan :@nick +nick nick
+        if len(args) < 4:
+            return
+
+        chankey = self.client.casefold(args[2])
+        if chankey not in self.channels:
+            return
+
+        names = self._names.setdefault(chankey, [])
+        names.extend(args[3].split())
+
+    def _on_endofnames(self, prefix, args):
+        # me #chan :End of /NAMES list.
+        if len(args) < 2:
+            return
+
+        chankey = self.client.casefold(args[1])
+        names = self._names.pop(chankey, None)
+        chan = self.channels.get(chankey)
+        if names is None or chan is None:
+            return
+
+        # the reply is the full list, so forget anyone not in it
+        old = chan.members
+        chan.members = {}
+        for name in names:
+            nick, modes = self._split_prefixes(name)
+            # userhost-in-names gives nick!user@host
+            nick, user, host = protocol.parse_prefix(nick) if '!' in nick else (nick, None, None)
+            self._add_member(chan, nick, user, host, modes)
+
+        for key in old:
+            if key not in chan.members:
+                self._remove_member(chankey, key)
@@ -0,0 +1,107 @@
+"""Running coroutine handlers as tasks, with bounded concurrency"""
+
+__all__ = ['HandlerRunner', 'GLOBAL', 'PER_CHANNEL']
+
+import asyncio, logging, time
+
+log = logging.getLogger(__name__)
+
+# what the concurrency limit applies to
+GLOBAL      = 'global'
+PER_CHANNEL = 'channel'
+
+
+class HandlerRunner:
+    """Runs async def handlers as tasks.
+
+    At most `limit` handlers run at once, either in total (GLOBAL), or
+    for each channel (PER_CHANNEL, private messages count per sender).
+    The rest wait their turn, in order.  With `ordered` set, each
+    source's events are handled one after another in the order they
+    arrived, so a handler never overtakes the one before it.
+
+    Whatever a handler returns, if anything, is sent as a raw line, like
+    for plain handlers.
+    """
+
+    def __init__(self, client, limit=10, scope=GLOBAL, ordered=False):
+        if scope not in (GLOBAL, PER_CHANNEL):
+            raise ValueError("unknown concurrency scope {0}".format(scope))
+
+        self.client  = client
+        self.limit   = limit
+        self.scope   = scope
+        self.ordered = ordered
+
+        self.tasks = set()
+
+        # scope key -> semaphore, and source -> its newest task
+        self._limits = {}
+        self._last   = {}
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def submit(self, handler, event, respond=True):
+        """Start handling an event, returns the task"""
+        source = event.source if self.ordered else None
+        previous = self._last.get(source) if source else None
+
+        task = self.client.loop.create_task(self._run(
+                handler, event, respond, self._key(event), previous, time.perf_counter()))
+        self.tasks.add(task)
+        task.add_done_callback(self._done)
+
+        if source:
+            self._last[source] = task
+            task.add_done_callback(lambda task: self._forget(source, task))
+        return task
+
+    def cancel_all(self):
+        """Cancel every handler that's still running or waiting"""
+        for task in list(self.tasks):
+            task.cancel()
+
+    def _key(self, event):
+        if self.scope == GLOBAL:
+            return None
+        target = event.target
+        if target and target[0] in self.client.isupport.chantypes:
+            return self.client.casefold(target)
+        return event.source
+
+    async def _run(self, handler, event, respond, key, previous, queued):
+        if previous is not None:
+            # the source's previous event goes first, however that ends
+            await asyncio.wait([previous])
+
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = self._limits[key] = [asyncio.Semaphore(self.limit), 0]
+
+        # count who's using the semaphore, so idle ones can be dropped
+        limit[1] += 1
+        try:
+            async with limit[0]:
+                response = await handler(self.client, event)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('*** handler {0} failed'.format(handler.__name__))
+            return
+        finally:
+            limit[1] -= 1
+            if not limit[1]:
+                del self._limits[key]
+            if self.client.metrics is not None:
+                self.client.metrics.handler_latency.observe(time.perf_counter() - queued)
+
+        if response and respond:
+            self.client._send(response)
+
+    def _done(self, task):
+        self.tasks.discard(task)
+
+    def _forget(self, source, task):
+        if self._last.get(source) is task:
+            del self._last[source]
@@ -0,0 +1,287 @@
+"""Benchmarks for the asyncirc receive path.  Run with:
+
+    python bench.py [-t traffic.log] [stage ...]
+
+Each stage (linebuffer, parse, event, dispatch) is run against synthetic
+traffic corpora: PRIVMSG floods, NAMES bursts, IRCv3 tagged lines, CTCP,
+and a mix of everything, or a recorded traffic log given with -t.
+
+For each we report lines/sec, the memory blocks still allocated per line
+when the stage's output is kept around (a proxy for allocations per
+line), and for dispatch the p50/p99 latency from data_received() to the
+handler being called.
+
+With --load, many simulated clients are also run against the in-process
+server in asyncirc.server, to measure end to end message throughput and
+latency.
+"""
+
+import argparse, asyncio, gc, logging, random, sys, time
+from asyncirc import buffer, events, protocol, server, IRCClient
+
+CHUNK = 4096
+LINE  = b':nick!user@example.com PRIVMSG #channel :hello there, this is a line\r\n'
+
+
+### Traffic corpora ###
+
+def _nicks(rnd, count=500):
+    return ['{0}{1}'.format(rnd.choice(['nick', 'Bot', 'user[', 'x_']), i)
+            for i in range(count)]
+
+def _source(rnd, nicks, i):
+    nick = rnd.choice(nicks)
+    return '{0}!~{0}@host{1}.example.com'.format(nick, i % 97)
+
+
+def privmsg_flood(count, rnd):
+    nicks = _nicks(rnd)
+    for i in range(count):
+        yield ':{0} PRIVMSG #chan{1} :message number {2} with some words in it'.format(
+                _source(rnd, nicks, i), i % 20, i)
+
+def names_burst(count, rnd):
+    nicks = _nicks(rnd, 10000)
+    prefixes = ['', '', '', '', '+', '@']
+    names = [rnd.choice(prefixes) + nick for nick in nicks]
+    for i in range(count):
+        chunk = names[(i * 50) % 10000:][:50]
+        yield ':irc.example.com 353 me = #big :{0}'.format(' '.join(chunk))
+
+def tagged(count, rnd):
+    nicks = _nicks(rnd)
+    for i in range(count):
+        yield ('@time=2026-10-18T05:28:{0:02d}.{1:03d}Z;msgid=abc{1};account={2} '
+               ':{3} PRIVMSG #chan{4} :tagged message {1}').format(
+                i % 60, i, rnd.choice(nicks), _source(rnd, nicks, i), i % 20)
+
+def ctcp(count, rnd):
+    nicks = _nicks(rnd)
+    kinds = ['ACTION waves at everyone', 'VERSION', 'PING 1234567890', 'ACTION yawns']
+    for i in range(count):
+        yield ':{0} PRIVMSG #chan{1} :\x01{2}\x01'.format(
+                _source(rnd, nicks, i), i % 20, rnd.choice(kinds))
+
+def mixed(count, rnd):
+    nicks = _nicks(rnd)
+    names = ' '.join(nicks[:100])
+    for i in range(count):
+        src = _source(rnd, nicks, i)
+        kind = rnd.random()
+        if kind < 0.6:
+            yield ':{0} PRIVMSG #chan{1} :message number {2} with some words'.format(
+                    src, i % 20, i)
+        elif kind < 0.65:
+            yield ':{0} PRIVMSG #chan{1} :\x01ACTION waves\x01'.format(src, i % 20)
+        elif kind < 0.75:
+            yield ':{0} JOIN #chan{1}'.format(src, i % 20)
+        elif kind < 0.8:
+            yield ':{0} QUIT :Quit: bye'.format(src)
+        elif kind < 0.85:
+            yield ':irc.example.com 353 me = #chan{0} :{1}'.format(i % 20, names)
+        elif kind < 0.95:
+            # no handler for these, they should be dropped cheaply
+            yield ':{0} AWAY :gone'.format(src)
+        else:
+            yield 'PING :irc.example.com'
+
+CORPORA = [('privmsg', privmsg_flood), ('names', names_burst), ('tagged', tagged),
+           ('ctcp', ctcp), ('mixed', mixed)]
+
+
+def synthetic_traffic(kind=mixed, count=100000, seed=1):
+    """Generate a traffic log, as bytes off the wire"""
+    lines = kind(count, random.Random(seed))
+    return ('\r\n'.join(lines) + '\r\n').encode()
+
+
+### Stages ###
+# each takes its input, and calls keep() with whatever it produces
+
+def split_lines(data):
+    """All the complete lines in data"""
+    buf = buffer.LineBuffer()
+    buf.push(data)
+    return list(buf)
+
+
+def stage_linebuffer(data, keep):
+    """Push data through a LineBuffer in socket-sized reads"""
+    buf = buffer.LineBuffer(max_line_length=8703)
+    for i in range(0, len(data), CHUNK):
+        buf.push(data[i:i + CHUNK])
+        for line in buf:
+            keep(line)
+
+
+def stage_parse(lines, keep):
+    """Parse decoded lines"""
+    parse = protocol.parse
+    for line in lines:
+        keep(parse(line))
+
+
+def stage_event(parsed, keep):
+    """Build events from parsed lines"""
+    Event, MessageEvent = events.Event, events.MessageEvent
+    for tags, prefix, command, args in parsed:
+        if command == 'PRIVMSG':
+            keep(MessageEvent(prefix, command, args, tags))
+        else:
+            keep(Event(prefix, command.lower(), args, tags))
+
+
+class FakeTransport:
+    """Transport stand-in that just counts what gets written"""
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+
+class ReplayClient(IRCClient):
+    """Client with a few typical bot handlers, which record how long it
+    took for each event to reach them"""
+    flood_rate = None
+
+    received = 0
+    latencies = None
+    keep = None
+
+    def _record(self, event):
+        self.latencies.append(time.perf_counter() - self.received)
+        if self.keep:
+            self.keep(event)
+
+    on_join = on_part = on_quit = on_mode = on_namreply = on_privmsg = _record
+    on_ctcp_action = _record
+
+
+def stage_dispatch(data, keep=None, latencies=None):
+    """Replay traffic through IRCClient.data_received"""
+    loop = asyncio.new_event_loop()
+    client = ReplayClient('localhost', loop=loop)
+    client.transport = FakeTransport()
+    client.connected = True
+    client.latencies = [] if latencies is None else latencies
+    client.keep = keep
+
+    for i in range(0, len(data), CHUNK):
+        client.received = time.perf_counter()
+        client.data_received(data[i:i + CHUNK])
+
+        # let the scheduled handlers run
+        loop.call_soon(loop.stop)
+        loop.run_forever()
+
+    loop.close()
+
+
+### Measurement ###
+
+def measure(stage, data, count):
+    """Time a stage, then count the blocks its retained output takes"""
+    gc.collect()
+    start = time.perf_counter()
+    stage(data, lambda item: None)
+    elapsed = time.perf_counter() - start
+
+    kept = []
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    stage(data, kept.append)
+    blocks = sys.getallocatedblocks() - blocks
+
+    return count / elapsed, blocks / count
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def run(stages, corpora):
+    print('{0:10s} {1:10s} {2:>12s} {3:>12s} {4:>10s} {5:>10s}'.format(
+            'stage', 'corpus', 'lines/s', 'blocks/line', 'p50 us', 'p99 us'))
+
+    for name, data in corpora:
+        lines = split_lines(data)
+        count = len(lines)
+        inputs = {
+            'linebuffer': data,
+            'parse':      [line.decode() for line in lines],
+            'event':      [protocol.parse(line.decode()) for line in lines],
+            'dispatch':   data,
+        }
+
+        for stage in stages:
+            rate, blocks = measure(globals()['stage_' + stage], inputs[stage], count)
+            p50 = p99 = ''
+            if stage == 'dispatch':
+                latencies = []
+                stage_dispatch(data, latencies=latencies)
+                if latencies:
+                    p50 = '{0:.1f}'.format(percentile(latencies, 50) * 1e6)
+                    p99 = '{0:.1f}'.format(percentile(latencies, 99) * 1e6)
+
+            print('{0:10s} {1:10s} {2:12.0f} {3:12.1f} {4:>10s} {5:>10s}'.format(
+                    stage, name, rate, blocks, p50, p99))
+
+
+def bench_linebuffer_scaling(sizes=(1, 2, 4, 8, 16)):
+    """LineBuffer throughput on multi-megabyte bursts, should be linear"""
+    print('LineBuffer: {0}-byte reads'.format(CHUNK))
+    for mb in sizes:
+        data = LINE * (mb * 1024 * 1024 // len(LINE))
+
+        start = time.perf_counter()
+        stage_linebuffer(data, lambda line: None)
+        elapsed = time.perf_counter() - start
+
+        print('  {0:3d} MB  {1:7.3f}s  {2:7.1f} MB/s'.format(
+                mb, elapsed, len(data) / elapsed / 1048576))
+
+
+def bench_load(clients, channels=None, messages=5, interval=0.5):
+    """Simulated clients talking through the fake server"""
+    channels = channels or max(1, clients // 10)
+    print('Load: {0} clients in {1} channels, {2} messages each'.format(
+            clients, channels, messages))
+    result = asyncio.run(server.load_test(clients, channels, messages, interval))
+    print('  connected in {0:.2f}s, {1} delivered at {2:.0f}/s, '
+          'latency p50 {3:.1f}ms p99 {4:.1f}ms'.format(
+            result['connect_time'], result['delivered'], result['rate'],
+            result['latency_p50'] * 1000, result['latency_p99'] * 1000))
+
+
+if __name__ == '__main__':
+    stages = ['linebuffer', 'parse', 'event', 'dispatch']
+
+    parser = argparse.ArgumentParser(description='asyncirc benchmarks')
+    parser.add_argument('-t', '--traffic', help='recorded traffic log to replay')
+    parser.add_argument('-n', '--lines', type=int, default=100000,
+                        help='lines per synthetic corpus')
+    parser.add_argument('--scaling', action='store_true',
+                        help='also check LineBuffer scaling on big bursts')
+    parser.add_argument('--load', type=int, metavar='CLIENTS',
+                        help='also run this many clients against the fake server')
+    parser.add_argument('stage', nargs='*', help=', '.join(stages))
+    opts = parser.parse_args()
+
+    for stage in opts.stage:
+        if stage not in stages:
+            parser.error('unknown stage {0}'.format(stage))
+
+    if opts.traffic:
+        with open(opts.traffic, 'rb') as f:
+            corpora = [('recorded', f.read())]
+    else:
+        corpora = [(name, synthetic_traffic(kind, opts.lines)) for name, kind in CORPORA]
+
+    run(opts.stage or stages, corpora)
+    if opts.scaling:
+        bench_linebuffer_scaling()
+    if opts.load:
+        logging.basicConfig(level=logging.CRITICAL)
+        bench_load(opts.load)
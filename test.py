@@ -1,6 +1,7 @@
 
-import datetime, re, sys
-from asyncirc import IRCClient
+import asyncio, datetime, re, sys
+from asyncirc import IRCClient, use_uvloop
+from asyncirc.routes import command
 
 class Client(IRCClient):
 
@@ -23,14 +24,14 @@ class Client(IRCClient):
 
     def on_join(self, event):
 
-        if event.source == self.nickname:
+        if self.is_me(event.source):
             print('*** joined channel {0}'.format(event.target))
         else:
             print('*** {0} has joined channel {1}'.format(event.source, event.target))
 
 
         # TODO run some tests upon joining #test
-        if (event.source == self.nickname and event.target == '#test'):
+        if self.is_me(event.source) and event.target_key == self.casefold('#test'):
             self.run_tests(event.target)
 
 
@@ -57,26 +58,32 @@ class Client(IRCClient):
 
 
     def on_privmsg(self, event):
-
         print('<{0}/{1}> {2}'.format(event.source, event.target, event.message))
 
-        # TODO handle commands and such
-        if event.source == 'michael' and event.message.startswith(self.nickname + ':'):
-            msg = event.message.lstrip(self.nickname + ':').lstrip()
 
-            if msg.startswith('quit'):
-                self.privmsg(event.target, "Okay, {0}.  Seeya.".format(event.source))
-                self.quit()
+    ### bot commands, addressed to us as "nick: command" ###
+    command_prefixes = ()
+
+    def from_owner(self, event):
+        return event.source_key == self.casefold('michael')
+
+    @command('quit')
+    def cmd_quit(self, event):
+        if self.from_owner(event):
+            self.privmsg(event.target, "Okay, {0}.  Seeya.".format(event.source))
+            self.quit()
 
-            elif msg.startswith('join'):
-                m = re.match('join\s+(#\S+)')
-                if m:
-                    self.join(m.group(0))
+    @command('join', rate=(3, 60))
+    def cmd_join(self, event):
+        m = re.match(r'(#\S+)', event.match.args)
+        if m and self.from_owner(event):
+            self.join(m.group(1))
 
-            elif msg.startswith('part'):
-                m = re.match('part\s+(#\S+)')
-                if m:
-                    self.part(m.group(0))
+    @command('part', rate=(3, 60))
+    def cmd_part(self, event):
+        m = re.match(r'(#\S+)', event.match.args)
+        if m and self.from_owner(event):
+            self.part(m.group(1))
 
 
     def on_topic(self, event):
@@ -103,16 +110,28 @@ class Client(IRCClient):
 
         # test some delayed/at methods
         self.privmsg_delayed(60, target, "test 01: delayed message")
-        self.privmsg_at(datetime.datetime.now() + datetime.timedelta(minutes=2),
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.privmsg_at(now + datetime.timedelta(minutes=2),
                         target, "test 02: at message")
 
 
 
+async def main(conn):
+    try:
+        await conn.run()
+    except asyncio.CancelledError:
+        # asyncio.run() cancels us on Ctrl-C, say goodbye while we can
+        if conn.connected:
+            conn.quit("Caught SIGINT")
+            conn.flush()
+        raise
+
+
 if __name__ == '__main__':
+    use_uvloop()
     conn = Client(sys.argv[1], int(sys.argv[2]))
     try:
-        conn.run()
+        asyncio.run(main(conn))
     except KeyboardInterrupt:
-        conn.quit("Caught SIGINT")
         sys.exit(0)
 
@@ -0,0 +1,68 @@
+"""Send queue ordering and flood control"""
+
+import asyncio, unittest
+
+from asyncirc import flood
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class SendQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.written = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def queue(self, rate=None, burst=1):
+        queue = flood.SendQueue(self.loop, self.written.append, rate, burst)
+        if rate:
+            self.clock = Clock()
+            queue.bucket = flood.TokenBucket(rate, burst, self.clock)
+        return queue
+
+    def lines(self):
+        return b''.join(self.written).split(b'\r\n')[:-1]
+
+    def test_unthrottled_keeps_send_order(self):
+        queue = self.queue()
+        queue.push(b'PRIVMSG #a :bye\r\n', flood.PRIORITY_LOW)
+        queue.push(b'QUIT\r\n', flood.PRIORITY_HIGH)
+        queue.flush()
+        self.assertEqual(self.lines(), [b'PRIVMSG #a :bye', b'QUIT'])
+
+    def test_order_kept_within_the_burst(self):
+        queue = self.queue(rate=1, burst=3)
+        queue.push(b'PRIVMSG NickServ :IDENTIFY pass\r\n', flood.PRIORITY_LOW)
+        queue.push(b'JOIN #registered\r\n')
+        queue.flush()
+        self.assertEqual(self.lines(), [b'PRIVMSG NickServ :IDENTIFY pass', b'JOIN #registered'])
+
+    def test_higher_lanes_jump_what_is_held_back(self):
+        queue = self.queue(rate=1, burst=1)
+        for i in range(3):
+            queue.push('PRIVMSG #a :{0}\r\n'.format(i).encode(), flood.PRIORITY_LOW)
+        queue.flush()
+        self.assertEqual(self.lines(), [b'PRIVMSG #a :0'])
+
+        queue.push(b'PONG :s\r\n', flood.PRIORITY_HIGH)
+        self.clock.now += 1
+        queue.flush()
+        self.assertEqual(self.lines()[1:], [b'PONG :s'])
+
+        for _ in range(2):
+            self.clock.now += 1
+            queue.flush()
+        self.assertEqual(self.lines()[2:], [b'PRIVMSG #a :1', b'PRIVMSG #a :2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
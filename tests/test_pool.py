@@ -0,0 +1,51 @@
+"""Running and shutting down a pool of clients against the fake server"""
+
+import asyncio, logging, unittest
+
+from asyncirc import IRCClient
+from asyncirc.pool import IRCPool
+from asyncirc.server import FakeServer
+
+logging.getLogger('asyncirc').setLevel(logging.CRITICAL)
+
+
+class Client(IRCClient):
+    flood_rate = None
+
+
+class PoolTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = FakeServer()
+        self.pool = IRCPool()
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    def client(self, network, connector=None):
+        client = Client('fake', nickname=network)
+        client.connector = connector or self.server.create_connection
+        return self.pool.add(client, network)
+
+    async def test_shutdown_while_still_connecting(self):
+        async def slow(*args, **kwargs):
+            await asyncio.sleep(0.3)
+            return await self.server.create_connection(*args, **kwargs)
+
+        fast = self.client('fast')
+        slow = self.client('slow', slow)
+        running = asyncio.ensure_future(self.pool.run())
+        while not fast.connected:
+            await asyncio.sleep(0.01)
+
+        self.pool.shutdown('bye', timeout=0.1)
+        await asyncio.wait_for(running, 1)
+        await asyncio.sleep(0.4)
+
+        self.assertFalse(fast.connected)
+        self.assertFalse(slow.connected)
+        self.assertEqual(self.server.stats['connections'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""The message parser, against what the parser it replaced returned"""
+
+import unittest
+
+from asyncirc import protocol
+
+# well-formed lines, and the (tags, prefix, verb, args) the original
+# split-based parser gave for them
+CORPUS = [
+    (':irc.example.com 001 me :Welcome to the Example IRC Network me',
+     ({}, 'irc.example.com', '001', ['me', 'Welcome to the Example IRC Network me'])),
+    (':irc.example.com 005 me CHANTYPES=# PREFIX=(ov)@+ NETWORK=Example :are supported by this server',
+     ({}, 'irc.example.com', '005', ['me', 'CHANTYPES=#', 'PREFIX=(ov)@+', 'NETWORK=Example',
+                                     'are supported by this server'])),
+    (':irc.example.com 353 me = #chan :@op +voice plain',
+     ({}, 'irc.example.com', '353', ['me', '=', '#chan', '@op +voice plain'])),
+    (':irc.example.com 366 me #chan :End of /NAMES list.',
+     ({}, 'irc.example.com', '366', ['me', '#chan', 'End of /NAMES list.'])),
+    (':nick!user@host PRIVMSG #chan :hello there',
+     ({}, 'nick!user@host', 'PRIVMSG', ['#chan', 'hello there'])),
+    (':nick!user@host PRIVMSG #chan ::)',
+     ({}, 'nick!user@host', 'PRIVMSG', ['#chan', ':)'])),
+    (':nick!user@host PRIVMSG #chan :',
+     ({}, 'nick!user@host', 'PRIVMSG', ['#chan', ''])),
+    (':nick!user@host PRIVMSG #chan :two  spaces, and a : colon',
+     ({}, 'nick!user@host', 'PRIVMSG', ['#chan', 'two  spaces, and a : colon'])),
+    (':nick!user@host PRIVMSG #chan :\x01ACTION waves\x01',
+     ({}, 'nick!user@host', 'PRIVMSG', ['#chan', '\x01ACTION waves\x01'])),
+    (':nick!user@host PRIVMSG #chan :#chan',
+     ({}, 'nick!user@host', 'PRIVMSG', ['#chan', '#chan'])),
+    (':op!user@host MODE #chan +oo nick nick',
+     ({}, 'op!user@host', 'MODE', ['#chan', '+oo', 'nick', 'nick'])),
+    (':op!user@host MODE #chan +ov-v nick nick other',
+     ({}, 'op!user@host', 'MODE', ['#chan', '+ov-v', 'nick', 'nick', 'other'])),
+    (':nick!user@host JOIN #chan',
+     ({}, 'nick!user@host', 'JOIN', ['#chan'])),
+    (':nick!user@host JOIN :#chan',
+     ({}, 'nick!user@host', 'JOIN', ['#chan'])),
+    (':nick!user@host QUIT :Quit: bye',
+     ({}, 'nick!user@host', 'QUIT', ['Quit: bye'])),
+    (':nick!user@host NICK :other',
+     ({}, 'nick!user@host', 'NICK', ['other'])),
+    (':op!user@host KICK #chan nick :nick',
+     ({}, 'op!user@host', 'KICK', ['#chan', 'nick', 'nick'])),
+    ('PING :irc.example.com',
+     ({}, '', 'PING', ['irc.example.com'])),
+    ('PING irc.example.com',
+     ({}, '', 'PING', ['irc.example.com'])),
+    ('ERROR :Closing Link: me (Excess Flood)',
+     ({}, '', 'ERROR', ['Closing Link: me (Excess Flood)'])),
+    ('@time=2020-01-01T00:00:00.000Z :nick!user@host PRIVMSG #chan :tagged',
+     ({'time': '2020-01-01T00:00:00.000Z'}, 'nick!user@host', 'PRIVMSG', ['#chan', 'tagged'])),
+    ('@account=nick :nick!user@host JOIN #chan',
+     ({'account': 'nick'}, 'nick!user@host', 'JOIN', ['#chan'])),
+    ('@msgid=abc PRIVMSG #chan :no prefix',
+     ({'msgid': 'abc'}, '', 'PRIVMSG', ['#chan', 'no prefix'])),
+]
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_parse_matches_the_old_parser(self):
+        for line, expected in CORPUS:
+            with self.subTest(line=line):
+                self.assertEqual(protocol.parse(line), expected)
+
+    def test_parse_bytes_matches_the_old_parser(self):
+        for line, expected in CORPUS:
+            with self.subTest(line=line):
+                self.assertEqual(protocol.parse_bytes(line.encode()), expected)
+
+    def test_verb_bytes(self):
+        for line, expected in CORPUS:
+            with self.subTest(line=line):
+                self.assertEqual(protocol.verb_bytes(line.encode()), expected[2].encode())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+"""Awaitable queries, fed numerics straight into the client"""
+
+import asyncio, logging, unittest
+
+from asyncirc import IRCClient
+
+logging.getLogger('asyncirc').setLevel(logging.CRITICAL)
+
+
+class Transport:
+    """Collects the lines the client writes"""
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data):
+        self.lines.extend(data.decode().split('\r\n')[:-1])
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class Client(IRCClient):
+    flood_rate    = None
+    capabilities  = ()
+    query_timeout = 0.05
+
+
+class QueryTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.client = Client('fake', nickname='me')
+        self.client._bind(asyncio.get_running_loop())
+        self.transport = Transport()
+        self.client.connection_made(self.transport)
+        self.feed(':s 001 me :Welcome',
+                  ':s 005 me TARGMAX=WHO:5,LIST:5 :are supported')
+        await self.settle()
+        self.transport.lines.clear()
+
+    async def asyncTearDown(self):
+        self.client.reconnect = False
+        self.client.queries.cancel_all(ConnectionResetError())
+
+    def feed(self, *lines):
+        self.client.data_received(''.join(line + '\r\n' for line in lines).encode())
+
+    async def settle(self):
+        """Let queries made this iteration go out"""
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+    def sent(self, command):
+        return [line for line in self.transport.lines if line.split()[0] == command]
+
+    async def test_identical_queries_share_a_command(self):
+        first = asyncio.ensure_future(self.client.whois_async('Nick'))
+        second = asyncio.ensure_future(self.client.whois_async('nick'))
+        await self.settle()
+        self.assertEqual(self.sent('WHOIS'), ['WHOIS Nick'])
+
+        self.feed(':s 311 me Nick user host * :Real Name',
+                  ':s 318 me Nick :End of /WHOIS list.')
+        reply = await first
+        self.assertIs(await second, reply)
+        self.assertEqual((reply.nick, reply.user, reply.host, reply.realname),
+                         ('Nick', 'user', 'host', 'Real Name'))
+
+    async def test_list_replies_go_to_their_channel(self):
+        a = asyncio.ensure_future(self.client.list_async('#a'))
+        b = asyncio.ensure_future(self.client.list_async('#b'))
+        await self.settle()
+        self.assertEqual(self.sent('LIST'), ['LIST #a,#b'])
+
+        self.feed(':s 322 me #b 5 :bee',
+                  ':s 322 me #a 3 :ay',
+                  ':s 323 me :End of /LIST')
+        self.assertEqual([(e.channel, e.users) for e in await a], [('#a', 3)])
+        self.assertEqual([(e.channel, e.users) for e in await b], [('#b', 5)])
+
+    async def test_list_of_everything(self):
+        everything = asyncio.ensure_future(self.client.list_async())
+        await self.settle()
+        self.assertEqual(self.sent('LIST'), ['LIST'])
+
+        self.feed(':s 322 me #a 3 :ay',
+                  ':s 322 me #b 5 :bee',
+                  ':s 323 me :End of /LIST')
+        self.assertEqual([e.channel for e in await everything], ['#a', '#b'])
+
+    async def test_batched_who_for_nicks(self):
+        one = asyncio.ensure_future(self.client.who_async('one'))
+        two = asyncio.ensure_future(self.client.who_async('two'))
+        await self.settle()
+        self.assertEqual(self.sent('WHO'), ['WHO one,two'])
+
+        self.feed(':s 352 me * u2 h2 s two H :0 Two',
+                  ':s 352 me #chan u1 h1 s one H :0 One',
+                  ':s 315 me one,two :End of /WHO list.')
+        self.assertEqual([r.nick for r in await one], ['one'])
+        self.assertEqual([r.nick for r in await two], ['two'])
+
+    async def test_userhost_misses(self):
+        here = asyncio.ensure_future(self.client.userhost_async('here'))
+        gone = asyncio.ensure_future(self.client.userhost_async('gone'))
+        await self.settle()
+        self.assertEqual(self.sent('USERHOST'), ['USERHOST here gone'])
+
+        self.feed(':s 302 me :here*=-user@host')
+        reply = await here
+        self.assertEqual((reply.nick, reply.user, reply.host, reply.operator, reply.away),
+                         ('here', 'user', 'host', True, True))
+        self.assertIsNone(await gone)
+
+    async def test_late_replies_after_a_timeout(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.client.who_async('#slow')
+
+        fast = asyncio.ensure_future(self.client.who_async('#fast'))
+        await self.settle()
+        self.feed(':s 352 me #slow u h s late H :0 Late',
+                  ':s 315 me #slow :End of /WHO list.',
+                  ':s 352 me #fast u h s quick H :0 Quick',
+                  ':s 315 me #fast :End of /WHO list.')
+        self.assertEqual([r.nick for r in await fast], ['quick'])
+        self.assertEqual(len(self.client.queries), 0)
+
+    async def test_cache_hits_and_nick_changes(self):
+        first = asyncio.ensure_future(self.client.whois_async('nick'))
+        await self.settle()
+        self.feed(':s 311 me nick user host * :Real Name',
+                  ':s 318 me nick :End of /WHOIS list.')
+        reply = await first
+
+        self.assertIs(await self.client.whois_async('NICK'), reply)
+        self.assertEqual(len(self.sent('WHOIS')), 1)
+
+        self.feed(':nick!user@host NICK other')
+        again = asyncio.ensure_future(self.client.whois_async('nick'))
+        await self.settle()
+        self.assertEqual(len(self.sent('WHOIS')), 2)
+        self.feed(':s 401 me nick :No such nick',
+                  ':s 318 me nick :End of /WHOIS list.')
+        self.assertIsNone(await again)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""Reconnecting with backoff, and rejoining, against the fake server"""
+
+import asyncio, logging, unittest
+
+from asyncirc import IRCClient
+from asyncirc.server import FakeServer
+
+logging.getLogger('asyncirc').setLevel(logging.CRITICAL)
+
+
+class Client(IRCClient):
+    flood_rate      = None
+    reconnect_delay = 0.02
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.attempts = []
+
+    def on_reconnecting(self, attempt, delay):
+        self.attempts.append((attempt, delay))
+
+
+async def wait_for(condition, timeout=2):
+    """Wait until condition() is true"""
+    loop = asyncio.get_running_loop()
+    end = loop.time() + timeout
+    while not condition():
+        if loop.time() > end:
+            raise AssertionError('timed out waiting')
+        await asyncio.sleep(0.005)
+
+
+class ReconnectTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = FakeServer()
+        self.client = Client('fake', nickname='bot')
+        self.client.connector = self.server.create_connection
+
+    async def asyncTearDown(self):
+        self.client.reconnect = False
+        self.client.cancel_reconnect()
+        await self.server.close()
+
+    def members(self, channel):
+        channel = self.server.channels.get(self.server.casefold(channel))
+        return sorted(conn.nick for conn in channel.members) if channel else []
+
+    async def test_rejoin_after_kill(self):
+        await self.client.connect()
+        await wait_for(lambda: self.client.nickname in [c.nick for c in self.server.connections
+                                                        if c.registered])
+        self.client.join(['#a', '#b'])
+        self.client.join('#keyed', 'sekrit')
+        await wait_for(lambda: self.members('#keyed') == ['bot'])
+
+        # a channel we left shouldn't come back
+        self.client.part('#b')
+        await wait_for(lambda: self.members('#b') == [])
+
+        self.server.kill('bot', 'testing')
+        await wait_for(lambda: self.server.stats['connections'] == 2 and
+                               self.members('#a') == ['bot'])
+        await wait_for(lambda: self.members('#keyed') == ['bot'])
+
+        self.assertEqual(len(self.client.attempts), 1)
+        attempt, delay = self.client.attempts[0]
+        self.assertEqual(attempt, 1)
+        self.assertTrue(Client.reconnect_delay / 2 <= delay <= Client.reconnect_delay)
+
+        self.assertEqual(self.members('#b'), [])
+        self.assertEqual(sorted(self.client.joined), ['#a', '#keyed'])
+        self.assertEqual(self.client.joined['#keyed'], ('#keyed', 'sekrit'))
+        # everything went back in one JOIN
+        self.assertEqual(self.server.received['JOIN'], 3)
+
+    async def test_backoff_doubles_while_refused(self):
+        refusals = 3
+        connect = self.server.create_connection
+
+        async def connector(*args, **kwargs):
+            nonlocal refusals
+            if refusals:
+                refusals -= 1
+                raise ConnectionRefusedError()
+            return await connect(*args, **kwargs)
+
+        self.client.connector = connector
+        self.client._bind(asyncio.get_running_loop())
+        self.client._connect()
+        await wait_for(lambda: self.server.connections and
+                               all(c.registered for c in self.server.connections))
+
+        delays = [delay for _, delay in self.client.attempts]
+        self.assertEqual([attempt for attempt, _ in self.client.attempts], [1, 2, 3])
+        for i, delay in enumerate(delays):
+            top = Client.reconnect_delay * 2 ** i
+            self.assertTrue(top / 2 <= delay <= top, (i, delay))
+
+        # a successful connection starts the backoff over
+        await wait_for(lambda: self.client.reconnect_count == 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+"""Bot command and trigger routing"""
+
+import asyncio, logging, re, unittest
+
+from asyncirc import IRCClient
+from asyncirc.routes import command, trigger, Route, RouteTable
+
+logging.getLogger('asyncirc').setLevel(logging.CRITICAL)
+
+
+def handler(event):
+    pass
+
+
+def commands(*names):
+    return Route(handler, names)
+
+
+def triggers(*patterns):
+    return [Route(handler, regex=re.compile(pattern)) for pattern in patterns]
+
+
+class RouteTableTest(unittest.TestCase):
+
+    def test_longest_command_wins(self):
+        set_, set_topic, help_ = commands('set'), commands('set topic'), commands('help', 'h')
+        table = RouteTable([set_, set_topic, help_])
+
+        self.assertEqual(table.find_command('set topic hello there'), (set_topic, 'hello there'))
+        self.assertEqual(table.find_command('SET Topic'), (set_topic, ''))
+        self.assertEqual(table.find_command('set mode +i'), (set_, 'mode +i'))
+        self.assertEqual(table.find_command('h  me'), (help_, 'me'))
+        self.assertIsNone(table.find_command('settopic'))
+        self.assertIsNone(table.find_command(''))
+
+    def test_triggers_go_by_definition_order(self):
+        world, hello = triggers('world', 'hello')
+        for table in (RouteTable([world, hello]), RouteTable(triggers('(w)orld', 'hello'))):
+            route, m = table.find_trigger('hello world')
+            self.assertEqual(m.group(0), 'world')
+
+        self.assertIsNone(RouteTable([world, hello]).find_trigger('goodbye'))
+
+    def test_backreferences_in_triggers(self):
+        other, repeat = triggers(r'(a)b', r'(x)(y)\2')
+        table = RouteTable([other, repeat])
+        self.assertIsNone(table.regex)
+
+        route, m = table.find_trigger('xyy')
+        self.assertIs(route, repeat)
+        self.assertEqual(m.groups(), ('x', 'y'))
+
+    def test_combined_triggers_keep_their_flags(self):
+        shout = Route(handler, regex=re.compile('HELLO', re.IGNORECASE))
+        url, = triggers(r'\bhttps?://\S+')
+        table = RouteTable([shout, url])
+        self.assertIsNotNone(table.regex)
+
+        route, m = table.find_trigger('see http://example.com')
+        self.assertEqual((route, m.group(0)), (url, 'http://example.com'))
+        route, m = table.find_trigger('why hello')
+        self.assertEqual((route, m.start()), (shout, 4))
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Transport:
+    def write(self, data):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class Bot(IRCClient):
+    flood_rate   = None
+    capabilities = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    @command('hello', 'hi')
+    def cmd_hello(self, event):
+        self.calls.append(('hello', event.match.args))
+
+    @command('slow', cooldown=10)
+    def cmd_slow(self, event):
+        self.calls.append(('slow', event.source))
+
+    @command('limited', rate=(2, 60))
+    def cmd_limited(self, event):
+        self.calls.append(('limited', event.source))
+
+    @trigger(r'\bcoffee\b')
+    def on_coffee(self, event):
+        self.calls.append(('coffee', event.match.group(0)))
+
+
+class RouterTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.bot = Bot('fake', nickname='bot')
+        self.bot._bind(asyncio.get_running_loop())
+        self.bot.connection_made(Transport())
+        self.clock = self.bot.router.clock = Clock()
+
+    async def say(self, text, target='#chan', source='someone'):
+        self.bot.data_received(':{0}!u@h PRIVMSG {1} :{2}\r\n'.format(
+                source, target, text).encode())
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+    async def test_prefixes_and_addressing(self):
+        await self.say('!hello world')
+        await self.say('bot: hi there')
+        await self.say('BOT, hello')
+        await self.say('hello', target='bot')
+        # not for us
+        await self.say('hello')
+        await self.say('bots: hello')
+        await self.say('?hello')
+        self.assertEqual(self.bot.calls, [('hello', 'world'), ('hello', 'there'),
+                                          ('hello', ''), ('hello', '')])
+
+    async def test_commands_before_triggers(self):
+        await self.say('!hello coffee')
+        await self.say('more coffee please')
+        self.assertEqual(self.bot.calls, [('hello', 'coffee'), ('coffee', 'coffee')])
+
+    async def test_cooldown(self):
+        await self.say('!slow', source='a')
+        self.clock.now += 5
+        await self.say('!slow', source='b')
+        self.clock.now += 5
+        await self.say('!slow', source='c')
+        self.assertEqual(self.bot.calls, [('slow', 'a'), ('slow', 'c')])
+
+    async def test_rate_limit_per_user(self):
+        for _ in range(3):
+            await self.say('!limited', source='a')
+        await self.say('!limited', source='b')
+        self.clock.now += 30
+        await self.say('!limited', source='a')
+        self.assertEqual(self.bot.calls, [('limited', 'a'), ('limited', 'a'),
+                                          ('limited', 'b'), ('limited', 'a')])
+
+
+if __name__ == '__main__':
+    unittest.main()
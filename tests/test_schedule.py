@@ -0,0 +1,250 @@
+"""The scheduler's timer wheel, persistence, and holding jobs while away"""
+
+import asyncio, json, logging, os, random, tempfile, unittest
+
+from asyncirc import IRCClient
+from asyncirc.schedule import Scheduler
+
+logging.getLogger('asyncirc').setLevel(logging.CRITICAL)
+
+
+class Clock:
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class WheelTest(unittest.TestCase):
+    """Driven by hand: with no loop, nothing runs until _run()"""
+
+    def setUp(self):
+        self.clock = Clock()
+        self.ran = []
+
+    def scheduler(self, **kwargs):
+        return Scheduler(resolve=lambda name: getattr(self, name), clock=self.clock, **kwargs)
+
+    def record(self, name):
+        self.ran.append((name, self.clock.now))
+
+    def run_until(self, scheduler, when, step=None):
+        """Move the clock on to when, running jobs as we go"""
+        if step is None:
+            self.clock.now = when
+            scheduler._run()
+            return
+        while self.clock.now < when:
+            self.clock.now = min(when, self.clock.now + step)
+            scheduler._run()
+
+    def test_jobs_run_in_order_once_due(self):
+        sched = self.scheduler()
+        sched.call_later(5, self.record, 'b')
+        sched.call_later(1, self.record, 'a')
+        sched.call_later(-1, self.record, 'late')
+
+        self.run_until(sched, self.clock.now + 0.5)
+        self.assertEqual([name for name, _ in self.ran], ['late'])
+        self.run_until(sched, self.clock.now + 10)
+        self.assertEqual([name for name, _ in self.ran], ['late', 'a', 'b'])
+        self.assertEqual(len(sched), 0)
+
+    def test_cascading_down_the_wheels(self):
+        sched = self.scheduler()
+        start = self.clock.now
+        # one on each wheel: ticks of 0.1s, so 25.6s, ~1.8h and ~19 days a turn
+        delays = [3, 300, 30000, 3000000]
+        for delay in delays:
+            sched.call_later(delay, self.record, delay)
+
+        self.run_until(sched, start + delays[-1] + 1, step=97.3)
+        self.assertEqual([name for name, _ in self.ran], delays)
+        for delay, (_, ran) in zip(delays, self.ran):
+            self.assertTrue(start + delay <= ran < start + delay + 97.3 + 0.1, (delay, ran))
+
+    def test_overflow(self):
+        # two wheels only reach 65536 ticks ahead
+        sched = self.scheduler(levels=2)
+        sched.call_later(100000, self.record, 'far')
+        sched.call_later(10, self.record, 'near')
+        self.assertEqual(len(sched._overflow), 1)
+
+        self.run_until(sched, self.clock.now + 50000, step=1000)
+        self.assertEqual([name for name, _ in self.ran], ['near'])
+        self.run_until(sched, self.clock.now + 60000, step=1000)
+        self.assertEqual([name for name, _ in self.ran], ['near', 'far'])
+
+    def test_cancel(self):
+        sched = self.scheduler()
+        keep = sched.call_later(1, self.record, 'keep')
+        drop = sched.call_later(1, self.record, 'drop')
+        far = sched.call_later(100000, self.record, 'far')
+
+        self.assertTrue(drop.cancel())
+        self.assertFalse(drop.cancel())
+        self.assertTrue(far.cancel())
+        self.assertEqual(sched.jobs(), [keep])
+
+        self.run_until(sched, self.clock.now + 200000, step=500)
+        self.assertEqual([name for name, _ in self.ran], ['keep'])
+        self.assertFalse(keep.cancel())
+
+    def test_random_against_a_sorted_list(self):
+        rnd = random.Random(7)
+        sched = self.scheduler(levels=3)
+        start = self.clock.now
+        expected = []
+        for i in range(2000):
+            delay = rnd.choice([rnd.uniform(0, 30), rnd.uniform(0, 3000), rnd.uniform(0, 3e6)])
+            job = sched.call_later(delay, self.record, i)
+            if rnd.random() < 0.2:
+                job.cancel()
+            else:
+                expected.append((start + delay, i))
+
+        end = start + 3e6 + 1
+        while self.clock.now < end:
+            self.clock.now = min(end, self.clock.now + rnd.expovariate(1 / 2000))
+            sched._run()
+
+        self.assertEqual(sorted(name for name, _ in self.ran), sorted(i for _, i in expected))
+        when = {i: due for due, i in expected}
+        for name, ran in self.ran:
+            self.assertGreaterEqual(ran + 0.1, when[name])
+        self.assertEqual(len(sched), 0)
+
+    def test_paused_jobs_are_held(self):
+        sched = self.scheduler()
+        sched.call_later(1, self.record, 'a')
+        sched.pause()
+        self.clock.now += 5
+        self.assertEqual(self.ran, [])
+        sched.resume()
+        sched._run()
+        self.assertEqual([name for name, _ in self.ran], ['a'])
+
+
+class PersistenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'jobs.json')
+        self.clock = Clock()
+        self.ran = []
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def record(self, *args):
+        self.ran.append(args)
+
+    def test_snapshot_and_restore(self):
+        sched = Scheduler(clock=self.clock)
+        sched.call_later(10, 'record', '#a', 'later')
+        sched.call_later(1, 'record', '#a', 'sooner')
+        sched.call_later(5, self.record, 'not saved')
+        self.assertEqual(sched.snapshot(self.path), 2)
+
+        self.clock.now += 3
+        restored = Scheduler(resolve=lambda name: getattr(self, name),
+                             path=self.path, clock=self.clock)
+        self.assertEqual([job.args for job in restored.jobs()],
+                         [('#a', 'sooner'), ('#a', 'later')])
+
+        # the overdue one runs straight away
+        restored._run()
+        self.assertEqual(self.ran, [('#a', 'sooner')])
+        self.clock.now += 10
+        restored._run()
+        self.assertEqual(self.ran, [('#a', 'sooner'), ('#a', 'later')])
+
+    def test_restore_without_a_file(self):
+        sched = Scheduler(clock=self.clock)
+        self.assertEqual(sched.restore(self.path), 0)
+
+
+class Transport:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data):
+        self.lines.extend(data.decode().split('\r\n')[:-1])
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class Client(IRCClient):
+    flood_rate   = None
+    capabilities = ()
+
+
+class HeldJobsTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'jobs.json')
+
+    async def asyncTearDown(self):
+        self.dir.cleanup()
+
+    async def settle(self):
+        for _ in range(3):
+            await asyncio.sleep(0)
+
+    async def test_restored_jobs_wait_for_registration(self):
+        with open(self.path, 'w') as f:
+            json.dump([{'when': 0, 'action': 'privmsg', 'args': ['#a', 'overdue']}], f)
+
+        class Saved(Client):
+            schedule_file = self.path
+
+        client = Saved('fake', nickname='me')
+        client._bind(asyncio.get_running_loop())
+        await self.settle()
+        self.assertEqual(len(client.scheduler), 1)
+
+        transport = Transport()
+        client.connection_made(transport)
+        client.data_received(b':s 001 me :Welcome\r\n')
+        await self.settle()
+        self.assertNotIn('PRIVMSG #a :overdue', transport.lines)
+
+        client.data_received(b':s 422 me :MOTD File is missing\r\n')
+        await self.settle()
+        self.assertIn('PRIVMSG #a :overdue', transport.lines)
+        self.assertEqual(len(client.scheduler), 0)
+
+    async def test_jobs_due_while_away_are_held(self):
+        client = Client('fake', nickname='me')
+        client.reconnect = False
+        client._bind(asyncio.get_running_loop())
+        transport = Transport()
+        client.connection_made(transport)
+        client.data_received(b':s 001 me :Welcome\r\n:s 376 me :End of MOTD\r\n')
+
+        client.connection_lost(None)
+        client.privmsg_delayed(0, '#a', 'while away')
+        await asyncio.sleep(0.15)
+        self.assertEqual(len(client.scheduler), 1)
+
+        transport = Transport()
+        client.connection_made(transport)
+        client.data_received(b':s 001 me :Welcome\r\n:s 376 me :End of MOTD\r\n')
+        await self.settle()
+        self.assertIn('PRIVMSG #a :while away', transport.lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""Channel and user state tracking, fed messages straight into the client"""
+
+import asyncio, logging, unittest
+
+from asyncirc import IRCClient
+
+logging.getLogger('asyncirc').setLevel(logging.CRITICAL)
+
+
+class Transport:
+    def write(self, data):
+        pass
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class Client(IRCClient):
+    flood_rate   = None
+    capabilities = ()
+
+
+class StateTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.client = Client('fake', nickname='me')
+        self.client._bind(asyncio.get_running_loop())
+        self.client.connection_made(Transport())
+        self.state = self.client.state
+        self.feed(':s 001 me :Welcome',
+                  ':s 005 me PREFIX=(qaohv)~&@%+ CHANMODES=beI,k,l,imnpst :are supported')
+
+        # a NAMES burst with multi-prefix and userhost-in-names
+        self.feed(':me!m@host JOIN #chan',
+                  ':s 353 me = #chan :@+op!o@h +voice!v@h plain!p@h',
+                  ':s 353 me = #chan :me!m@host',
+                  ':s 366 me #chan :End of /NAMES list.',
+                  ':me!m@host JOIN #other',
+                  ':op!o@h JOIN #other')
+
+    def feed(self, *lines):
+        self.client.data_received(''.join(line + '\r\n' for line in lines).encode())
+        self.check_indexes()
+
+    def check_indexes(self):
+        """The channel -> members and user -> channels indexes agree"""
+        state = self.state
+        for chankey, chan in state.channels.items():
+            self.assertEqual(chan.key, chankey)
+            for key in chan.members:
+                self.assertIn(chankey, state.users[key].channels)
+        for key, user in state.users.items():
+            self.assertEqual(self.client.casefold(user.nick), key)
+            self.assertTrue(user.channels)
+            for chankey in user.channels:
+                self.assertIn(key, state.channels[chankey].members)
+
+    def test_names_burst(self):
+        self.assertEqual(sorted(self.state.members('#CHAN')), ['me', 'op', 'plain', 'voice'])
+        self.assertEqual(self.state.modes('#chan', 'OP'), 'ov')
+        self.assertEqual(self.state.modes('#chan', 'voice'), 'v')
+        self.assertEqual(self.state.modes('#chan', 'plain'), '')
+        self.assertIsNone(self.state.modes('#chan', 'nobody'))
+        self.assertTrue(self.state.is_on('voice', '#chan'))
+        self.assertFalse(self.state.is_on('voice', '#other'))
+        self.assertEqual(sorted(self.state.common_channels('op')), ['#chan', '#other'])
+
+        user = self.state.user('plain')
+        self.assertEqual((user.nick, user.user, user.host), ('plain', 'p', 'h'))
+
+    def test_modes_with_parameters(self):
+        self.feed(':op!o@h MODE #chan +obl-v+k plain *!*@bad 10 voice key')
+        self.assertEqual(self.state.modes('#chan', 'plain'), 'o')
+        self.assertEqual(self.state.modes('#chan', 'voice'), '')
+        self.assertEqual(self.state.modes('#chan', 'op'), 'ov')
+
+        # unsetting l takes no parameter, unsetting k does
+        self.feed(':op!o@h MODE #chan -lo+h-k+q op op key me')
+        self.assertEqual(self.state.modes('#chan', 'op'), 'hv')
+        self.assertEqual(self.state.modes('#chan', 'me'), 'q')
+
+    def test_nick_change(self):
+        self.feed(':op!o@h NICK Op[1]')
+        self.assertFalse(self.state.is_on('op', '#chan'))
+        self.assertTrue(self.state.is_on('OP{1}', '#chan'))
+        self.assertEqual(self.state.modes('#chan', 'op[1]'), 'ov')
+        self.assertEqual(sorted(self.state.common_channels('op[1]')), ['#chan', '#other'])
+        self.assertEqual(self.state.user('op{1}').nick, 'Op[1]')
+
+    def test_quit(self):
+        self.feed(':op!o@h QUIT :bye')
+        self.assertFalse(self.state.is_on('op', '#chan'))
+        self.assertFalse(self.state.is_on('op', '#other'))
+        self.assertIsNone(self.state.user('op'))
+        self.assertEqual(self.state.common_channels('op'), [])
+
+    def test_kicked_ourselves(self):
+        self.feed(':op!o@h KICK #chan me :out')
+        self.assertIsNone(self.state.channel('#chan'))
+        self.assertFalse(self.state.is_on('plain', '#chan'))
+        self.assertIsNone(self.state.user('plain'))
+        self.assertEqual(self.state.common_channels('op'), ['#other'])
+        self.assertEqual(self.state.modes('#other', 'op'), '')
+
+    def test_case_mapping_change(self):
+        self.feed(':me!m@host JOIN #A[x]',
+                  ':s 353 me = #A[x] :me @Nick{1}',
+                  ':s 366 me #A[x] :End of /NAMES list.')
+        self.assertTrue(self.state.is_on('nick[1]', '#a{x}'))
+
+        self.feed(':s 005 me CASEMAPPING=ascii :are supported')
+        self.assertTrue(self.state.is_on('NICK{1}', '#a[x]'))
+        self.assertFalse(self.state.is_on('nick[1]', '#a[x]'))
+        self.assertIsNone(self.state.channel('#a{x}'))
+        self.assertEqual(self.state.modes('#A[X]', 'nick{1}'), 'o')
+        self.assertEqual(self.state.common_channels('nick{1}'), ['#A[x]'])
+
+        # and later updates use the new mapping
+        self.feed(':Nick{1}!n@h PART #a[x]')
+        self.assertFalse(self.state.is_on('nick{1}', '#A[x]'))
+        self.assertIsNone(self.state.user('nick{1}'))
+
+
+if __name__ == '__main__':
+    unittest.main()